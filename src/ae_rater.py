@@ -38,9 +38,11 @@ INITIAL_METADATA_FNAME = "backup_initial_metadata.csv"
 DEFAULT_HISTORY_FNAME = "match_history.csv"
 
 class Controller:
-  def __init__(self, media_dir:str, refresh:bool, prioritizer_type=PrioritizerType.DEFAULT, history_fname=DEFAULT_HISTORY_FNAME) -> None:
+  def __init__(self, media_dir:str, refresh:bool, prioritizer_type=PrioritizerType.DEFAULT, history_fname=DEFAULT_HISTORY_FNAME,
+               watch:bool=False, write_behind:bool=False, similarity:bool=False) -> None:
     self.competition = RatingCompetition()
-    self.db = DBAccess(media_dir, refresh, prioritizer_type, self.competition.get_rat_systems(), history_fname)
+    self.db = DBAccess(media_dir, refresh, prioritizer_type, self.competition.get_rat_systems(), history_fname,
+                       self.competition.get_batch_systems(), watch, write_behind, similarity)
     self.analyzer = Analyzer()
 
   def process_match(self, match:MatchInfo):
@@ -49,25 +51,47 @@ class Controller:
     self.db.apply_opinions(match.profiles, opinions)
 
 class FromHistoryController(Controller):
+  CHECKPOINT_EVERY = 1000
+
   def __init__(self, media_dir:str, history_fname:str=DEFAULT_HISTORY_FNAME):
     super().__init__(media_dir, refresh=False, history_fname=history_fname)
 
-  def run(self, with_diagnostics=True):
-    logging.info("preparing to re-run history: resetting meta to initial...")
-    self.db.reset_meta_to_initial()
-    for match in tqdm(self.db.get_match_history()):
-      self.process_match(match)
+  def run(self, with_diagnostics=True, from_scratch=False):
+    offset, checkpoint = (0, None) if from_scratch else self.db.get_checkpoint()
+    if checkpoint is None:
+      logging.info("preparing to re-run history: resetting meta to initial...")
+    else:
+      logging.info("preparing to re-run history: resuming from checkpoint at match %d...", offset)
+    self.db.reset_meta_to_initial(checkpoint)
+    total = self.db.get_history_len()
+    with tqdm(total=total, initial=offset) as pbar:
+      while offset < total:
+        stop = min(total, (offset//self.CHECKPOINT_EVERY + 1) * self.CHECKPOINT_EVERY)
+        for match in self.db.get_match_history(offset, stop):
+          self.process_match(match)
+        pbar.update(stop-offset)
+        offset = stop
+        self.db.save_checkpoint(offset)
     if with_diagnostics:
       self.analyzer.show_results()
 
+class BatchFitController(Controller):
+  def __init__(self, media_dir:str, history_fname:str=DEFAULT_HISTORY_FNAME):
+    super().__init__(media_dir, refresh=False, history_fname=history_fname)
+
+  def run(self):
+    for system in self.competition.get_batch_systems():
+      logging.info("fitting %s over the whole history...", system.name())
+      self.db.fit_batch(system)
+
 class InteractiveController(Controller, UserListener):
   def __init__(self, media_dir:str, refresh:bool, n_participants:int, prioritizer_type, mode:AppMode) -> None:
-    super().__init__(media_dir, refresh, prioritizer_type)
+    super().__init__(media_dir, refresh, prioritizer_type, watch=True, write_behind=True, similarity=True)
     self.n = n_participants
     self.mode = mode
     self.gui = MatchGui(self) if mode==AppMode.MATCH else SearchGui(self)
     self.participants = []
-    self.ai_assistant = Assistant()
+    self.ai_assistant = Assistant(media_dir)
 
   def run(self) -> None:
     try:
@@ -77,17 +101,20 @@ class InteractiveController(Controller, UserListener):
         self.search_for("", page=1)
       else:
         raise RuntimeError(f"cannot run mode {self.mode}")
+      self.ai_assistant.preload()  # the first page is up, the model loads while it's looked at
       self.gui.mainloop()
     except Exception:
       logging.exception("")
     finally:
       self.db.on_exit()
+      self.ai_assistant.close()
 
   def start_next_match(self):
     show_mem_usage()
     self.participants = self.db.get_next_match(self.n)
     self.gui.display_leaderboard(self.db.get_leaderboard(), self.participants)
     self.gui.display_match(self.participants)
+    self._report_write_failures()
 
   def consume_result(self, outcome:Outcome) -> None:
     assert self.n and len(self.participants) == self.n
@@ -98,6 +125,7 @@ class InteractiveController(Controller, UserListener):
     self.gui.display_leaderboard(self.db.get_leaderboard(), self.participants)
     self.gui.conclude_match()
     self.participants = []
+    self._report_write_failures()
 
   def update_meta(self, fullname:str, meta:ManualMetadata) -> None:
     self.db.update_meta(fullname, meta)
@@ -105,15 +133,24 @@ class InteractiveController(Controller, UserListener):
     self.participants = [updated_prof if p.fullname==fullname else p for p in self.participants]
     self.gui.display_leaderboard(self.db.get_leaderboard(), self.participants)
     self.gui.refresh_profile(updated_prof)
+    self._report_write_failures()
 
   def suggest_tags(self, fullname:str) -> list:
-    return self.ai_assistant.suggest_tags(fullname)
+    return self.ai_assistant.suggest_tags_nowait(fullname)
+
+  def suggestions_status(self) -> str:
+    return self.ai_assistant.status()
 
   def search_for(self, query:str, page:int=1) -> None:
     show_mem_usage()
     res = self.db.get_search_results(query, self.n, page)
     self.gui.display_leaderboard(self.db.get_leaderboard(), res)
     self.gui.display_match(res, self.n)
+    self._report_write_failures()
+
+  def _report_write_failures(self) -> None:
+    if failures := self.db.pop_write_failures():
+      self.gui.show_error("Could not save:\n" + '\n'.join(failures))
 
 
 def main(args):
@@ -122,6 +159,10 @@ def main(args):
   if args.history_replay:
     FromHistoryController(
       args.media_dir,
+    ).run(from_scratch=args.from_scratch)
+  elif args.batch_fit:
+    BatchFitController(
+      args.media_dir,
     ).run()
   else:
     InteractiveController(
@@ -141,6 +182,12 @@ if __name__ == "__main__":
   parser.add_argument('--history_replay', dest='history_replay', action='store_const',
                       const=True, default=False,
                       help="replay matches from history instead of interactive matches")
+  parser.add_argument('--from_scratch', dest='from_scratch', action='store_const',
+                      const=True, default=False,
+                      help="ignore history checkpoints and replay every match")
+  parser.add_argument('--batch_fit', dest='batch_fit', action='store_const',
+                      const=True, default=False,
+                      help="fit the offline rating systems to the whole history")
   parser.add_argument('-p', '--prioritizer', dest='prioritizer_type', type=PrioritizerType,
                       choices=list(PrioritizerType), default=PrioritizerType.DEFAULT,
                       help="which media is prioritized for matches")
@@ -1,22 +1,29 @@
 import logging
 import os
 import statistics
+import time
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
 from ae_rater_types import *
 from db_managers import MetadataManager, HistoryManager
-from rating_backends import RatingBackend, ELO, Glicko
+from perceptual_index import PerceptualIndex
+from profile_store import Profiles, ProfileStore
+from rating_backends import RatingBackend, ELO, Glicko, TrueSkill, BradleyTerry
+from write_behind import WriteBehind
 
 
 class RatingCompetition:
   def __init__(self):
-    self.rat_systems:list[RatingBackend] = [Glicko(), ELO()]
+    self.rat_systems:list[RatingBackend] = [Glicko(), ELO(), TrueSkill()]
+    self.batch_systems:list[BradleyTerry] = [BradleyTerry()]
 
   def get_rat_systems(self) -> list[RatingBackend]:
     return self.rat_systems
 
+  def get_batch_systems(self) -> list[BradleyTerry]:
+    return self.batch_systems
+
   def consume_match(self, match:MatchInfo) -> tuple[RatingOpinions, DiagnosticInfo]:
     logging.info("consume_match outcome = '%s'  boosts = %s", match.outcome.tiers, match.outcome.boosts)
     opinions = {s.name(): s.process_match(match)
@@ -62,21 +69,33 @@ class Analyzer:
   def show_results(self):
     if self.df is None:
       return
+    import matplotlib.pyplot as plt  # only replays plot, the app shouldn't pay for the import
     self.df.plot(subplots=True, figsize=(10,10))
     plt.title("Diagnostic of the replay")
     plt.show()
 
 
 class DBAccess:
-  def __init__(self, media_dir, refresh, prioritizer_type, rat_systems:list[RatingBackend], history_fname:str) -> None:
+  def __init__(self, media_dir, refresh, prioritizer_type, rat_systems:list[RatingBackend], history_fname:str,
+               batch_systems:list[BradleyTerry]=(), watch:bool=False, write_behind:bool=False,
+               similarity:bool=False) -> None:
+    """
+    write_behind: persist in the background, failures are collected by pop_write_failures()
+    similarity: keep a perceptual index for near-duplicate search and matchmaking, built in the background
+    """
     self.media_dir = media_dir
     self.rat_systems = rat_systems
-    self.meta_mgr = MetadataManager(media_dir, refresh, prioritizer_type, self.default_values_getter)
-    self.history_mgr = HistoryManager(media_dir, history_fname)
+    self.batch_systems = list(batch_systems)
+    self.writer = WriteBehind() if write_behind else None
+    self.store = ProfileStore(media_dir, [s.name() for s in self.rat_systems + self.batch_systems])
+    self.meta_mgr = MetadataManager(media_dir, refresh, prioritizer_type, self.default_values_getter, watch,
+                                    PerceptualIndex(media_dir, background=True) if similarity else None,
+                                    self.writer, self.store)
+    self.history_mgr = HistoryManager(media_dir, history_fname, self.writer)
 
   def default_values_getter(self, stars:float)->dict:
     default_values = {}
-    for s in self.rat_systems:
+    for s in self.rat_systems + self.batch_systems:
       def_rat = s.stars_to_rating(stars)
       default_values.update({
         s.name()+"_pts": def_rat.points,
@@ -92,13 +111,22 @@ class DBAccess:
       match.outcome.rawstr
     )
 
-  def reset_meta_to_initial(self) -> None:
-    self.meta_mgr.reset_meta_to_initial()
+  def reset_meta_to_initial(self, checkpoint:pd.DataFrame=None) -> None:
+    self.meta_mgr.reset_meta_to_initial(checkpoint)
+
+  def save_checkpoint(self, offset:int) -> None:
+    self.history_mgr.save_checkpoint(offset, self.meta_mgr.get_db())
+
+  def get_checkpoint(self) -> tuple[int, pd.DataFrame]:
+    return self.history_mgr.get_checkpoint()
+
+  def get_history_len(self) -> int:
+    return len(self.history_mgr.get_match_history())
 
-  def get_match_history(self) -> list[MatchInfo]:
+  def get_match_history(self, start:int=0, stop:int=None) -> list[MatchInfo]:
     hist = []
     matches_unavailable = 0
-    for index, (timestamp, names, outcome_str) in self.history_mgr.get_match_history().iterrows():
+    for index, (timestamp, names, outcome_str) in self.history_mgr.get_match_history().iloc[start:stop].iterrows():
       assert isinstance(timestamp, float)
       assert isinstance(names, str), type(names)
       assert names
@@ -115,6 +143,34 @@ class DBAccess:
       logging.warning(f"get_match_history: couldn't reconstruct {matches_unavailable} matches")
     return hist
 
+  def fit_batch(self, system:BradleyTerry) -> None:
+    db = self.meta_mgr.get_db()
+    row_of = {name:i for i,name in enumerate(db.index)}
+    winners, losers, weights = [], [], []
+    matches_unavailable = 0
+    for names, outcome_str in self.history_mgr.get_match_history()[['names', 'outcome']].itertuples(index=False):
+      rows = [row_of.get(name) for name in eval(names)]
+      if None in rows:
+        matches_unavailable += 1
+        continue
+      for curr, results in Outcome(outcome_str).as_dict().items():
+        for opponent, sr in results:
+          if sr:
+            winners.append(rows[curr])
+            losers.append(rows[opponent])
+            weights.append(sr)
+    if matches_unavailable:
+      logging.warning(f"fit_batch: couldn't reconstruct {matches_unavailable} matches")
+
+    prior_pts = np.array([system.stars_to_rating(stars).points for stars in db['stars']])
+    points, errors = system.fit(np.array(winners, dtype=np.int64), np.array(losers, dtype=np.int64),
+                                np.array(weights, dtype=float), prior_pts, db[system.name()+'_pts'].to_numpy())
+    self.meta_mgr.update_many(pd.DataFrame({
+      system.name()+'_pts': points,
+      system.name()+'_rd': errors,
+      system.name()+'_time': time.time(),
+    }, index=db.index))
+
   def apply_opinions(self, profiles:list[ProfileInfo], opinions:RatingOpinions) -> None:
     for i,prof in enumerate(profiles):
       new_ratings = {}
@@ -143,57 +199,29 @@ class DBAccess:
     logging.info("update_meta %s\n  starchange: %s\n  upd=%s", fullname, starchange, upd)
     self.meta_mgr.update(fullname, upd)
 
-  def get_leaderboard(self) -> list[ProfileInfo]:
-    db = self.meta_mgr.get_db()
-    sortpriorities = ['stars'] + [s.name()+'_pts' for s in self.rat_systems] + ['awards']
-    db.sort_values(sortpriorities, ascending=False, inplace=True)
-    return [self._validate_and_convert_info(db.iloc[i]) for i in range(len(db))]
+  def get_leaderboard(self) -> Profiles:
+    self.meta_mgr.apply_fs_events()
+    return self.store.ranking([s.name() for s in self.rat_systems])
 
   def get_next_match(self, n:int) -> list[ProfileInfo]:
-    sample = self.meta_mgr.get_rand_files_info(n)
-    return [self._validate_and_convert_info(sample.iloc[i])
-            for i in range(len(sample))]
+    self.meta_mgr.apply_fs_events()
+    return self.store.profiles(self.meta_mgr.get_rand_files_info(n).index)
 
   def get_search_results(self, query:str, n_per_page:int, page:int) -> list[ProfileInfo]:
-    hits = self.meta_mgr.get_search_results(query, n_per_page, page)
+    ldbrd = self.get_leaderboard()
+    if not query.strip():
+      return ldbrd[n_per_page*(page-1):n_per_page*page]
+    hits = self.meta_mgr.get_search_results(query, n_per_page, page, order=self.store.names[ldbrd.rows])
     assert len(hits) <= n_per_page, f"query returned {len(hits)} elems, expected no more than {n_per_page}"
-    return [self._validate_and_convert_info(hits.iloc[i])
-            for i in range(len(hits))]
+    return self.store.profiles(hits.index)
 
   def get_profile(self, fullname:str) -> ProfileInfo:
-    info = self.meta_mgr.get_file_info(os.path.basename(fullname))
-    return self._validate_and_convert_info(info)
+    return self.store.get(os.path.basename(fullname))
+
+  def pop_write_failures(self) -> list[str]:
+    return self.writer.pop_failures() if self.writer else []
 
   def on_exit(self) -> None:
     self.meta_mgr.on_exit()
-
-  def _validate_and_convert_info(self, info) -> ProfileInfo:
-    short_name = info.name
-
-    expected_dtypes = {
-      'tags': str,
-      'stars': np.float64,
-      'nmatches': np.int64,
-      'priority': np.float64,
-      'awards': str,
-    }
-    for s in self.rat_systems:
-      expected_dtypes |= {
-        s.name()+'_pts': np.int64,
-        s.name()+'_rd': np.int64,
-        s.name()+'_time': np.float64,
-      }
-    assert all(col in info.index for col in expected_dtypes.keys()), str(info)
-    assert 0 <= info['stars']
-    for col,t in expected_dtypes.items():
-      assert isinstance(info[col], t), f"{col} expected {t}  got {type(info[col])} {short_name}"
-
-    return ProfileInfo(
-      tags=info['tags'],
-      fullname=os.path.join(self.media_dir, short_name),
-      stars=info['stars'],
-      ratings={s.name():Rating(info[s.name()+'_pts'], info[s.name()+'_rd'], info[s.name()+'_time'])
-               for s in self.rat_systems},
-      nmatches=int(info['nmatches']),
-      awards=info['awards'],
-    )
+    if self.writer:
+      self.writer.close()
@@ -11,7 +11,7 @@ from helpers import truncate
 from metadata import ManualMetadata
 
 
-@dataclass
+@dataclass(slots=True)
 @total_ordering
 class Rating:
   points: int
@@ -35,7 +35,7 @@ class Rating:
     return f"{self.points}`{self.rd}`"
 
 
-@dataclass
+@dataclass(slots=True)
 class ProfileInfo:
   fullname : str
   tags : str = ""
@@ -245,6 +245,11 @@ class UserListener:
     raise NotImplementedError()
 
   def suggest_tags(self, fullname:str) -> list:
+    """must not block: None if the suggestions aren't ready yet, the editor asks again"""
+    raise NotImplementedError()
+
+  def suggestions_status(self) -> str:
+    """what the editor shows while suggest_tags() returns None"""
     raise NotImplementedError()
 
   def search_for(self, query:str, page:int=1) -> None:
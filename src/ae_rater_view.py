@@ -3,7 +3,7 @@ from itertools import filterfalse
 from abc import ABC, abstractmethod
 import math
 import tkinter as tk
-from tkinter import ttk
+from tkinter import messagebox, ttk
 import tkinter.font
 import numpy as np
 import logging
@@ -74,6 +74,9 @@ class RaterGui(ABC):
     card = next(c for c in self.cards if c.get_curr_profile().fullname==prof.fullname)
     card.show_profile(prof)
 
+  def show_error(self, msg:str) -> None:
+    messagebox.showerror("aesthetics", msg, parent=self.root)
+
   def mainloop(self):
     self.root.mainloop()
 
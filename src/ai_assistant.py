@@ -1,23 +1,111 @@
 import os
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from ai_backend_tags import ConvnextTiny
 from ai_backend_stars import StarPredictorBaseline
+from ai_backend_tags import MODEL_PATH, ConvnextTiny, model_version
 from metadata import get_metadata
+from tag_suggestions import SuggestionCache
 
 
 class Assistant:
-  def __init__(self):
+  """
+  The tags model is loaded on the inference thread, on first use or by preload():
+  torch and the model take seconds, nothing else should wait for them.
+  Cached suggestions are served while the model is still loading,
+  the stars baseline is cheap and ready on construction
+  """
+  def __init__(self, media_dir:str=None):
+    self.tags_backend = None
+    self.stars_backend = StarPredictorBaseline()
+    self.cache = None
+    if media_dir and os.path.exists(MODEL_PATH):
+      self.cache = SuggestionCache(media_dir, model_version())
+    # the only user of the tags model: callers never run inference at the same time
+    self.inference = ThreadPoolExecutor(max_workers=1)
+    self.loaded:Future = None
+    self.running:dict[str,Future] = {}  # till their results are taken
+    self.lock = threading.Lock()
+
+  def preload(self) -> Future:
+    with self.lock:
+      if self.loaded is None:
+        self.loaded = self.inference.submit(self._load)
+      return self.loaded
+
+  def _load(self) -> None:
     try:
       self.tags_backend = ConvnextTiny()
-    except:
-      self.tags_backend = None
-    self.stars_backend = StarPredictorBaseline()
+    except Exception as ex:
+      logging.warning("no tag suggestions, could not load the model: %s", ex)
+
+  def is_loading(self) -> bool:
+    return self.loaded is None or not self.loaded.done()
+
+  def status(self) -> str:
+    return "loading model..." if self.is_loading() else "computing..."
 
   def suggest_tags(self, fname:str) -> list[str]:
+    """waits for inference if the suggestions aren't cached"""
+    fullname = os.path.abspath(fname)
+    cached = self._cached(fullname)
+    if cached is not None:
+      return cached
+    future = self._infer(fullname)
+    try:
+      return future.result()
+    finally:
+      self._forget(fullname, future)
+
+  def suggest_tags_nowait(self, fname:str) -> list[str]:
+    """None while the model loads or the suggestions are being computed in the background, ask again later"""
+    fullname = os.path.abspath(fname)
+    cached = self._cached(fullname)
+    if cached is not None:
+      return cached
+    future = self._infer(fullname)
+    if not future.done():
+      return None
+    self._forget(fullname, future)
+    try:
+      return future.result()
+    except Exception as ex:
+      logging.warning("Could not suggest tags for '%s': %s", fullname, ex)
+      return []
+
+  def _cached(self, fullname:str) -> list:
+    if self.cache and self.cache.covers(fullname):
+      cached = self.cache.get(fullname)
+      return cached if cached is None else cached[:20]
+    return None
+
+  def _infer(self, fullname:str) -> Future:
+    self.preload()  # queued before any inference
+    with self.lock:
+      if fullname not in self.running:
+        self.running[fullname] = self.inference.submit(self._suggest_and_cache, fullname)
+      return self.running[fullname]
+
+  def _forget(self, fullname:str, future:Future) -> None:
+    with self.lock:
+      if self.running.get(fullname) is future:
+        del self.running[fullname]
+
+  def _suggest_and_cache(self, fullname:str) -> list:
     if not self.tags_backend:
       return []
-    return self.tags_backend.suggest_tags(os.path.abspath(fname))[:20]
+    suggestions = self.tags_backend.suggest_tags(fullname)
+    if self.cache and self.cache.covers(fullname):
+      self.cache.put(fullname, suggestions)
+      self.cache.commit_due()
+    return suggestions[:20]
 
-  def predict_rating(self, fname:str) -> float:
-    return self.stars_backend.predict_from_tags(get_metadata(fname)[0])
+  def close(self) -> None:
+    """commits the suggestions computed since the last commit"""
+    if self.cache and self.cache.dirty:
+      self.cache.commit()
 
+  def predict_rating(self, fname:str) -> float:
+    meta = get_metadata(fname)
+    return self.stars_backend.predict_from_tags(meta.tags, meta.awards)
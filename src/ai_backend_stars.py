@@ -1,17 +1,21 @@
 import math
 import os
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.ensemble import RandomForestRegressor
 
 from db_managers import MetadataManager
 from ai_types import StarPredictorBackend
+from tag_features import TagFeaturizer
 
 
 class StarPredictorBaseline(StarPredictorBackend):
-  def predict_from_tags(self, tags):
-    AVERAGE = 1.8
-    return AVERAGE
+  AVERAGE = 1.8
+
+  def predict_from_tags(self, tags, awards=()):
+    return self.AVERAGE
+
+  def predict_many(self, items):
+    return np.full(len(items), self.AVERAGE)
 
 
 def r_mse(pred, y):
@@ -19,49 +23,46 @@ def r_mse(pred, y):
 
 
 class RandomForest(StarPredictorBackend):
-  def __init__(self):
-    super().__init__()
-
-    def prepare_datasets():
-      MEDIAPATH = os.path.abspath("")
-      mm = MetadataManager(MEDIAPATH)
-      train_df = mm.get_db().reset_index().rename(columns={'index':'name'})
-      train_df = train_df[['name', 'tags', 'stars']]
-      vocab = train_df['tags'].str.split().explode().unique()
-      tags_df = pd.DataFrame({tag:train_df['tags'].str.contains(tag,regex=False) for tag in vocab})
-      train_df = pd.concat([train_df, tags_df], axis=1)
-      valid_df = train_df.sample(frac=0.1)
-      train_df.drop(valid_df.index, inplace=True)
-      valid_df.sort_values('stars', ascending=False, inplace=True)
-      return train_df, valid_df, vocab
+  def __init__(self, mm:MetadataManager, valid_frac:float=0.1):
+    from sklearn.ensemble import RandomForestRegressor
+    self.mm = mm
+    db = mm.get_db()
+    self.featurizer = TagFeaturizer().fit(db)
+    x, y = self.featurizer.db_features(mm), db['stars'].to_numpy()
+    self.valid = np.random.rand(len(db)) < valid_frac
+    self.forest = RandomForestRegressor(oob_score=True, n_jobs=-1)
+    self.forest.fit(x[~self.valid], y[~self.valid])
 
-    train_df, valid_df, self.vocab = prepare_datasets()
+  def report(self):
+    import matplotlib.pyplot as plt
+    db = self.mm.get_db()
+    x, y = self.featurizer.db_features(self.mm), db['stars'].to_numpy()
     print("Datasets are prepared.\n"
-          f"vocab has {len(self.vocab)} items: {self.vocab[:10]}...\n"
-          f"train_df has {len(train_df)} and valid has {len(valid_df)}\n"
-          f"train_df:\n{train_df.sample(5)}\n"
-          f"valid_df:\n{valid_df.sample(5)}\n")
-    train_x, train_y = train_df[self.vocab], train_df['stars']
-    valid_x, valid_y = valid_df[self.vocab], valid_df['stars']
-    self.forest = RandomForestRegressor(oob_score=True)
-    self.forest.fit(train_x, train_y)
-
-    def loss(x, y):
-      return r_mse(self.forest.predict(x), y)
+          f"{len(self.featurizer.columns)} features: {self.featurizer.columns[:10]}...\n"
+          f"train has {(~self.valid).sum()} and valid has {self.valid.sum()}")
+    def loss(mask):
+      return r_mse(self.forest.predict(x[mask]), y[mask])
     print( "Random forest trained. MSE:\n"
-          f" test={loss(train_x, train_y)}\n"
-          f"valid={loss(valid_x, valid_y)}\n"
-          f"  oob={r_mse(self.forest.oob_prediction_, train_y)}")
-    plt.plot(valid_y.index, valid_y)
-    plt.plot(valid_y.index, self.forest.predict(valid_x))
+          f" test={loss(~self.valid)}\n"
+          f"valid={loss(self.valid)}\n"
+          f"  oob={r_mse(self.forest.oob_prediction_, y[~self.valid])}")
+    order = np.argsort(-y[self.valid], kind='stable')
+    plt.plot(y[self.valid][order])
+    plt.plot(self.forest.predict(x[self.valid])[order])
     plt.show()
 
+  def predict_from_tags(self, tags, awards=()):
+    return self.predict_many([(tags, awards)])[0]
+
+  def predict_many(self, items):
+    """items: (tags, awards) of each file, the forest was trained on both"""
+    return self.forest.predict(self.featurizer.transform(TagFeaturizer.tokens(tags, awards) for tags, awards in items))
 
-  def predict_from_tags(self, tags):
-    pred = self.forest.predict(pd.DataFrame({t:[t in tags] for t in self.vocab}))
-    assert len(pred) == 1
-    return pred[0]
+  def predict_db(self) -> pd.Series:
+    """predicted stars of the whole library, by tags and awards"""
+    return pd.Series(self.forest.predict(self.featurizer.db_features(self.mm)), index=self.mm.get_db().index)
 
 
 if __name__ == "__main__":
-  rf = RandomForest()
+  rf = RandomForest(MetadataManager(os.path.abspath("")))
+  rf.report()
@@ -1,15 +1,31 @@
 import os
-from fastai.vision.all import load_learner
 
 from ai_types import TagsBackend
 
 
+MODEL_PATH = os.path.abspath("./models/convnext_tiny_in22k_new.pkl")
+
+def model_version(path:str=MODEL_PATH) -> str:
+  """changes whenever the model file is replaced"""
+  return f"{os.path.basename(path)}@{os.stat(path).st_mtime_ns}"
+
+
 class ConvnextTiny(TagsBackend):
-  def __init__(self):
+  def __init__(self, saved_model:str=MODEL_PATH):
     super().__init__()
-    saved_model = os.path.abspath("./models/convnext_tiny_in22k_new.pkl")
+    from fastai.vision.all import load_learner  # torch takes seconds to import
     self.learner = load_learner(saved_model)
+    self.version = model_version(saved_model)
+
+  def _ranked(self, probs) -> list[tuple[str,float]]:
+    return sorted(zip(self.learner.dls.vocab, probs.tolist()), key=lambda t:t[1], reverse=True)
 
   def suggest_tags(self, fullname):
     tags, booltensor, probs = self.learner.predict(fullname)
-    return sorted(zip(self.learner.dls.vocab, probs), key=lambda t:t[1], reverse=True)
+    return self._ranked(probs)
+
+  def suggest_many(self, fullnames, bs:int=64):
+    # decoding images is the slow part on cpu, spread it over all the cores
+    dl = self.learner.dls.test_dl(fullnames, bs=bs, num_workers=os.cpu_count())
+    probs, _ = self.learner.get_preds(dl=dl)
+    return [self._ranked(p) for p in probs]
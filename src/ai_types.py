@@ -1,14 +1,24 @@
 from abc import ABC, abstractmethod
+import numpy as np
 
 
 class TagsBackend(ABC):
+  version = ""  # of the model, cached suggestions of other versions are stale
+
   @abstractmethod
   def suggest_tags(self, fullname:str) -> list[tuple[str,float]]:
     """return list of tuples (tag, probability)"""
     pass
 
+  def suggest_many(self, fullnames:list[str]) -> list[list[tuple[str,float]]]:
+    return [self.suggest_tags(f) for f in fullnames]
+
 
 class StarPredictorBackend(ABC):
   @abstractmethod
-  def predict_from_tags(self, tags:list[str]) -> float:
+  def predict_from_tags(self, tags:list[str], awards:list[str]=()) -> float:
     pass
+
+  def predict_many(self, items:list[tuple[list[str],list[str]]]) -> np.ndarray:
+    """items: (tags, awards) of each file"""
+    return np.array([self.predict_from_tags(tags, awards) for tags, awards in items])
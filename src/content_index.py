@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import logging
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from tqdm import tqdm
+
+import helpers as hlp
+from db_managers import _fingerprint, _scan_fingerprints
+
+
+HEAD_BYTES = 64*1024
+CHUNK_BYTES = 1024*1024
+
+def _jpeg_ranges(f, size:int) -> list[tuple[int,int]]:
+  """everything but APPn and COM segments, where exif/iptc/xmp live"""
+  ranges, pos = [], 2
+  while pos+4 <= size:
+    f.seek(pos)
+    ff, kind, length = struct.unpack('>BBH', f.read(4))
+    if ff != 0xFF:
+      raise ValueError(f"bad jpeg marker at {pos}")
+    if kind == 0xDA:  # start of scan: entropy-coded data till the end
+      ranges.append((pos, size))
+      return ranges
+    if not (0xE0 <= kind <= 0xEF or kind == 0xFE):
+      ranges.append((pos, pos+2+length))
+    pos += 2+length
+  raise ValueError("no image data in jpeg")
+
+def _isobmff_ranges(f, size:int) -> list[tuple[int,int]]:
+  """only the media payload, the moov box with the metadata gets rewritten on edits"""
+  ranges, pos = [], 0
+  while pos+8 <= size:
+    f.seek(pos)
+    box_size, box_type = struct.unpack('>I4s', f.read(8))
+    if box_size == 1:
+      box_size = struct.unpack('>Q', f.read(8))[0]
+    elif box_size == 0:
+      box_size = size-pos
+    if box_size < 8:
+      raise ValueError(f"bad box size at {pos}")
+    if box_type == b'mdat':
+      ranges.append((pos, min(pos+box_size, size)))
+    pos += box_size
+  if not ranges:
+    raise ValueError("no mdat box")
+  return ranges
+
+PAYLOAD_PARSERS = {
+  'jpg': _jpeg_ranges, 'jpeg': _jpeg_ranges, 'jfif': _jpeg_ranges,
+  'mp4': _isobmff_ranges, 'mov': _isobmff_ranges,
+}
+
+def payload_ranges(fullname:str) -> list[tuple[int,int]]:
+  """
+  byte ranges of the media content: identical for copies of one file that
+  carry different metadata, so writing tags or ratings doesn't change the hash
+  """
+  size = os.path.getsize(fullname)
+  parser = PAYLOAD_PARSERS.get(hlp.file_extension(fullname))
+  if parser:
+    try:
+      with open(fullname, 'rb') as f:
+        return parser(f, size)
+    except (ValueError, struct.error) as ex:
+      logging.debug("hashing whole %s: %s", fullname, ex)
+  return [(0, size)]
+
+def _hash_ranges(fullname:str, ranges:list[tuple[int,int]], limit:int=None) -> str:
+  h = hashlib.blake2b(digest_size=16)
+  left = limit if limit is not None else float('inf')
+  with open(fullname, 'rb') as f:
+    for start, end in ranges:
+      f.seek(start)
+      todo = min(end-start, left)
+      left -= todo
+      while todo > 0:
+        chunk = f.read(min(CHUNK_BYTES, todo))
+        if not chunk:
+          break
+        h.update(chunk)
+        todo -= len(chunk)
+      if left <= 0:
+        break
+  return h.hexdigest()
+
+def content_key(fullname:str) -> tuple[int,str]:
+  """the cheap prefilter: payload size and a hash of its beginning"""
+  ranges = payload_ranges(fullname)
+  return sum(end-start for start, end in ranges), _hash_ranges(fullname, ranges, HEAD_BYTES)
+
+def content_digest(fullname:str) -> str:
+  return _hash_ranges(fullname, payload_ranges(fullname))
+
+
+class ContentIndex:
+  """
+  Finds exact duplicates of media content in a directory. Files are keyed by
+  (payload size, head hash) and full hashes are computed only for key
+  collisions; the index is kept in a csv and refreshed incrementally
+  """
+  FNAME = 'content_index.csv'
+  COLUMNS = ['size', 'mtime', 'payload_size', 'head', 'digest']
+  WORKERS = min(32, 4*(os.cpu_count() or 1))
+
+  def __init__(self, media_dir:str) -> None:
+    self.media_dir = media_dir
+    self.fname = os.path.join(media_dir, self.FNAME)
+    self.lock = threading.RLock()
+    if os.path.exists(self.fname):
+      self.df = pd.read_csv(self.fname, index_col='name', keep_default_na=False,
+                            dtype={'head': str, 'digest': str})
+    else:
+      self.df = pd.DataFrame(columns=self.COLUMNS).rename_axis('name')
+    self.refresh()
+
+  def refresh(self) -> None:
+    """(re)hash the heads of new and modified files, forget deleted ones"""
+    with self.lock:
+      fingerprints = _scan_fingerprints(self.media_dir)[['size', 'mtime']].astype(int)
+      known = self.df.reindex(fingerprints.index)
+      stale = (known['size'] != fingerprints['size']) | (known['mtime'] != fingerprints['mtime'])
+      fresh = self._compute(list(fingerprints.index[stale]), content_key, "hashing heads")
+      fresh = pd.DataFrame([(*fingerprints.loc[name], *key, "") for name, key in fresh.items()],
+                           columns=self.COLUMNS, index=pd.Index(list(fresh), name='name'))
+      self.df = pd.concat([self.df.loc[fingerprints.index[~stale]], fresh])
+      self._rebuild_lookup()
+      self.commit()
+
+  def _compute(self, names:list[str], func, desc:str) -> dict:
+    fullnames = [os.path.join(self.media_dir, name) for name in names]
+    with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+      # hashlib and file reads release the GIL
+      values = tqdm(pool.map(func, fullnames), total=len(names), desc=desc, disable=len(names)<100)
+      return dict(zip(names, values))
+
+  def _rebuild_lookup(self) -> None:
+    self.by_key:dict[tuple[int,str],set[str]] = {}
+    for name, payload_size, head in zip(self.df.index, self.df['payload_size'], self.df['head']):
+      self.by_key.setdefault((payload_size, head), set()).add(name)
+
+  def _digest_of(self, name:str) -> str:
+    if not self.df.at[name, 'digest']:
+      self.df.at[name, 'digest'] = content_digest(os.path.join(self.media_dir, name))
+    return self.df.at[name, 'digest']
+
+  def find(self, fullname:str) -> list[str]:
+    """short names of indexed files with the same content as `fullname`, which may be anywhere"""
+    key = content_key(fullname)
+    with self.lock:
+      candidates = []
+      for name in list(self.by_key.get(key, ())):
+        indexed = os.path.join(self.media_dir, name)
+        if not os.path.exists(indexed):  # deleted since the last refresh
+          self.remove(name)
+        elif not os.path.samefile(fullname, indexed):
+          candidates.append(name)
+      if not candidates:
+        return []
+      digest = content_digest(fullname)
+      found = []
+      for name in candidates:
+        try:
+          if self._digest_of(name) == digest:
+            found.append(name)
+        except FileNotFoundError:
+          self.remove(name)
+      return sorted(found)
+
+  def add(self, fullname:str) -> None:
+    """index a file that was just moved into media_dir"""
+    name = os.path.basename(fullname)
+    size, mtime, _ = _fingerprint(fullname)
+    payload_size, head = content_key(fullname)
+    with self.lock:
+      self.remove(name)
+      self.df.loc[name] = [size, mtime, payload_size, head, ""]
+      self.by_key.setdefault((payload_size, head), set()).add(name)
+
+  def remove(self, name:str) -> None:
+    with self.lock:
+      if name in self.df.index:
+        self.by_key[(self.df.at[name, 'payload_size'], self.df.at[name, 'head'])].discard(name)
+        self.df.drop(index=name, inplace=True)
+
+  def duplicates(self) -> list[list[str]]:
+    """groups of files with identical content, full hashes are computed in parallel for key collisions only"""
+    with self.lock:
+      colliding = [names for names in self.by_key.values() if len(names) > 1]
+      todo = [name for names in colliding for name in names if not self.df.at[name, 'digest']]
+      for name, digest in self._compute(todo, content_digest, "hashing candidates").items():
+        self.df.at[name, 'digest'] = digest
+      if todo:
+        self.commit()
+      groups = self.df.loc[[name for names in colliding for name in names]].groupby('digest').groups
+      return sorted(sorted(names) for names in groups.values() if len(names) > 1)
+
+  def commit(self) -> None:
+    with self.lock:
+      self.df.to_csv(self.fname)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="find files with identical content")
+  parser.add_argument('media_dir')
+  args = parser.parse_args()
+  for group in ContentIndex(args.media_dir).duplicates():
+    print(*group, sep='\n\t', end='\n\n')
@@ -1,10 +1,24 @@
+import csv
+import hashlib
+import json
 import logging
 import os
+import numpy as np
 import pandas as pd
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from typing import Callable
 
-from metadata import ManualMetadata, get_metadata, write_metadata
+from fs_watcher import DirWatcher, FsEvent, FsEventKind
+from metadata import SIDECAR_EXT, ManualMetadata, get_metadata, sidecar_name, write_metadata
 from prioritizers import make_prioritizer, PrioritizerType
+from tag_matrix import TagMatrix
+from write_behind import WriteBehind
+
+
+_REGEX_CHARS = set('.^$*+?{}[]\\|()')  # search words without them are plain substrings
 
 
 def stringify(iterable):
@@ -19,30 +33,172 @@ def _db_row(fname):
     'awards': stringify(meta.awards),
   }
 
-
-def _default_init(row, default_values_getter):
-  assert 0 <= row['stars'], row
-  if row.isna()['nmatches']:
-    row['nmatches'] = 0
-  if row.isna()['priority']:
-    row['priority'] = 0.8 if row['tags'] else 1
-  if row.isna()['awards']:
-    row['awards'] = ""
-  for column, value in default_values_getter(row['stars']).items():
-    if (column not in row) or pd.isnull(row[column]):
-      row[column] = value
-  return row
+FINGERPRINT_COLS = ['size', 'mtime', 'inode']
+
+def _is_media(fname:str):
+  return fname.find('.')>0 and not fname.endswith(('.csv', '.pkl', '.wal', SIDECAR_EXT))
+
+def _scan_fingerprints(img_dir:str) -> pd.DataFrame:
+  """a single pass over the directory entries, no file is opened.
+  A sidecar edit counts as a modification of its media file"""
+  rows, sidecar_mtimes = [], {}
+  with os.scandir(img_dir) as it:
+    for entry in it:
+      if entry.name.endswith(SIDECAR_EXT) and entry.is_file():
+        sidecar_mtimes[entry.name[:-len(SIDECAR_EXT)]] = entry.stat().st_mtime_ns
+      elif _is_media(entry.name) and entry.is_file():
+        st = entry.stat()
+        rows.append((entry.name, st.st_size, st.st_mtime_ns, st.st_ino))
+  rows = [(name, size, max(mtime, sidecar_mtimes.get(name, 0)), ino) for name, size, mtime, ino in rows]
+  return pd.DataFrame(rows, columns=['name']+FINGERPRINT_COLS).set_index('name').astype('Int64')
+
+def _fingerprint(fullname:str) -> list[int]:
+  st = os.stat(fullname)
+  sidecar = sidecar_name(fullname)
+  sidecar_mtime = os.stat(sidecar).st_mtime_ns if os.path.exists(sidecar) else 0
+  return [st.st_size, max(st.st_mtime_ns, sidecar_mtime), st.st_ino]
+
+def _scan_metadata(fnames:list[str], max_workers:int) -> pd.DataFrame:
+  # reading xmp is I/O bound (and slow on network mounts), libxmp releases the GIL in its C calls
+  with ThreadPoolExecutor(max_workers=max_workers) as pool:
+    rows = list(tqdm(pool.map(_db_row, fnames), total=len(fnames), desc="reading metadata"))
+  return pd.DataFrame(rows, columns=['name', 'tags', 'stars', 'awards']).set_index('name')
+
+
+def _fsync_dir(dirname:str) -> None:
+  if os.name == 'posix':  # makes a rename durable
+    fd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+def _write_atomically(df:pd.DataFrame, fname:str, **to_csv_kwargs) -> None:
+  """a crash leaves either the old or the new file, never a truncated one"""
+  tmp_name = os.path.join(os.path.dirname(fname), '.' + os.path.basename(fname) + '.tmp')
+  with open(tmp_name, 'w', encoding='utf-8', newline='') as f:
+    df.to_csv(f, **to_csv_kwargs)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_name, fname)
+  _fsync_dir(os.path.dirname(fname))
+
+def _is_complete_row(line:bytes, ncols:int) -> bool:
+  try:
+    fields = next(csv.reader([line.decode('utf-8')], strict=True))
+  except (UnicodeDecodeError, csv.Error, StopIteration):
+    return False
+  return len(fields) == ncols
+
+def _mend_tail(fname:str, ncols:int) -> None:
+  """an append cut short by a crash leaves a partial last line, it's dropped.
+  A complete last line only missing its newline (e.g. edited by hand) gets one"""
+  with open(fname, 'rb+') as f:
+    size = f.seek(0, os.SEEK_END)
+    f.seek(max(0, size-64*1024))
+    tail = f.read()
+    if not tail or tail.endswith(b'\n'):
+      return
+    if b'\n' not in tail:  # a very long last line
+      f.seek(0)
+      tail = f.read()
+    start = tail.rfind(b'\n') + 1
+    if _is_complete_row(tail[start:], ncols):
+      f.write(b'\n')
+    elif start:
+      keep = size - len(tail) + start
+      logging.warning("%s: dropping a partially written line: %s", fname, tail[start:])
+      f.truncate(keep)
+    else:
+      logging.warning("%s: the only line is incomplete, leaving it as it is", fname)
+
+
+class UpdateLog:
+  """
+  Rows updated since the last commit of the db, one json line each: the db
+  is committed rarely and still can be rebuilt after a crash.
+  Every line is flushed, a crash of the program loses none. The fsyncs are batched:
+  one when the last is SYNC_INTERVAL old, so a power loss takes at most that much of updates
+  """
+  SYNC_INTERVAL = 1.0  # seconds
+
+  def __init__(self, fname:str) -> None:
+    self.fname = fname
+    self.last_sync = -np.inf
+
+  def append(self, short_name:str, row:pd.Series) -> None:
+    entry = {'name': short_name, 'row': {col: None if pd.isna(v) else v.item() if isinstance(v, np.generic) else v
+                                         for col, v in row.items()}}
+    with open(self.fname, 'a', encoding='utf-8') as f:
+      f.write(json.dumps(entry) + '\n')
+      f.flush()
+      if time.monotonic()-self.last_sync >= self.SYNC_INTERVAL:
+        os.fsync(f.fileno())
+        self.last_sync = time.monotonic()
+
+  def read(self) -> dict[str,dict]:
+    """the latest row of every updated file"""
+    rows = {}
+    if not os.path.exists(self.fname):
+      return rows
+    with open(self.fname, encoding='utf-8') as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          logging.warning("%s: skipping a partially written line", self.fname)
+          continue
+        rows[entry['name']] = entry['row']
+    return rows
+
+  def clear(self) -> None:
+    if os.path.exists(self.fname):
+      os.remove(self.fname)
+
+
+def _default_columns(stars:pd.Series, default_values_getter) -> pd.DataFrame:
+  """defaults depend only on stars, which take few distinct values: one getter call per value"""
+  per_value = pd.DataFrame([default_values_getter(v) for v in stars.unique()], index=stars.unique())
+  return per_value.reindex(stars.to_numpy()).set_axis(stars.index)
+
+def _default_init(df:pd.DataFrame, default_values_getter) -> pd.DataFrame:
+  assert (df['stars'] >= 0).all(), df[df['stars'] < 0]
+  df = df.fillna({'nmatches': 0, 'awards': ""})
+  df['priority'] = df['priority'].fillna(pd.Series(np.where(df['tags'] != "", 0.8, 1), index=df.index))
+  rating_dtypes = {col: type(val) for col, val in default_values_getter(0).items()}
+  rating_cols = list(rating_dtypes)
+  df = df.reindex(columns=df.columns.union(rating_cols, sort=False))
+  incomplete = df[rating_cols].isna().any(axis=1)
+  if incomplete.any():
+    defaults = _default_columns(df.loc[incomplete, 'stars'], default_values_getter)
+    df.loc[incomplete, rating_cols] = df.loc[incomplete, rating_cols].fillna(defaults)
+  return df.astype(rating_dtypes)
 
 
 class MetadataManager:
+  SCAN_WORKERS = min(32, 4*(os.cpu_count() or 1))
+  COMMIT_EVERY = 500  # updates, the ones in between are in the update log
+
   def __init__(self, img_dir:str, refresh:bool=False,
                prioritizer_type:PrioritizerType=PrioritizerType.DEFAULT,
-               defaults_getter:Callable=None):
+               defaults_getter:Callable=None, watch:bool=False, similarity=None, writer:WriteBehind=None,
+               store=None):
+    """
+    similarity: a PerceptualIndex of img_dir, enables near-duplicate search and matchmaking
+    writer: if given, file writes and commits go through it instead of blocking the caller
+    store: a ProfileStore kept in sync with the db
+    """
     self.db_fname = os.path.join(img_dir, 'metadata_db.csv')
     self.initial_metadata_fname = os.path.join(img_dir, 'backup_initial_metadata.csv')
     self.media_dir = img_dir
     self.profile_updates_since_last_save = 0
+    self.version = 0  # moves on every change of the db, for caches derived from it
+    self.update_log = UpdateLog(os.path.join(img_dir, 'metadata_db.wal'))
     self.defaults_getter = defaults_getter
+    self.similarity = similarity
+    self.writer = writer
+    self.store = store
+    self.own_writes = queue.SimpleQueue()  # (short name, fingerprint) after the metadata writes of update()
     metadata_dtypes = {
       'name': str,
       'tags': str,
@@ -50,54 +206,164 @@ class MetadataManager:
       'nmatches': int,
       'priority': float,
       'awards': str,
-    }
+    } | {col: 'Int64' for col in FINGERPRINT_COLS}
     if os.path.exists(self.db_fname):
       logging.info(f"{self.db_fname} exists, read")
-      self.df = pd.read_csv(self.db_fname, keep_default_na=False)
+      self.df = pd.read_csv(self.db_fname, keep_default_na=False, na_values={col:'' for col in FINGERPRINT_COLS})
+      self.df = self.df.reindex(columns=self.df.columns.union(FINGERPRINT_COLS, sort=False))  # dbs made before fingerprints
     else:
       logging.info("metadata csv does not exist, create")
       self.df = pd.DataFrame(columns=metadata_dtypes.keys())
     self.df = self.df.astype(metadata_dtypes)
     self.df.set_index('name', inplace=True)
+    if self.defaults_getter and len(self.df):
+      self._add_missing_columns()
+    if os.path.exists(self.db_fname):
+      self._replay_update_log()
+    else:
+      self.update_log.clear()
 
     is_first_run = not os.path.exists(self.db_fname)
     if refresh or is_first_run:
       logging.info("refreshing metadata db...")
-      def is_media(fname:str):
-        return fname.find('.')>0 and not fname.endswith(('.csv', '.pkl'))
-      fnames = [os.path.join(img_dir, f) for f in os.listdir(img_dir) if is_media(f)]
-      fresh_tagrat = pd.DataFrame(_db_row(fname) for fname in fnames).set_index('name')
+      fingerprints = _scan_fingerprints(img_dir)
+      self._follow_renames(fingerprints)
+      known = self.df.reindex(fingerprints.index)
+      unchanged = (known[FINGERPRINT_COLS] == fingerprints).fillna(False).all(axis=1)
+      logging.info("%d files unchanged, %d new or modified", unchanged.sum(), (~unchanged).sum())
+      fnames = [os.path.join(img_dir, f) for f in fingerprints.index[~unchanged]]
+      fresh_tagrat = pd.concat([
+        known.loc[unchanged, ['tags', 'stars', 'awards']].astype({'stars': int}),  # as written on disk
+        _scan_metadata(fnames, self.SCAN_WORKERS),
+      ]).astype({'stars': float})
       if not os.path.exists(self.initial_metadata_fname):
         logging.info("creating metadata backup")
         fresh_tagrat.to_csv(self.initial_metadata_fname)
       original_dtypes = self.df.dtypes
-      joined = self.df.join(fresh_tagrat, how='right', lsuffix='_old')
-
-      def refresh_row(row):
-        if not row.isna()['stars_old']:
-          if int(row['stars']) == int(row['stars_old']):
-            row['stars'] = row['stars_old']
-        return row
+      joined = self.df.drop(columns=FINGERPRINT_COLS).join(fresh_tagrat, how='right', lsuffix='_old')
+      # manual stars on disk are whole, keep the finer rated value while its whole part still agrees
+      keep_old = joined['stars_old'].notna() & (np.floor(joined['stars']) == np.floor(joined['stars_old']))
+      joined['stars'] = np.where(keep_old, joined['stars_old'], joined['stars'])
       assert self.defaults_getter
-      self.df = joined.apply(refresh_row, axis=1)[self.df.columns]
-      self.df = self.df.apply(_default_init, axis=1, args=(self.defaults_getter,))
+      self.df = _default_init(joined[self.df.columns.drop(FINGERPRINT_COLS)], self.defaults_getter)
+      self.df[FINGERPRINT_COLS] = fingerprints
       self.df = self.df.astype(original_dtypes)
       self.df.sort_values('stars', ascending=False, inplace=True)
       self._commit()
 
     self.set_prioritizer(prioritizer_type)
 
+    self.fs_events = queue.SimpleQueue()
+    self.watcher = DirWatcher(img_dir, self.fs_events.put).start() if watch else None
+
+  def apply_fs_events(self) -> None:
+    """apply what the watcher has seen so far, on the caller's thread"""
+    events = []
+    while not self.fs_events.empty():
+      events += self.fs_events.get()
+    if not events:
+      return
+    changed = set()
+    for ev in events:
+      if ev.name.endswith(SIDECAR_EXT):
+        if self._sync_file(ev.name[:-len(SIDECAR_EXT)]):
+          changed.add(ev.name[:-len(SIDECAR_EXT)])
+        continue
+      if ev.kind == FsEventKind.DELETED:
+        if ev.name in self.df.index:
+          changed.add(ev.name)
+        self.df.drop(ev.name, inplace=True, errors='ignore')
+        continue
+      if ev.kind == FsEventKind.MOVED and ev.old_name in self.df.index:
+        logging.info("%s was renamed to %s", ev.old_name, ev.name)
+        # moved over an existing file: that one is gone, the moved file keeps its row
+        self.df.drop(ev.name, inplace=True, errors='ignore')
+        self.df.rename(index={ev.old_name:ev.name}, inplace=True)
+        changed |= {ev.old_name, ev.name}
+      if self._sync_file(ev.name):
+        changed.add(ev.name)
+    if not changed:
+      return  # e.g. the events of our own writes
+    if self.similarity is not None:
+      self.similarity.update(sorted(changed))
+    logging.info("applied %d filesystem events", len(events))
+    self.prioritizer.track(self.df)
+    self._reload_mirrors()
+    self._commit()
+
+  def _sync_file(self, short_name:str) -> bool:
+    """same as a refresh limited to one file, returns whether the db changed"""
+    fullname = os.path.join(self.media_dir, short_name)
+    if not _is_media(short_name) or not os.path.isfile(fullname):
+      return False
+    if self.writer and self.writer.is_pending(fullname):
+      return False  # the event of our own write, while a newer one is still queued: the db is ahead of the disk
+    self._take_own_writes()
+    fingerprint = _fingerprint(fullname)
+    if short_name in self.df.index and (self.df.loc[short_name, FINGERPRINT_COLS] == fingerprint).all():
+      return False
+    try:
+      fresh = _db_row(fullname)
+    except Exception as ex:
+      logging.warning("could not read metadata of %s: %s", short_name, ex)
+      return False
+    if short_name in self.df.index:
+      row = self.df.loc[short_name].copy()
+      if int(row['stars']) != fresh['stars']:
+        row['stars'] = fresh['stars']
+      row['tags'], row['awards'] = fresh['tags'], fresh['awards']
+    else:
+      logging.info("new file %s", short_name)
+      new = pd.DataFrame([fresh]).set_index('name').astype({'stars': float}).reindex(columns=self.df.columns)
+      row = _default_init(new, self.defaults_getter).iloc[0]
+    row[FINGERPRINT_COLS] = fingerprint
+    dtypes = self.df.dtypes
+    self.df.loc[short_name] = self.prioritizer.calc(row)
+    self.df = self.df.astype(dtypes)  # a new row is inserted as objects, upcasting the int columns
+    return True
+
+  def _take_own_writes(self) -> None:
+    """files as we wrote them are not external changes, their fs events shouldn't re-read them"""
+    while not self.own_writes.empty():
+      short_name, fingerprint = self.own_writes.get()
+      if short_name in self.df.index:
+        self.df.loc[short_name, FINGERPRINT_COLS] = fingerprint
+
+  def _follow_renames(self, fingerprints:pd.DataFrame) -> None:
+    """a file that vanished while a new one with the same inode appeared was renamed,
+    if it was also modified the size/mtime check will have it re-read under the new name"""
+    gone = self.df.loc[~self.df.index.isin(fingerprints.index), ['inode']].dropna()
+    appeared = fingerprints.loc[~fingerprints.index.isin(self.df.index), ['inode']]
+    if gone.empty or appeared.empty:
+      return
+    pairs = gone.reset_index().merge(appeared.reset_index(), on='inode', suffixes=('_old', '_new'))
+    pairs = pairs.drop_duplicates('name_old', keep=False).drop_duplicates('name_new', keep=False)
+    for old_shname, new_shname in zip(pairs['name_old'], pairs['name_new']):
+      logging.info("%s was renamed to %s", old_shname, new_shname)
+    self.df.rename(index=dict(zip(pairs['name_old'], pairs['name_new'])), inplace=True)
+
   def set_prioritizer(self, prioritizer_type) -> None:
     self.prioritizer = make_prioritizer(prioritizer_type)
     self.df = self.df.apply(self.prioritizer.calc, axis=1)
+    self.prioritizer.track(self.df)
+    self._reload_mirrors()
+
+  def _reload_mirrors(self) -> None:
+    """structures that mirror the db, after changes to more than single rows"""
+    self.version += 1
+    self.tag_matrix = TagMatrix(self.df['tags'])
+    if self.store is not None:
+      self.store.load(self.df)
 
-  def reset_meta_to_initial(self):
+  def reset_meta_to_initial(self, checkpoint:pd.DataFrame=None):
     assert self.defaults_getter
     df = pd.read_csv(self.initial_metadata_fname)
     for _, row in df.iterrows():
       fullname = os.path.join(self.media_dir, row['name'])
       if not os.path.exists(fullname):
         continue
+      if checkpoint is not None and row['name'] in checkpoint.index:
+        continue
       reset_data = {
         'tags': row['tags'],
         'stars': row['stars'],
@@ -107,14 +373,25 @@ class MetadataManager:
       reset_data |= self.defaults_getter(row['stars'])
       self.update(fullname, reset_data)
 
+    if checkpoint is not None:
+      self._restore_checkpoint(checkpoint)
+
+  def _restore_checkpoint(self, checkpoint:pd.DataFrame):
+    columns = [c for c in checkpoint.columns if c in self.df.columns]
+    for short_name, row in checkpoint[columns].iterrows():
+      fullname = os.path.join(self.media_dir, short_name)
+      if short_name not in self.df.index or not os.path.exists(fullname):
+        continue
+      if (self.df.loc[short_name, columns] == row).all():
+        continue  # most of the library is untouched by recent matches, spare the disk writes
+      self.update(fullname, row.to_dict())
+
   def get_db(self, min_tag_freq:int=0) -> pd.DataFrame:
     if min_tag_freq:
       freq_tags = self._get_frequent_tags(min_tag_freq)
       logging.debug("frequency of tags (threshold %d):\n%s", min_tag_freq, freq_tags)
       dfc = self.df.copy()
-      def remove_infrequent(s):
-        return ' '.join([tag for tag in s.split(' ') if tag in freq_tags])
-      dfc['tags'] = dfc['tags'].apply(remove_infrequent)
+      dfc['tags'] = self.tag_matrix.strings(keep=self.tag_matrix.mask(freq_tags.index))
       return dfc
 
     return self.df
@@ -123,13 +400,39 @@ class MetadataManager:
     return self.df.loc[short_name]
 
   def get_rand_files_info(self, n:int) -> pd.DataFrame:
-    return self.df.sample(n, weights='priority')
-
-  def get_search_results(self, query:str, n_per_page:int, page:int=1) -> pd.DataFrame:
+    sample = self.prioritizer.pick(self.df, n)
+    if self.similarity is None:
+      return sample
+    return self._without_near_duplicates(sample)
+
+  def _without_near_duplicates(self, sample:pd.DataFrame) -> pd.DataFrame:
+    """a match between two versions of one picture wastes the user's time"""
+    n = len(sample)
+    def fits(name:str) -> bool:
+      return not any(self.similarity.are_similar(name, other) for other in chosen)
+    chosen = []
+    for name in sample.index:
+      if fits(name):
+        chosen.append(name)
+    if len(chosen) == n:
+      return sample
+    rest = self.df.drop(index=sample.index)
+    for name in rest.sample(frac=1, weights=rest['priority']+1e-9).index:
+      if len(chosen) == n:
+        break
+      if fits(name):
+        chosen.append(name)
+    if len(chosen) < n:
+      logging.warning("not enough distinct files for a match of %d", n)
+      chosen += [name for name in sample.index if name not in chosen][:n-len(chosen)]
+    return self.df.loc[chosen]
+
+  def get_search_results(self, query:str, n_per_page:int, page:int=1, order=None) -> pd.DataFrame:
+    """order: names in the order results are paged through, the db's order by default"""
     query = query.strip()
-    hit_idx = 0
+    df = self.df if order is None else self.df.reindex(order)
     if query == "":
-      return self.df[n_per_page*(page-1):n_per_page*page]
+      return df[n_per_page*(page-1):n_per_page*page]
 
     def negpos(subquery:str) -> tuple:
       neg, pos = [], []
@@ -140,91 +443,175 @@ class MetadataManager:
           pos.append(word)
       return neg, pos
     subqueries = [negpos(sub) for sub in query.split('|')]
-    def is_match(row:pd.Series) -> bool:
-      nonlocal hit_idx
-      if hit_idx > n_per_page*page:
-        return False
-      row['name'] = row.name
-      strrow = row.astype(str).str
-      for neg_filters, pos_filters in subqueries:
-        pos = [strrow.contains(word).any() for word in pos_filters]
-        neg = [strrow.contains(word).any() for word in neg_filters]
-        if all(pos) and not any(neg):
-          hit_idx += 1
-          return n_per_page*(page-1) < hit_idx <= n_per_page*page
-      return False
-
-    return self.df[self.df.apply(is_match, axis=1)]
+    # ~name: files that look like name, the file itself included
+    lookalikes = {word: {word[1:]} | set(self.similarity.similar(word[1:]) if self.similarity else [])
+                  for neg, pos in subqueries for word in neg+pos if word.startswith('~')}
+    rows = self.tag_matrix.rows(df.index) if df.index.isin(self.tag_matrix.names).all() else None
+    strcols = [df.index.to_series(index=df.index).astype(str)] + [df[col].astype(str) for col in df.columns.drop('tags')]
+    found = {}
+    def has(word:str) -> np.ndarray:
+      if word in lookalikes:
+        return df.index.isin(lookalikes[word])
+      if word not in found:
+        hits = np.logical_or.reduce([col.str.contains(word).to_numpy() for col in strcols])
+        if rows is not None and _REGEX_CHARS.isdisjoint(word):
+          hits |= self.tag_matrix.has_any(self.tag_matrix.containing(word), rows)
+        else:  # a pattern may span tags, only the string has them in order
+          hits |= df['tags'].astype(str).str.contains(word).to_numpy()
+        found[word] = hits
+      return found[word]
+
+    is_match = np.zeros(len(df), dtype=bool)
+    for neg_filters, pos_filters in subqueries:
+      matches = np.ones(len(df), dtype=bool)
+      for word in pos_filters:
+        matches &= has(word)
+      for word in neg_filters:
+        matches &= ~has(word)
+      is_match |= matches
+    return df[is_match][n_per_page*(page-1):n_per_page*page]
 
   def update(self, fullname:str, upd_data:dict, matches_each:int=0) -> None:
     # TODO: to improve performance,
     # accept updates in bulk - in dataframes (from apply_opinions and reset_meta)
     logging.debug("DB update():\n%s\n%s\nmatches_each=%d\n", fullname, upd_data, matches_each)
     short_name = os.path.basename(fullname)
-    row = self.df.loc[short_name].copy()
+    # a dict until the prioritizer needs a Series: copying, updating and storing whole pandas rows is slow
+    values = self.df.loc[short_name].to_dict() if self.store is None else self.store.values(short_name)
 
     if 'stars' in upd_data:
       assert upd_data['stars'] >= 0, upd_data
 
     # updates in df
-    if upd_data:
-      row.update(upd_data)
-    row.loc['nmatches'] += matches_each
-    row = self.prioritizer.calc(row)
-    self.df.loc[short_name] = row
+    changed = [col for col, v in upd_data.items() if col in values and not pd.isna(v)]  # as Series.update() did
+    values.update({col: upd_data[col] for col in changed})
+    values['nmatches'] += matches_each
+    row = self.prioritizer.calc(pd.Series(values, name=short_name))
+    for col in changed + ['nmatches', 'priority']:
+      self.df.at[short_name, col] = row[col]
+    self.prioritizer.on_update(short_name, row)
+    self.version += 1
+    self.tag_matrix.set_row(short_name, row['tags'])
+    if self.store is not None:
+      self.store.set_row(short_name, row)
     logging.debug("updated db: %s", row)
+    if self.writer:
+      self.writer.submit("update log", self.update_log.append, short_name, row.copy())
+    else:
+      self.update_log.append(short_name, row)
 
     # updates on disk
-    # TODO: to improve performance,
-    # maybe queue all write_metadata calls (create a set of changed fullnames),
-    # and only do the disk write operations on _commit()
-    # in that case, be careful that the whole program uses the freshest info from the DF, and not disk
     new_disk_meta = ManualMetadata.from_str(row['tags'], int(row['stars']), row['awards'])
-    write_metadata(fullname, new_disk_meta)
+    if self.writer:
+      self.writer.submit(f"metadata of {short_name}", self._write_file, fullname, new_disk_meta, key=fullname)
+    else:
+      self._write_file(fullname, new_disk_meta)
 
     self.profile_updates_since_last_save += 1
-    if self.profile_updates_since_last_save > 20:
+    if self.profile_updates_since_last_save >= self.COMMIT_EVERY:
       self._commit()
-      self.profile_updates_since_last_save = 0
+
+  def _write_file(self, fullname:str, meta:ManualMetadata) -> None:
+    write_metadata(fullname, meta)
+    self.own_writes.put((os.path.basename(fullname), _fingerprint(fullname)))
+
+  def update_many(self, upd:pd.DataFrame) -> None:
+    """bulk update of columns that live only in the db, one commit for all rows"""
+    assert not set(upd.columns) & {'tags', 'stars', 'awards'}, "those are written to the files one by one in update()"
+    logging.info("DB update_many(): %d rows, columns %s", len(upd), list(upd.columns))
+    for col in upd.columns:
+      self.df.loc[upd.index, col] = upd[col]
+    self._reload_mirrors()
+    self._commit()
 
   def rename(self, old_shname:str, new_shname:str) -> None:
     if old_shname not in self.df.index:
       raise KeyError(old_shname)
     if new_shname == old_shname:
       return
+    if self.writer:
+      self.writer.drain()
     old_fullname = os.path.join(self.media_dir, old_shname)
     new_fullname = os.path.join(self.media_dir, new_shname)
     assert os.path.exists(old_fullname)
     assert not os.path.exists(new_fullname)
     os.rename(old_fullname, new_fullname)
+    if os.path.exists(sidecar_name(old_fullname)):
+      os.rename(sidecar_name(old_fullname), sidecar_name(new_fullname))
     self.df.rename(index={old_shname:new_shname}, inplace=True)
+    if self.similarity is not None:
+      self.similarity.update([old_shname, new_shname])
+    self.prioritizer.track(self.df)
+    self._reload_mirrors()
     self._commit()
 
   def delete(self, shname:str) -> None:
     self.df.drop(shname, inplace=True)
+    self.prioritizer.track(self.df)
+    self._reload_mirrors()
     self._commit()
 
   def on_exit(self):
+    if self.watcher:
+      self.watcher.stop()
+      self.apply_fs_events()
     self._commit()
 
+  def _add_missing_columns(self):
+    """e.g. a rating system was added since the db was created"""
+    missing = [col for col in self.defaults_getter(0) if col not in self.df.columns]
+    if not missing:
+      return
+    logging.info("adding missing columns %s", missing)
+    defaults = _default_columns(self.df['stars'], self.defaults_getter)
+    for col in missing:
+      self.df[col] = defaults[col]
+    self.df = self.df.astype({col: type(val) for col, val in self.defaults_getter(0).items()})
+
   def _get_frequent_tags(self, min_tag_freq):
-    lists = self.df['tags'].str.split(' ')
-    tag_freq = pd.concat([pd.Series(l) for l in lists], ignore_index=True).value_counts()
+    tag_freq = self.tag_matrix.counts().sort_values(ascending=False, kind='stable')
     return tag_freq[tag_freq>=min_tag_freq]
 
+  def _replay_update_log(self) -> None:
+    rows = {name: row for name, row in self.update_log.read().items() if name in self.df.index}
+    if not rows:
+      self.update_log.clear()
+      return
+    logging.info("restoring %d rows updated after the last commit", len(rows))
+    upd = pd.DataFrame.from_dict(rows, orient='index')
+    dtypes = self.df.dtypes
+    for col in upd.columns.intersection(self.df.columns):
+      self.df.loc[upd.index, col] = upd[col]
+    self.df = self.df.astype(dtypes)
+    self._commit()
+
   def _commit(self):
     logging.info("commit db to disk")
-    self.df.to_csv(self.db_fname)
+    self._take_own_writes()
+    if self.writer:
+      self.writer.submit("metadata db", self._write_db, self.df.copy())
+    else:
+      self._write_db(self.df)
+    self.profile_updates_since_last_save = 0
+
+  def _write_db(self, df:pd.DataFrame) -> None:
+    _write_atomically(df, self.db_fname)
+    self.update_log.clear()  # only now, a crash in between replays the log over the new db harmlessly
 
 
 class HistoryManager:
-  def __init__(self, img_dir:str, history_fname:str):
+  def __init__(self, img_dir:str, history_fname:str, writer:WriteBehind=None):
+    self.writer = writer
     self.matches_fname = os.path.join(img_dir, history_fname)
+    self.checkpoints_dir = os.path.join(img_dir, os.path.splitext(history_fname)[0]+'_checkpoints')
+    self.checkpoints_index_fname = os.path.join(self.checkpoints_dir, 'index.csv')
     match_history_dtypes = {
       "timestamp": float,
       "names": str,
       "outcome": str,
     }
+    if os.path.exists(self.matches_fname):
+      _mend_tail(self.matches_fname, len(match_history_dtypes))
     if os.path.exists(self.matches_fname):
       logging.info("match_history csv exists, read")
       self.matches_df = pd.read_csv(self.matches_fname, dtype=match_history_dtypes)
@@ -235,7 +622,68 @@ class HistoryManager:
 
   def save_match(self, timestamp:float, names:list[str], outcome:str) -> None:
     self.matches_df.loc[len(self.matches_df)] = [timestamp, names, outcome]
-    self.matches_df.to_csv(self.matches_fname, index=False)
+    row = self.matches_df.iloc[[-1]]
+    if self.writer:
+      self.writer.submit("match history", self._append, row)
+    else:
+      self._append(row)
+
+  def _append(self, rows:pd.DataFrame) -> None:
+    header = not os.path.exists(self.matches_fname)
+    with open(self.matches_fname, 'a', encoding='utf-8', newline='') as f:
+      rows.to_csv(f, header=header, index=False)
+      f.flush()
+      os.fsync(f.fileno())
 
   def get_match_history(self):
     return self.matches_df
+
+  def save_checkpoint(self, offset:int, state:pd.DataFrame) -> None:
+    """store rating state after the first `offset` matches of history"""
+    assert 0 < offset <= len(self.matches_df)
+    os.makedirs(self.checkpoints_dir, exist_ok=True)
+    _write_atomically(state.drop(columns=['priority']+FINGERPRINT_COLS, errors='ignore'), self._checkpoint_fname(offset))
+    index = self._read_checkpoints_index()
+    index = index[index['offset'] != offset]
+    index.loc[len(index)] = [offset, self._prefix_digests()[offset]]
+    _write_atomically(index, self.checkpoints_index_fname, index=False)
+    logging.info("saved checkpoint at match %d", offset)
+
+  def get_checkpoint(self) -> tuple[int, pd.DataFrame]:
+    """latest checkpoint consistent with current history, or (0, None)"""
+    index = self._read_checkpoints_index()
+    if index.empty:
+      return 0, None
+    digests = self._prefix_digests()
+    is_valid = [offset < len(digests) and digests[offset] == digest
+                for offset, digest in zip(index['offset'], index['digest'])]
+    if not all(is_valid):
+      dropped = index.loc[[not v for v in is_valid], 'offset']
+      index = index.loc[is_valid]
+      _write_atomically(index, self.checkpoints_index_fname, index=False)  # before the files it no longer lists go
+      for offset in dropped:
+        logging.info("history changed before match %d, dropping its checkpoint", offset)
+        os.remove(self._checkpoint_fname(offset))
+    if index.empty:
+      return 0, None
+    offset = int(index['offset'].max())
+    state = pd.read_csv(self._checkpoint_fname(offset), index_col='name',
+                        dtype={'tags':str, 'awards':str}, keep_default_na=False)
+    return offset, state
+
+  def _checkpoint_fname(self, offset:int) -> str:
+    return os.path.join(self.checkpoints_dir, f"{offset}.csv")
+
+  def _read_checkpoints_index(self) -> pd.DataFrame:
+    if os.path.exists(self.checkpoints_index_fname):
+      return pd.read_csv(self.checkpoints_index_fname, dtype={'offset':int, 'digest':str})
+    return pd.DataFrame({'offset':pd.Series(dtype=int), 'digest':pd.Series(dtype=str)})
+
+  def _prefix_digests(self) -> list[str]:
+    """digests[i] identifies the first i matches, so any edit invalidates all later checkpoints"""
+    h = hashlib.sha1()
+    digests = [h.hexdigest()]
+    for timestamp, names, outcome in self.matches_df.itertuples(index=False):
+      h.update(f"{float(timestamp)!r};{names};{outcome}\n".encode())
+      digests.append(h.hexdigest())
+    return digests
@@ -11,24 +11,40 @@ from metadata import ManualMetadata, get_metadata, write_metadata
 
 
 class MockListener(UserListener):
+  def __init__(self, assistant:Assistant, suggested_tags:list=None) -> None:
+    self.assistant = assistant
+    self.suggested_tags = suggested_tags
+    self.written = None
+
   def consume_result(self, *args, **kwargs): pass
   def give_boost(self, *args, **kwargs): pass
   def start_next_match(self): pass
   def search_for(self, *args, **kwargs): pass
   def suggest_tags(self, fullname: str) -> list:
-    return Assistant().suggest_tags(fullname)
+    if self.suggested_tags is not None:
+      return self.suggested_tags
+    return self.assistant.suggest_tags_nowait(fullname)
+  def suggestions_status(self) -> str:
+    return self.assistant.status()
   def update_meta(self, fullname:str, meta:ManualMetadata) -> None:
     print("update_meta: ", fullname, meta)
     write_metadata(fullname, meta)
+    self.written = meta
 
 class DownGui:
-  def __init__(self) -> None:
+  def __init__(self, assistant:Assistant=None) -> None:
     self.root = tk.Tk()
     self.root.withdraw()
+    self.assistant = assistant or Assistant()
 
-  def show_editor(self, fullname:str):
-    meditor = MetaEditor(self.root, MockListener())
-    existing_meta = get_metadata(fullname)
+  def show_editor(self, fullname:str, suggested_tags:list=None, existing_meta:ManualMetadata=None) -> ManualMetadata:
+    """
+    suggested_tags, existing_meta: if known already, saves work on opening
+    returns the metadata the user saved, None if nothing was saved
+    """
+    listener = MockListener(self.assistant, suggested_tags)
+    meditor = MetaEditor(self.root, listener)
+    existing_meta = existing_meta or get_metadata(fullname) or ManualMetadata()
     prof = ProfileInfo(
       fullname=fullname,
       tags=' '.join(existing_meta.tags),
@@ -43,6 +59,7 @@ class DownGui:
         self.root.quit()
     window.bind('<Destroy>', on_destroy)
     window.mainloop()
+    return listener.written
 
 
 if __name__ == "__main__":
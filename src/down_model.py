@@ -1,25 +1,39 @@
+import heapq
 import os
+import queue
 import shutil
+import subprocess
 import logging
+import threading
 import time
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from send2trash import send2trash
 
 import helpers as hlp
+from ai_assistant import Assistant
+from content_index import ContentIndex
 from down_gui import DownGui
-from metadata import can_write_metadata, get_metadata, has_metadata
+from fs_watcher import DirWatcher, FsEventKind
+from metadata import (ManualMetadata, MetadataIO, SidecarPolicy, can_write_metadata, get_metadata,
+                      set_sidecar_policy, sidecar_name)
 
 
 class Converter:
-  def __init__(self) -> None:
+  def __init__(self, max_workers:int=None) -> None:
+    # ffmpeg is multithreaded itself, leave room for it
+    self.pool = ThreadPoolExecutor(max_workers=max_workers or max(1, (os.cpu_count() or 2)//2))
+    self.jobs:dict[str,Future] = {}  # the main and the producer threads both start and join conversions
+    self.lock = threading.Lock()
     self.acceptable_ext = ["jpg", "jpeg", "mp4", "jfif", "mov"]
     FFVIDOPTS = " -movflags faststart -pix_fmt yuv420p -vf scale='trunc(iw/2)*2:trunc(ih/2)*2' -loglevel warning "
     self.conversion_map = {
-      "png":  [("jpg", lambda fin,fout: f"mogrify -format jpg '{fin}'")],
+      "png":  [("jpg", lambda fin,fout: f"magick '{fin}' '{fout}'")],
       "heic": [("jpg", lambda fin,fout: f"heif-convert -q 100 '{fin}' '{fout}'")],
       "webp": [("jpg", lambda fin,fout: f"ffmpeg -loglevel error -i '{fin}' '{fout}'"),
-               ("mp4", lambda fin,fout: f"magick '{fin}' '{fin}.gif' && ffmpeg -i '{fin}.gif' {FFVIDOPTS} '{fout}' && rm '{fin}.gif'"),
-               ("mp4", lambda fin,fout: f"mkdir tmpcnv; dur=$(webpinfo '{fin}' | grep -oP '(?<=Duration: )[0-9]+' | tail -n1); magick '{fin}' tmpcnv/frames.png && ffmpeg ${{dur:+-framerate 1000/$((dur>100?100:dur))}} -i tmpcnv/frames-%0d.png -c:v libx264 {FFVIDOPTS} '{fout}'; rm -r tmpcnv"),  # Note: magick produces artifacts extracting frames. Consider switching to anim_dump
+               ("mp4", lambda fin,fout: f"magick '{fin}' '{fout}.gif' && ffmpeg -i '{fout}.gif' {FFVIDOPTS} '{fout}' && rm '{fout}.gif'"),
+               ("mp4", lambda fin,fout: f"mkdir '{fout}.frames'; dur=$(webpinfo '{fin}' | grep -oP '(?<=Duration: )[0-9]+' | tail -n1); magick '{fin}' '{fout}.frames/frames.png' && ffmpeg ${{dur:+-framerate 1000/$((dur>100?100:dur))}} -i '{fout}.frames/frames-%0d.png' -c:v libx264 {FFVIDOPTS} '{fout}'; rm -r '{fout}.frames'"),  # Note: magick produces artifacts extracting frames. Consider switching to anim_dump
               ],
       "webm": [("mp4", lambda fin,fout: f"ffmpeg -fflags +genpts -i '{fin}' {FFVIDOPTS} -r 24 '{fout}'")],
       "gif":  [("mp4", lambda fin,fout: f"ffmpeg -i '{fin}' {FFVIDOPTS} '{fout}'")],
@@ -31,9 +45,34 @@ class Converter:
   def can_convert(self, fname:str) -> bool:
     return hlp.file_extension(fname) in self.conversion_map
 
+  def outputs(self, fullname:str) -> list[str]:
+    """the names a conversion of `fullname` may produce"""
+    root = os.path.splitext(fullname)[0]
+    return sorted({f"{root}.{out_ext}" for out_ext, _ in self.conversion_map.get(hlp.file_extension(fullname), [])})
+
   def convert(self, fullname:str, keep_original:bool=True) -> str:
-    assert os.path.exists(fullname)
-    assert self.can_convert(fullname)
+    """blocks until the conversion, maybe started earlier by convert_async, is done"""
+    future = self.convert_async(fullname, keep_original)
+    try:
+      return future.result()
+    finally:
+      with self.lock:
+        self.jobs.pop(fullname, None)
+
+  def convert_async(self, fullname:str, keep_original:bool=True) -> Future:
+    with self.lock:
+      if fullname not in self.jobs:
+        assert os.path.exists(fullname)
+        assert self.can_convert(fullname)
+        self.jobs[fullname] = self.pool.submit(self._convert_job, fullname, keep_original)
+      return self.jobs[fullname]
+
+  def is_converting(self, fullname:str) -> bool:
+    """started and not joined by convert() yet, the original may be gone already"""
+    with self.lock:
+      return fullname in self.jobs
+
+  def _convert_job(self, fullname:str, keep_original:bool) -> str:
     converted_name = self._convert_impl(fullname)
     if not keep_original:
       send2trash(fullname)
@@ -41,30 +80,33 @@ class Converter:
 
   def _convert_impl(self, fullname):
     for out_ext, get_conv_cmd in self.conversion_map[hlp.file_extension(fullname)]:
-      converted_name = f"{os.path.splitext(fullname)[0]}.{out_ext}"
+      root = os.path.splitext(fullname)[0]
+      converted_name = f"{root}.{out_ext}"
       assert not os.path.exists(converted_name)
-      conv_cmd = get_conv_cmd(fullname, converted_name)
+      # hidden until complete, so nobody watching the folder picks up a half-written file
+      tmp_name = os.path.join(os.path.dirname(root), f".{os.path.basename(root)}.converting.{out_ext}")
+      conv_cmd = get_conv_cmd(fullname, tmp_name)
       self._exec(conv_cmd, fullname)
-      if not os.path.exists(converted_name):
+      if not os.path.exists(tmp_name):
         logging.warning("Could not convert %s to .%s", os.path.basename(fullname), out_ext)
         continue
-      if not can_write_metadata(converted_name):
+      if not can_write_metadata(tmp_name):
         logging.warning("Bad conversion: metadata not writable")
-        send2trash(converted_name)
+        send2trash(tmp_name)
         continue
+      os.rename(tmp_name, converted_name)
       return converted_name
     raise RuntimeError(f"Could not convert file {fullname}")
 
   def _exec(self, cmd:str, fullname:str) -> None:
     assert os.path.exists(fullname)
-    tmp_wd = os.path.dirname(fullname)
-    global_wd = os.getcwd()
-    if global_wd != tmp_wd:
-      os.chdir(tmp_wd)
-    logging.info("executing command:\n\t%s\n\tworking_dir=%s", cmd, os.getcwd())
-    os.system(cmd)
-    if global_wd != tmp_wd:
-      os.chdir(global_wd)
+    cwd = os.path.dirname(fullname)
+    logging.info("executing command:\n\t%s\n\tworking_dir=%s", cmd, cwd)
+    res = subprocess.run(cmd, shell=True, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if res.returncode:
+      logging.warning("command exited with %d:\n%s", res.returncode, res.stderr)
+    elif res.stderr:
+      logging.info("command stderr:\n%s", res.stderr)
 
 
 @dataclass
@@ -72,6 +114,7 @@ class UsherCfg:
   buffer_dir: str
   uncateg_dir: str
   dest_dir: str
+  sidecar_policy: SidecarPolicy = field(default_factory=SidecarPolicy)
 
   def __post_init__(self) -> None:
     assert os.path.exists(self.buffer_dir)
@@ -79,58 +122,220 @@ class UsherCfg:
     assert os.path.exists(self.dest_dir)
 
 
+@dataclass
+class Prepared:
+  fullname: str
+  suggested_tags: list
+  meta: ManualMetadata = None  # as found on disk
+
+  def has_metadata(self) -> bool:
+    return bool(self.meta and self.meta.tags)
+
+
 class Usher:
+  PARTIAL_DOWNLOADS = ['crdownload', 'part']
+  LOOKAHEAD = 3
+  SETTLE = 1.0  # seconds a new file must keep its size and mtime, it may still be downloading
+
   def __init__(self, cfg:UsherCfg, catch_up_n:int) -> None:
     self.cfg = cfg
     self.catch_up_n = catch_up_n
-    self.gui = DownGui()
+    set_sidecar_policy(cfg.sidecar_policy)
+    self.assistant = Assistant()
+    self.gui = DownGui(self.assistant)
+    self.assistant.preload()
     self.converter = Converter()
+    self.content_index = ContentIndex(cfg.dest_dir)
+    self.pending = []  # heap of (-mtime, fullname), newest first
+    # buffer files that are queued, being handled or about to be created by Usher:
+    # they are never queued twice, and events about them are Usher's own doing
+    self.owned:set[str] = set()
+    self.owned_lock = threading.Lock()
+    self.fs_events = queue.SimpleQueue()
+    # one producer thread: it's the only user of the tags model, the gui stays on the main thread.
+    # The main thread owns the files in `pending`, the producer the ones it was handed
+    self.producer = ThreadPoolExecutor(max_workers=1)
+    # Prepared and the names the file went by, in the order they'll be shown
+    self.ahead:deque[tuple[Future,list[str]]] = deque()
 
   def idle(self) -> None:
-    last_mtime = None
-    while True:
-      if last_mtime == os.stat(self.cfg.buffer_dir).st_mtime:
-        time.sleep(2)
-      else:
+    watcher = DirWatcher(self.cfg.buffer_dir, self.fs_events.put, debounce=0.05).start()
+    for f in os.listdir(self.cfg.buffer_dir):
+      self._enqueue(f)
+    try:
+      while True:
         self.process_recent_files(1 + self.catch_up_n)
-        last_mtime = os.stat(self.cfg.buffer_dir).st_mtime
         print("\n"*16)
         print(f"Buffer still has {len(os.listdir(self.cfg.buffer_dir))} items.")
+        self._wait_for_files()
+    finally:
+      watcher.stop()
+
+  def _wait_for_files(self) -> int:
+    """
+    blocks until a new download is queued, returns how many were.
+    Events about the files Usher moves, renames or writes itself don't count
+    """
+    settling:dict[str,tuple] = {}  # name -> (size, mtime), since when they hold
+    queued = 0
+    while not queued:
+      try:
+        events = self.fs_events.get(timeout=self.SETTLE/2 if settling else None)
+      except queue.Empty:
+        events = []
+      for ev in events:
+        if (ev.kind != FsEventKind.DELETED and self._is_download(ev.name)
+            and not self._is_owned(os.path.join(self.cfg.buffer_dir, ev.name))):
+          settling.setdefault(ev.name, (None, 0))
+      now = time.monotonic()
+      for name, (seen, since) in list(settling.items()):
+        try:
+          st = os.stat(os.path.join(self.cfg.buffer_dir, name))
+        except FileNotFoundError:
+          del settling[name]
+          continue
+        if (st.st_size, st.st_mtime_ns) != seen:
+          settling[name] = ((st.st_size, st.st_mtime_ns), now)
+        elif now-since >= self.SETTLE:
+          del settling[name]
+          queued += self._enqueue(name)
+    return queued
+
+  def _is_download(self, short_name:str) -> bool:
+    """a finished download either appears under its final name or is renamed to it from a partial"""
+    return not short_name.startswith('.') and hlp.file_extension(short_name) not in self.PARTIAL_DOWNLOADS + ['xmp']
+
+  def _enqueue(self, short_name:str) -> bool:
+    fullname = os.path.join(self.cfg.buffer_dir, short_name)
+    if (not self._is_download(short_name) or not os.path.isfile(fullname) or self._is_owned(fullname)
+        or self._is_duplicate(fullname)):
+      return False
+    with self.owned_lock:
+      self.owned.add(fullname)
+    heapq.heappush(self.pending, (-os.path.getmtime(fullname), fullname))
+    return True
+
+  def _is_owned(self, fullname:str) -> bool:
+    with self.owned_lock:
+      return fullname in self.owned
+
+  def _own(self, names:list[str], fullnames:list[str]) -> None:
+    """claims the names Usher is about to give the file that went by `names`"""
+    with self.owned_lock:
+      self.owned.update(fullnames)
+    names += fullnames
+
+  def _release(self, names:list[str]) -> None:
+    """names that are gone from the buffer; files left there stay claimed, they have been shown already"""
+    with self.owned_lock:
+      self.owned.difference_update(f for f in names if not os.path.exists(f))
 
   def process_recent_files(self, n_interactive:int) -> None:
-    buffer_files = []
-    for f in os.listdir(self.cfg.buffer_dir):
-      fullname = os.path.join(self.cfg.buffer_dir, f)
-      if not os.path.isfile(fullname) or hlp.file_extension(fullname) in ['crdownload', 'part']:
-        continue
-      buffer_files.append(fullname)
-    for fullname in sorted(buffer_files, key=os.path.getmtime, reverse=True):
-      if n_interactive == 0:
-        break
-      n_interactive -= self.process_file(fullname)
+    self._convert_backlog()
+    self._fill_pipeline()
+    while self.ahead and n_interactive > 0:
+      future, names = self.ahead.popleft()
+      self._fill_pipeline()
+      try:
+        prepared = future.result()
+      except Exception:
+        logging.exception("Could not prepare a file")
+        prepared = None
+      try:
+        if prepared is not None and os.path.isfile(prepared.fullname):
+          n_interactive -= self._process_prepared(prepared, names)
+      finally:
+        self._release(names)
       logging.info("Processing done.\n\n")
 
-  def process_file(self, fullname) -> bool:
-    logging.info("process_file '%s'", fullname)
-    was_interactive = False
+  def _fill_pipeline(self) -> None:
+    while self.pending and len(self.ahead) < self.LOOKAHEAD:
+      _, fullname = heapq.heappop(self.pending)
+      if not os.path.isfile(fullname) and not self.converter.is_converting(fullname):
+        self._release([fullname])
+        continue  # gone
+      names = [fullname]
+      self.ahead.append((self.producer.submit(self._prepare, fullname, names), names))
+
+  def _convert_backlog(self) -> None:
+    """conversions don't need the user, let them run in the background while the editor is open"""
+    for i, (key, fullname) in enumerate(self.pending):
+      if (os.path.isfile(fullname) and self.converter.needs_conversion(fullname)
+          and self.converter.can_convert(fullname) and not self.converter.is_converting(fullname)):
+        names = [fullname]
+        try:
+          fullname = self._robust_rename(fullname, names)
+          self._own(names, self.converter.outputs(fullname))  # released with the names _prepare() collects
+          self.converter.convert_async(fullname, keep_original=False)
+        except OSError as ex:
+          logging.warning("Could not start converting '%s': %s", fullname, ex)
+        self.pending[i] = (key, fullname)
+        self._release(names[:1])
+    heapq.heapify(self.pending)
+
+  def _is_duplicate(self, fullname:str) -> bool:
+    duplicates = self.content_index.find(fullname)
+    if duplicates:
+      logging.warning("'%s' is already in '%s' as %s, moving it to trash", fullname, self.cfg.dest_dir, duplicates)
+      send2trash(fullname)
+    return bool(duplicates)
 
+  def _robust_rename(self, fullname:str, names:list[str]) -> str:
     robust_name = hlp.better_fname(os.path.basename(fullname))
     robust_name = os.path.join(os.path.dirname(fullname), robust_name)
     if robust_name != fullname:
       assert not os.path.exists(robust_name)
       logging.info("Renaming:\n  %s\n  %s", fullname, robust_name)
+      self._own(names, [robust_name])
       os.rename(fullname, robust_name)
-      fullname = robust_name
+    return robust_name
+
+  def process_file(self, fullname) -> bool:
+    names = [fullname]
+    try:
+      prepared = self._prepare(fullname, names)
+      return prepared is not None and self._process_prepared(prepared, names)
+    finally:
+      self._release(names)
+
+  def _prepare(self, fullname:str, names:list[str]) -> Prepared|None:
+    """the part that doesn't need the user, runs ahead of the editor. `names` collects the names the file goes by"""
+    logging.info("preparing '%s'", fullname)
+    fullname = self._robust_rename(fullname, names)
 
     if self.converter.needs_conversion(fullname):
       logging.info("Converting...")
+      self._own(names, self.converter.outputs(fullname))
       try:
         fullname = self.converter.convert(fullname, keep_original=False)
       except Exception as ex:
         logging.warning("Could not convert '%s', exception: %s", fullname, ex)
         logging.warning("Moving file to '%s'", self.cfg.uncateg_dir)
         shutil.move(fullname, self.cfg.uncateg_dir)
-        return False
+        return None
+      if self._is_duplicate(fullname):
+        return None
+
+    with MetadataIO(fullname, 'w') as mio:
+      writable, meta = mio.can_write(), mio.read()
+    if not writable:
+      logging.error("Metadata not writable %s, sending to %s", fullname, self.cfg.uncateg_dir)
+      shutil.move(fullname, self.cfg.uncateg_dir)
+      return None
+
+    prepared = Prepared(fullname, [], meta)
+    if not prepared.has_metadata():
+      try:
+        prepared.suggested_tags = self.assistant.suggest_tags(fullname)
+      except Exception as ex:
+        logging.warning("Could not suggest tags for '%s': %s", fullname, ex)
+        prepared.suggested_tags = None  # the editor will try again
+    return prepared
+
+  def _process_prepared(self, prepared:Prepared, names:list[str]) -> bool:
+    fullname = prepared.fullname
+    logging.info("process_file '%s'", fullname)
+    was_interactive = False
 
     conflict_fname = os.path.join(self.cfg.dest_dir, os.path.basename(fullname))
     if os.path.exists(conflict_fname):
@@ -145,23 +350,23 @@ class Usher:
         elif usr_input in ["n", "no"]:
           logging.info("Ok, we'll just rename the file and continue")
           new_fullname = '_contend'.join(os.path.splitext(fullname))
+          self._own(names, [new_fullname])
           os.rename(fullname, new_fullname)
-          return self.process_file(new_fullname)
-
-    if not can_write_metadata(fullname):
-      logging.error("Metadata not writable %s, sending to %s", fullname, self.cfg.uncateg_dir)
-      shutil.move(fullname, self.cfg.uncateg_dir)
-      return False
+          return self._process_prepared(Prepared(new_fullname, prepared.suggested_tags, prepared.meta), names)
 
-    if not has_metadata(fullname):
-      self.gui.show_editor(fullname)
+    if not prepared.has_metadata():
+      written = self.gui.show_editor(fullname, prepared.suggested_tags, prepared.meta)
+      prepared = Prepared(fullname, prepared.suggested_tags, written or prepared.meta)
       was_interactive = True
     else:
-      logging.info("File already has metadata:\n\t%s", get_metadata(fullname))
+      logging.info("File already has metadata:\n\t%s", prepared.meta)
 
-    if has_metadata(fullname):
+    if prepared.has_metadata():
       logging.info("Moving file to '%s'", self.cfg.dest_dir)
-      shutil.move(fullname, self.cfg.dest_dir)
+      if os.path.exists(sidecar_name(fullname)):
+        shutil.move(sidecar_name(fullname), self.cfg.dest_dir)  # first, so the file arrives with its metadata
+      self.content_index.add(shutil.move(fullname, self.cfg.dest_dir))
+      self.content_index.commit()
     else:
       logging.warning("At the end, still no metadata in %s", fullname)
 
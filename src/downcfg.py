@@ -1,7 +1,10 @@
 from down_model import UsherCfg
+from metadata import SidecarPolicy
 
 USHER_CFG = UsherCfg(
   buffer_dir  = "",
   uncateg_dir = "",
   dest_dir    = "",
+  # e.g. SidecarPolicy(extensions=('mp4', 'mov'), min_size=50*2**20) to keep their metadata in .xmp files
+  # sidecar_policy = SidecarPolicy(),
 )
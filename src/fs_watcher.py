@@ -0,0 +1,195 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable
+
+
+class FsEventKind(Enum):
+  CREATED = "created"
+  MODIFIED = "modified"
+  MOVED = "moved"
+  DELETED = "deleted"
+
+
+@dataclass
+class FsEvent:
+  kind: FsEventKind
+  name: str
+  old_name: str = None  # only for MOVED
+
+
+def coalesce(events:list[FsEvent]) -> list[FsEvent]:
+  """squash a burst of events into at most one event per file, in order of appearance"""
+  out:dict[str,FsEvent] = {}
+  for ev in events:
+    if ev.kind == FsEventKind.MOVED:
+      prev = out.pop(ev.old_name, None)
+      out.pop(ev.name, None)
+      if prev is None or prev.kind == FsEventKind.MODIFIED:
+        out[ev.name] = ev
+      elif prev.kind == FsEventKind.CREATED:
+        out[ev.name] = FsEvent(FsEventKind.CREATED, ev.name)
+      elif prev.kind == FsEventKind.MOVED:
+        out[ev.name] = FsEvent(FsEventKind.MOVED, ev.name, prev.old_name)
+      continue
+
+    prev = out.pop(ev.name, None)
+    if ev.kind == FsEventKind.DELETED:
+      if prev is None or prev.kind in (FsEventKind.MODIFIED, FsEventKind.DELETED):
+        out[ev.name] = ev
+      elif prev.kind == FsEventKind.MOVED:
+        out[prev.old_name] = FsEvent(FsEventKind.DELETED, prev.old_name)
+      # created and deleted within one burst: nothing happened
+    elif ev.kind == FsEventKind.CREATED:
+      replaced = prev is not None and prev.kind == FsEventKind.DELETED
+      out[ev.name] = FsEvent(FsEventKind.MODIFIED, ev.name) if replaced else ev
+    else:
+      out[ev.name] = prev if prev is not None and prev.kind != FsEventKind.DELETED else ev
+  return list(out.values())
+
+
+class _Inotify:
+  IN_MODIFY      = 0x00000002
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM  = 0x00000040
+  IN_MOVED_TO    = 0x00000080
+  IN_CREATE      = 0x00000100
+  IN_DELETE      = 0x00000200
+  IN_ISDIR       = 0x40000000
+  IN_NONBLOCK    = 0o4000
+  IN_CLOEXEC     = 0o2000000
+  HEADER = struct.Struct('iIII')
+
+  def __init__(self, dirname:str):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+    if libc.inotify_add_watch(self.fd, os.fsencode(dirname), mask) < 0:
+      err = ctypes.get_errno()
+      os.close(self.fd)
+      raise OSError(err, f"inotify_add_watch failed for {dirname}")
+
+  def read(self, timeout:float) -> list[FsEvent]:
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+    data = os.read(self.fd, 64*1024)
+    events, moved_from = [], {}
+    pos = 0
+    while pos < len(data):
+      _, mask, cookie, length = self.HEADER.unpack_from(data, pos)
+      pos += self.HEADER.size
+      name = os.fsdecode(data[pos:pos+length].rstrip(b'\0'))
+      pos += length
+      if mask & self.IN_ISDIR:
+        continue
+      if mask & self.IN_MOVED_FROM:
+        moved_from[cookie] = name
+        events.append(FsEvent(FsEventKind.DELETED, name))  # moved out, unless the pair arrives below
+      elif mask & self.IN_MOVED_TO:
+        if cookie in moved_from:
+          old_name = moved_from.pop(cookie)
+          events.remove(FsEvent(FsEventKind.DELETED, old_name))
+          events.append(FsEvent(FsEventKind.MOVED, name, old_name))
+        else:
+          events.append(FsEvent(FsEventKind.CREATED, name))
+      elif mask & self.IN_CREATE:
+        events.append(FsEvent(FsEventKind.CREATED, name))
+      elif mask & self.IN_CLOSE_WRITE:
+        events.append(FsEvent(FsEventKind.MODIFIED, name))
+      elif mask & self.IN_DELETE:
+        events.append(FsEvent(FsEventKind.DELETED, name))
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+
+class _Polling:
+  """fallback: compare a listing of the directory with the previous one, a single scandir per poll"""
+  def __init__(self, dirname:str, interval:float):
+    self.dirname = dirname
+    self.interval = interval
+    self.snapshot = self._scan()
+
+  def _scan(self) -> dict[str,tuple]:
+    with os.scandir(self.dirname) as it:
+      return {e.name: (st.st_ino, st.st_size, st.st_mtime_ns)
+              for e in it if e.is_file() and (st := e.stat())}
+
+  def read(self, timeout:float) -> list[FsEvent]:
+    time.sleep(min(timeout, self.interval))
+    # not only when the directory mtime moves: in-place edits don't touch it
+    old, self.snapshot = self.snapshot, self._scan()
+    gone = {old[name][0]: name for name in old.keys() - self.snapshot.keys()}
+    events = []
+    for name, fingerprint in self.snapshot.items():
+      if name not in old:
+        if fingerprint[0] in gone:
+          events.append(FsEvent(FsEventKind.MOVED, name, gone.pop(fingerprint[0])))
+        else:
+          events.append(FsEvent(FsEventKind.CREATED, name))
+      elif old[name] != fingerprint:
+        events.append(FsEvent(FsEventKind.MODIFIED, name))
+    events += [FsEvent(FsEventKind.DELETED, name) for name in gone.values()]
+    return events
+
+  def close(self):
+    pass
+
+
+class DirWatcher:
+  """
+  Watches the files of one directory (not recursive) from a daemon thread.
+  Bursts of events are debounced and coalesced, then handed to `on_events` -
+  it is called from the watcher thread, so it should only queue the work
+  """
+  def __init__(self, dirname:str, on_events:Callable[[list[FsEvent]],None],
+               debounce:float=0.5, poll_interval:float=2.0, force_polling:bool=False):
+    self.dirname = dirname
+    self.on_events = on_events
+    self.debounce = debounce
+    self.backend = None
+    if not force_polling:
+      try:
+        self.backend = _Inotify(dirname)
+      except (OSError, AttributeError) as ex:
+        logging.warning("inotify unavailable (%s), watching %s by polling", ex, dirname)
+    if self.backend is None:
+      self.backend = _Polling(dirname, poll_interval)
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self._run, name=f"watcher {dirname}", daemon=True)
+
+  def start(self) -> "DirWatcher":
+    self.thread.start()
+    return self
+
+  def stop(self) -> None:
+    self.stop_event.set()
+    self.thread.join()
+    self.backend.close()
+
+  def _run(self):
+    pending, last_event_time = [], 0
+    while not self.stop_event.is_set():
+      events = self.backend.read(timeout=self.debounce if pending else 1.0)
+      now = time.monotonic()
+      if events:
+        pending += events
+        last_event_time = now
+      elif pending and now-last_event_time >= self.debounce:
+        batch, pending = coalesce(pending), []
+        logging.debug("%s: %s", self.dirname, batch)
+        if batch:
+          try:
+            self.on_events(batch)
+          except Exception:
+            logging.exception("watcher callback failed")
@@ -82,6 +82,7 @@ def spice_up_color(
 
 CHANGE_MATCH_DELAY = 100
 ACC_TAG_THRESH = 0.47
+SUGG_POLL_MS = 200  # how often the editor checks if suggestions are ready
 
 BTFL_DARK_BG = "#222"
 BTFL_DARK_GRANOLA = "#D6B85A"
@@ -5,6 +5,7 @@ import os
 
 from gui.guicfg import *
 from ae_rater_types import Outcome, ProfileInfo
+from profile_store import Profiles
 import helpers as hlp
 
 class Leaderboard(tk.Text):
@@ -33,13 +34,14 @@ class Leaderboard(tk.Text):
 
     for i, featured in enumerate(feature):
       letter = Outcome.idx_to_let(i)
-      rank = next(j for j,p in enumerate(leaderboard) if p.fullname==featured.fullname)
+      rank = self._rank(leaderboard, featured.fullname)
       for j in range(max(0,rank-context), min(len(leaderboard),rank+context+1)):
         displayed_rows.setdefault(j, "")
       displayed_rows[rank] = letter
 
     self.tag_configure('total_matches', foreground=BTFL_LIGHT_GRAY, justify="center", spacing3=10)
-    self.insert(tk.END, f"total matches: {sum([p.nmatches for p in leaderboard])//2}\n", 'total_matches')
+    total = leaderboard.total_matches() if isinstance(leaderboard, Profiles) else sum(p.nmatches for p in leaderboard)
+    self.insert(tk.END, f"total matches: {total//2}\n", 'total_matches')
     prev = -1
     for i in sorted(displayed_rows.keys()):
       if i-prev != 1:
@@ -50,6 +52,12 @@ class Leaderboard(tk.Text):
 
     self.configure(state=tk.DISABLED)
 
+  @staticmethod
+  def _rank(leaderboard, fullname:str) -> int:
+    if isinstance(leaderboard, Profiles):  # without building every profile
+      return leaderboard.rank_of(fullname)
+    return next(j for j,p in enumerate(leaderboard) if p.fullname==fullname)
+
   def _write_profile(self, idx:int, prof:ProfileInfo, letter:str):
     cfg = self._get_line_visual_cfg(letter)
 
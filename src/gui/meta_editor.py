@@ -144,16 +144,30 @@ class TagEditor(ttk.Frame):
     self.states = {tag:tk.IntVar(self, int(self._should_be_set(tag))) for tag in sorted(VOCAB)}
 
     for tag in self.states:
-      stylename = "IHateTkinter.TCheckbutton"
-      prob = next((p for t,p in self.suggested_tags if t==tag), None)
-      if prob:
-        stylename = f"sugg{int(prob*30)}." + stylename
-        self.style.configure(stylename, background=f"#3{3+int(prob*10):x}3")
       self.chk_btns[tag] = ttk.Checkbutton(master, text=indent_hierarchical(tag, 6),
                                            command=self._check_parent_as_well, variable=self.states[tag],
-                                           style=stylename)
+                                           style=self._suggestion_style(tag))
       self.chk_btns[tag].pack(expand=True, fill=tk.X, padx=20)
 
+  def _suggestion_style(self, tag) -> str:
+    stylename = "IHateTkinter.TCheckbutton"
+    prob = next((p for t,p in self.suggested_tags if t==tag), None)
+    if prob:
+      stylename = f"sugg{int(prob*30)}." + stylename
+      self.style.configure(stylename, background=f"#3{3+int(prob*10):x}3")
+    return stylename
+
+  def set_suggestions(self, suggested_tags):
+    """suggestions that came after the window was opened"""
+    self.suggested_tags = suggested_tags
+    for tag, chk_btn in self.chk_btns.items():
+      chk_btn.configure(style=self._suggestion_style(tag))
+      if self._should_be_set(tag):
+        self.states[tag].set(1)
+    if self.autocomplete.hits:
+      self.autocomplete.highlight(self.autocomplete.hits[0])
+    self._check_parent_as_well()
+
   def _should_be_set(self, tag):
     prob = next((p for t,p in self.suggested_tags if t==tag), 0)
     return (tag in self.curr_prof.tags) or (self.curr_prof.tags=="" and prob > ACC_TAG_THRESH)
@@ -212,6 +226,7 @@ class MetaEditor:
     self.win = None
     self.tag_editor:TagEditor = None
     self.job_id = ""
+    self.sugg_job_id = ""
 
   def set_curr_profile(self, prof:ProfileInfo):
     self.curr_prof = prof
@@ -221,14 +236,30 @@ class MetaEditor:
 
   def open(self, event) -> tk.Toplevel:
     assert self.curr_prof
-    try:
-      suggested_tags = self.user_listener.suggest_tags(self.curr_prof.fullname)
-    except:
-      suggested_tags = []
+    suggested_tags = self._ask_suggestions()
     self._create_window(suggested_tags)
     assert self.win
+    if suggested_tags is None:
+      self.sugg_job_id = self.win.after(SUGG_POLL_MS, self._poll_suggestions)
     return self.win
 
+  def _ask_suggestions(self):
+    """None while they are computed, the window doesn't wait for them"""
+    try:
+      return self.user_listener.suggest_tags(self.curr_prof.fullname)
+    except:
+      return []
+
+  def _poll_suggestions(self):
+    suggested_tags = self._ask_suggestions()
+    if suggested_tags is None:
+      self._display_suggestions(None, self.sugg_panel)  # e.g. the model is loaded now, computing
+      self.sugg_job_id = self.win.after(SUGG_POLL_MS, self._poll_suggestions)
+      return
+    self.sugg_job_id = ""
+    self._display_suggestions(suggested_tags, self.sugg_panel)
+    self.tag_editor.set_suggestions(suggested_tags)
+
   def _create_window(self, suggested_tags):
     self.win = tk.Toplevel(self.master)
     self.win.protocol("WM_DELETE_WINDOW", self._cleanup)
@@ -238,19 +269,19 @@ class MetaEditor:
     self._configure_style()
 
     self.media_panel = MediaFrame(self.win)
-    self.tag_editor = TagEditor(self.curr_prof, suggested_tags,
+    self.tag_editor = TagEditor(self.curr_prof, suggested_tags or [],
                                 self._on_commit_pressed, self.style, self.win)
-    sugg_panel = tk.Text(self.win, padx=0, pady=10, bd=0, cursor="arrow", spacing1=8,
-                          foreground=BTFL_LIGHT_GRAY, background=BTFL_DARK_BG,
-                          font=tk.font.Font(family='courier 10 pitch', size=9))
-    self._display_suggestions(suggested_tags, sugg_panel)
+    self.sugg_panel = tk.Text(self.win, padx=0, pady=10, bd=0, cursor="arrow", spacing1=8,
+                              foreground=BTFL_LIGHT_GRAY, background=BTFL_DARK_BG,
+                              font=tk.font.Font(family='courier 10 pitch', size=9))
+    self._display_suggestions(suggested_tags, self.sugg_panel)
 
     LW, MW = .5, .22
     RW = 1 - (LW + MW)
 
     self.media_panel.place(relwidth=LW, relheight=1)
     self.tag_editor.place(relwidth=MW, relheight=1, relx=LW)
-    sugg_panel.place(relwidth=RW, relheight=1, relx=LW+MW)
+    self.sugg_panel.place(relwidth=RW, relheight=1, relx=LW+MW)
     self.win.update()
     self.tag_editor.create_children()
     self.media_panel.show_media(self.curr_prof.fullname)
@@ -265,6 +296,9 @@ class MetaEditor:
     sugg_panel.delete("1.0", tk.END)
     sugg_panel.tag_configure('heading', justify="center")
     sugg_panel.insert(tk.END, "SUGGESTED TAGS:\n", 'heading')
+    if suggested_tags is None:
+      sugg_panel.insert(tk.END, "\n"+self.user_listener.suggestions_status(), 'heading')
+      suggested_tags = []
     for tag, prob in suggested_tags:
       sugg_panel.tag_configure('acc_line', foreground="#383")
       sugg_panel.insert(tk.END, f"\n{tag:>20} {prob*100:>5.2f} {'#'*int(prob*30)}", 'acc_line' if prob>ACC_TAG_THRESH else '')
@@ -290,5 +324,8 @@ class MetaEditor:
     if self.job_id:
       self.win.after_cancel(self.job_id)
       self.job_id = ""
+    if self.sugg_job_id:
+      self.win.after_cancel(self.sugg_job_id)
+      self.sugg_job_id = ""
     self.tag_editor.cleanup()
     self.win.destroy()
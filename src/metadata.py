@@ -1,10 +1,44 @@
 import logging
+import os
 from dataclasses import dataclass, field
-from libxmp import XMPFiles, consts, XMPError
+from libxmp import XMPFiles, XMPMeta, consts, XMPError
 
 from tags_vocab import VOCAB, SPECIAL_AWARDS
 
 
+VOCAB_SET = frozenset(VOCAB)
+
+def build_leaf_index(vocab:list[str]) -> dict[str,list[str]]:
+  """leaf -> the full tags ending with it, in vocab order; full tags map to themselves"""
+  index = {}
+  for tag in vocab:
+    index.setdefault(tag.rsplit('|', maxsplit=1)[-1], []).append(tag)
+    if '|' in tag:
+      index[tag] = [tag]
+  return index
+
+LEAF_INDEX = build_leaf_index(VOCAB)
+
+def resolve_leaf_tags(leaves:list[str], leaf_index:dict[str,list[str]]=LEAF_INDEX) -> list[str]:
+  """
+  dc:subject keeps only the last part of hierarchical tags. A leaf shared by
+  several tags resolves to the first whose parents are among the leaves too
+  (they are written along), unknown leaves are kept as they are
+  """
+  present = set(leaves)
+  tags = []
+  for leaf in leaves:
+    candidates = leaf_index.get(leaf)
+    if not candidates:
+      logging.warning("tag '%s' is not in the vocabulary", leaf)
+      tags.append(leaf)
+      continue
+    if len(candidates) > 1:
+      candidates = [c for c in candidates if all(p in present for p in c.split('|')[:-1])] or candidates
+    tags.append(candidates[0])
+  return tags
+
+
 @dataclass
 class ManualMetadata:
   tags : set[str] = field(default_factory=set)
@@ -21,13 +55,13 @@ class ManualMetadata:
       err.append(f"negative stars: {self.stars}")
     if not self.tags:
       err.append("empty tags")
-    if (bad_tags := [t for t in self.tags if t not in VOCAB]):
+    if (bad_tags := [t for t in self.tags if t not in VOCAB_SET]):
       err.append(f"tags not in vocab: {bad_tags}")
     if (orphan_tags := [t for t in self.tags if '|' in t and t.rsplit('|',maxsplit=1)[0] not in self.tags]):
       err.append(f"orphan tags: {orphan_tags}")
     if (bad_awards := [a for a in self.awards
-                       if a.startswith("e_") and a[2:] not in VOCAB
-                       or a.startswith("wow_") and a[4:] not in VOCAB
+                       if a.startswith("e_") and a[2:] not in VOCAB_SET
+                       or a.startswith("wow_") and a[4:] not in VOCAB_SET
                        or a.isdigit()]):
       err.append(f"bad exemplary awards: {bad_awards}")
     return err
@@ -59,27 +93,137 @@ def write_metadata(fullname:str, metadata:ManualMetadata) -> None:
 
 
 
+SIDECAR_EXT = '.xmp'
+
+def sidecar_name(fullname:str) -> str:
+  return fullname + SIDECAR_EXT
+
+
+@dataclass
+class SidecarPolicy:
+  """which files get their metadata in a `<file>.xmp` next to them, so big files aren't rewritten on every change"""
+  extensions: tuple[str] = ()
+  min_size: int = None  # bytes
+
+  def wants_sidecar(self, fullname:str) -> bool:
+    return (os.path.splitext(fullname)[1][1:].lower() in self.extensions
+            or self.min_size is not None and os.path.getsize(fullname) >= self.min_size)
+
+# a file with a sidecar keeps it regardless of the policy, the policy decides for the rest
+SIDECAR_POLICY = SidecarPolicy()
+
+def set_sidecar_policy(policy:SidecarPolicy) -> None:
+  global SIDECAR_POLICY
+  SIDECAR_POLICY = policy
+
+def move_to_sidecar(fullname:str) -> None:
+  """the embedded xmp is left as it is, the sidecar takes precedence from now on"""
+  if os.path.exists(sidecar_name(fullname)):
+    return
+  with MetadataIO(fullname, 'w', sidecar=True) as mio:
+    mio._save()
+
+def embed_sidecar(fullname:str) -> None:
+  sidecar = sidecar_name(fullname)
+  if not os.path.exists(sidecar):
+    return
+  with MetadataIO(fullname, 'w', sidecar=False) as mio:
+    with open(sidecar, encoding='utf-8') as f:
+      mio.xmp = XMPMeta(xmp_str=f.read())
+    if not mio.xmpfile.can_put_xmp(mio.xmp):
+      raise RuntimeError(f"can't embed metadata into {fullname}")
+    mio._save()
+  os.remove(sidecar)
+
+
+XMP_SCAN_BYTES = 256*1024
+
+def find_xmp_packet(fullname:str) -> bytes:
+  """the serialized xmp, looked up where the format handlers put it: near the start or the end of the file"""
+  size = os.path.getsize(fullname)
+  with open(fullname, 'rb') as f:
+    for start in sorted({0, max(0, size-XMP_SCAN_BYTES)}):
+      f.seek(start)
+      data = f.read(XMP_SCAN_BYTES)
+      begin = data.find(b'<?xpacket begin')
+      if begin < 0:
+        continue
+      trailer = data.find(b'<?xpacket end', begin)
+      end = data.find(b'?>', trailer) if trailer >= 0 else -1
+      return data[begin:end+2] if end >= 0 else None  # cut off by the chunk border, let the SDK find it
+  return None
+
+
 class MetadataIO:
+  """
+  One open of the file per session: the parsed xmp is kept for all the calls.
+  A sidecar, if there is one, is read instead of the file. Otherwise read-only
+  sessions parse the raw packet and skip the SDK's format handlers,
+  unless the packet is not where find_xmp_packet looks
+  sidecar: write to a sidecar, by default if one exists or SIDECAR_POLICY wants it
+  """
   PROP_TAGS_HIERARCHICAL = (consts.XMP_NS_Lightroom, "hierarchicalSubject")
   PROP_TAGS_BACKUP = (consts.XMP_NS_DC, "subject")
   PROP_STARS = (consts.XMP_NS_XMP, "Rating")
   PROP_AWARDS = (consts.XMP_NS_XMP, "Label")
 
-  def __init__(self, fullname:str, mode:str) -> None:
+  def __init__(self, fullname:str, mode:str, sidecar:bool=None) -> None:
     self.fullname = fullname
     self.mode = mode
+    self.sidecar = sidecar_name(fullname)
+    if sidecar is None:
+      sidecar = os.path.exists(self.sidecar) or 'w' in mode and SIDECAR_POLICY.wants_sidecar(fullname)
+    self.in_sidecar = sidecar
     self.xmpfile = None
     self.xmp = None
+    self.loaded = False
+    self.writable = None
 
   def __enter__(self):
-    self.xmpfile = XMPFiles(file_path=self.fullname, open_forupdate='w' in self.mode)
-    self.xmp = self.xmpfile.get_xmp()
+    if 'w' in self.mode:
+      self._load()
     return self
 
   def __exit__(self, exc_type, exc_value, exc_traceback):
-    self.xmpfile.close_file()
+    if self.xmpfile:
+      self.xmpfile.close_file()
+
+  def _load(self) -> None:
+    if self.loaded:
+      return
+    self.loaded = True
+    if 'w' in self.mode and not self.in_sidecar:
+      self._open(for_update=True)
+    elif os.path.exists(self.sidecar):
+      with open(self.sidecar, encoding='utf-8') as f:
+        self.xmp = XMPMeta(xmp_str=f.read())
+    elif self.in_sidecar:
+      # the first write into a sidecar starts from what is embedded
+      self._open(for_update=False)
+      self.xmpfile.close_file()
+      self.xmpfile = None
+      if self.xmp is None:
+        self.xmp = XMPMeta()
+    elif not self._parse_packet():
+      self._open(for_update=False)
+
+  def _open(self, for_update:bool) -> None:
+    self.xmpfile = XMPFiles(file_path=self.fullname, open_forupdate=for_update)
+    self.xmp = self.xmpfile.get_xmp()
+
+  def _parse_packet(self) -> bool:
+    packet = find_xmp_packet(self.fullname)
+    if packet is None:
+      return False
+    try:
+      self.xmp = XMPMeta(xmp_str=packet.decode('utf-8'))
+    except Exception as ex:
+      logging.debug("could not parse the xmp packet of %s, falling back to XMPFiles: %s", self.fullname, ex)
+      return False
+    return True
 
   def read(self) -> ManualMetadata:
+    self._load()
     if self.xmp is None:
       return None
     return ManualMetadata.from_str(self._read_tags(), self._read_stars(), self._read_awards())
@@ -95,13 +239,13 @@ class MetadataIO:
     n = self.xmp.count_array_items(*tag_prop)
     if n==0:
       logging.warning("ZERO tags in %s", self.fullname)
-    return ' '.join([self._read_one_tag(i, tag_prop) for i in range(n)])
+    tags = [self._read_one_tag(i, tag_prop) for i in range(n)]
+    if tag_prop == self.PROP_TAGS_BACKUP:
+      tags = resolve_leaf_tags(tags)
+    return ' '.join(tags)
 
   def _read_one_tag(self, i, propname):
-    tag = self.xmp.get_array_item(*propname, i+1)
-    if propname==self.PROP_TAGS_BACKUP:
-      return next(voc_tag for voc_tag in VOCAB if voc_tag.endswith(tag))
-    return tag
+    return self.xmp.get_array_item(*propname, i+1)
 
   def _read_stars(self) -> int:
     if not self.xmp.does_property_exist(*self.PROP_STARS):
@@ -114,7 +258,12 @@ class MetadataIO:
     return self.xmp.get_property(*self.PROP_AWARDS)
 
   def can_write(self) -> bool:
-    return bool(self.xmp) and self.xmpfile.can_put_xmp(self.xmp)
+    if self.writable is None:
+      if self.in_sidecar:
+        self.writable = os.access(os.path.dirname(os.path.abspath(self.fullname)), os.W_OK)
+      else:
+        self.writable = bool(self.xmp) and self.xmpfile.can_put_xmp(self.xmp)
+    return self.writable
 
   def write(self, meta) -> None:
     tag_prop = self.PROP_TAGS_HIERARCHICAL
@@ -133,7 +282,17 @@ class MetadataIO:
     self.xmp.set_property_int(*self.PROP_STARS, meta.stars)
     self.xmp.set_property(*self.PROP_AWARDS, ' '.join(meta.awards))
 
-    self.xmpfile.put_xmp(self.xmp)
+    self._save()
+
+  def _save(self) -> None:
+    if not self.in_sidecar:
+      self.xmpfile.put_xmp(self.xmp)
+      return
+    # hidden while being written, so directory watchers only see the finished sidecar
+    tmp_name = os.path.join(os.path.dirname(self.sidecar), '.' + os.path.basename(self.sidecar) + '.tmp')
+    with open(tmp_name, 'w', encoding='utf-8') as f:
+      f.write(self.xmp.serialize_to_str(omit_packet_wrapper=True))
+    os.replace(tmp_name, self.sidecar)
 
   def _register_namespace(self, namespace:str) -> str:
     try:
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import imageio
+import numpy as np
+import pandas as pd
+from PIL import Image
+from tqdm import tqdm
+
+import helpers as hlp
+from content_index import ContentIndex, content_key
+from db_managers import _write_atomically
+
+
+HASH_SIZE = 8  # 64-bit hashes
+VIDEO_EXTENSIONS = ['mp4', 'mov', 'webm']
+VIDEO_SAMPLES = [.1, .3, .5, .7, .9]
+
+def dhash(img:Image.Image) -> int:
+  """difference hash: the sign of horizontal gradients of a tiny grayscale thumbnail"""
+  small = img.convert('L').resize((HASH_SIZE+1, HASH_SIZE), Image.Resampling.BOX)
+  px = np.asarray(small, dtype=np.int16)
+  return int.from_bytes(np.packbits(px[:, 1:] > px[:, :-1]).tobytes(), 'big')
+
+def _image_hashes(fullname:str) -> list[int]:
+  with Image.open(fullname) as img:
+    img.draft('L', (8*HASH_SIZE, 8*HASH_SIZE))  # jpegs decode straight to a small size
+    return [dhash(img)]
+
+def _video_hashes(fullname:str) -> list[int]:
+  reader = imageio.get_reader(fullname)
+  try:
+    meta = reader.get_meta_data()
+    nframes = int(meta['fps']*meta['duration'])
+    hashes = []
+    for frac in VIDEO_SAMPLES:
+      h = dhash(Image.fromarray(reader.get_data(min(int(frac*nframes), nframes-1))))
+      if h and h not in hashes:  # a flat frame, like a fade to black, says nothing
+        hashes.append(h)
+    return hashes
+  finally:
+    reader.close()
+
+def perceptual_hashes(fullname:str) -> list[int]:
+  """one hash for an image, a few sampled frames for a video; empty if the file can't be decoded"""
+  try:
+    if hlp.file_extension(fullname) in VIDEO_EXTENSIONS:
+      return _video_hashes(fullname)
+    return _image_hashes(fullname)
+  except Exception as ex:
+    logging.warning("could not hash %s: %s", fullname, ex)
+    return []
+
+def hamming(a:int, b:int) -> int:
+  return (a^b).bit_count()
+
+
+class BKTree:
+  """metric tree for hamming-radius queries, visits only subtrees that can hold matches"""
+  def __init__(self) -> None:
+    self.root = None  # node: (hash, items, {distance: child})
+
+  def add(self, h:int, item) -> None:
+    if self.root is None:
+      self.root = (h, [item], {})
+      return
+    node = self.root
+    while True:
+      d = hamming(h, node[0])
+      if d == 0:
+        node[1].append(item)
+        return
+      if d not in node[2]:
+        node[2][d] = (h, [item], {})
+        return
+      node = node[2][d]
+
+  def find(self, h:int, radius:int) -> list[tuple[int,object]]:
+    """(distance, item) for all items within radius"""
+    found, todo = [], [self.root] if self.root else []
+    while todo:
+      node = todo.pop()
+      d = hamming(h, node[0])
+      if d <= radius:
+        found += [(d, item) for item in node[1]]
+      todo += [child for dist, child in node[2].items() if d-radius <= dist <= d+radius]
+    return found
+
+
+class PerceptualIndex:
+  """
+  Near-duplicate lookup: files whose perceptual hashes are within NEAR_DISTANCE bits.
+  Kept in a csv next to the metadata db; files are re-hashed only when their
+  media content changes - as the content index sees it, so metadata writes don't count.
+  background: refresh() and update() return at once and hash on a thread,
+  lookups meanwhile see the index as it was
+  """
+  FNAME = 'perceptual_index.csv'
+  NEAR_DISTANCE = 8
+  WORKERS = min(32, 4*(os.cpu_count() or 1))
+
+  def __init__(self, media_dir:str, refresh:bool=True, background:bool=False) -> None:
+    self.media_dir = media_dir
+    self.fname = os.path.join(media_dir, self.FNAME)
+    self.background = background
+    self.lock = threading.Lock()  # one refresh or update at a time
+    if os.path.exists(self.fname):
+      self.df = pd.read_csv(self.fname, index_col='name', keep_default_na=False, dtype={'head': str, 'hashes': str})
+    else:
+      self.df = pd.DataFrame(columns=['payload_size', 'head', 'hashes']).rename_axis('name')
+    self._build_tree()
+    if refresh or not os.path.exists(self.fname):
+      self.refresh()
+
+  def _run(self, func, *args) -> None:
+    def locked():
+      with self.lock:
+        func(*args)
+    if not self.background:
+      return locked()
+    def logged():
+      try:
+        locked()
+      except Exception:
+        logging.exception("perceptual index: %s failed", func.__name__)
+    threading.Thread(target=logged, name="perceptual-index", daemon=True).start()
+
+  def refresh(self) -> None:
+    """(re)hash new and modified files of the whole dir, forget deleted ones"""
+    self._run(self._refresh)
+
+  def update(self, names:list[str]) -> None:
+    """the same for a few files, e.g. the ones a watcher saw change"""
+    if names:
+      self._run(self._update, list(names))
+
+  def _refresh(self) -> None:
+    content = ContentIndex(self.media_dir).df[['payload_size', 'head']]
+    self._merge(content, gone=self.df.index.difference(content.index))
+
+  def _update(self, names:list[str]) -> None:
+    keys, gone = {}, []
+    for name in names:
+      try:
+        keys[name] = content_key(os.path.join(self.media_dir, name))
+      except OSError:
+        gone.append(name)
+    content = pd.DataFrame(list(keys.values()), index=pd.Index(list(keys), name='name'), columns=['payload_size', 'head'])
+    self._merge(content, gone=self.df.index.intersection(gone))
+
+  def _merge(self, content:pd.DataFrame, gone:pd.Index) -> None:
+    """content: (payload_size, head) of files as they are now, only the ones that differ from the index are hashed"""
+    known = self.df.reindex(content.index)
+    stale = (known['payload_size'] != content['payload_size']) | (known['head'] != content['head'])
+    names = list(content.index[stale])
+    logging.info("perceptual index: %d files unchanged, %d to hash, %d gone", (~stale).sum(), len(names), len(gone))
+    if not names and gone.empty:
+      return
+    fullnames = [os.path.join(self.media_dir, name) for name in names]
+    with ThreadPoolExecutor(max_workers=self.WORKERS) as pool:
+      # PIL releases the GIL while decoding and resizing, ffmpeg runs in its own process
+      hashes = list(tqdm(pool.map(perceptual_hashes, fullnames), total=len(names),
+                         desc="perceptual hashes", disable=len(names)<100))
+    fresh = content.loc[names].assign(hashes=[' '.join(f"{h:016x}" for h in hs) for hs in hashes])
+    self.df = pd.concat([self.df.drop(index=gone.union(names), errors='ignore'), fresh])
+    self._build_tree()
+    _write_atomically(self.df, self.fname)
+
+  def _build_tree(self) -> None:
+    hashes = {name: [int(h, 16) for h in hs.split()] for name, hs in self.df['hashes'].items()}
+    tree = BKTree()
+    for name, hs in hashes.items():
+      for h in hs:
+        tree.add(h, name)
+    self.hashes, self.tree = hashes, tree  # lookups on other threads see either the old or the new index
+
+  def similar(self, short_name:str, max_distance:int=None) -> list[str]:
+    """indexed files that look like `short_name`, closest first"""
+    radius = self.NEAR_DISTANCE if max_distance is None else max_distance
+    best = {}
+    for h in self.hashes.get(short_name, []):
+      for d, name in self.tree.find(h, radius):
+        if name != short_name and d < best.get(name, radius+1):
+          best[name] = d
+    return sorted(best, key=lambda name: (best[name], name))
+
+  def are_similar(self, a:str, b:str) -> bool:
+    return any(hamming(ha, hb) <= self.NEAR_DISTANCE
+               for ha in self.hashes.get(a, []) for hb in self.hashes.get(b, []))
+
+  def groups(self) -> list[list[str]]:
+    """connected components of the 'looks similar' relation"""
+    parent = {name: name for name in self.hashes}
+    def root(x):
+      while parent[x] != x:
+        x = parent[x]
+      return x
+    for name in self.hashes:
+      for other in self.similar(name):
+        parent[root(other)] = root(name)
+    components = {}
+    for name in self.hashes:
+      components.setdefault(root(name), []).append(name)
+    return sorted(sorted(c) for c in components.values() if len(c) > 1)
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="find files that look alike")
+  parser.add_argument('media_dir')
+  args = parser.parse_args()
+  for group in PerceptualIndex(args.media_dir).groups():
+    print(*group, sep='\n\t', end='\n\n')
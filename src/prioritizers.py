@@ -1,5 +1,8 @@
+import bisect
+import random
 from functools import partial
 from enum import Enum
+import numpy as np
 import pandas as pd
 from typing import Callable
 import statistics
@@ -12,6 +15,12 @@ def star_coef(p, row):
   MAXSTARS = 6.5
   return min(1.0, (row['stars']/MAXSTARS)**p)
 
+def rd_coef(maxrd, row):
+  rds = [row[col] for col in row.index if col.endswith('_rd')]
+  if not rds:
+    return 1.0
+  return min(1.0, statistics.mean(rds)/maxrd)
+
 def keyword_coef(word, row):
   coef = 0
   cols = ['tags', 'awards']
@@ -26,6 +35,8 @@ class PrioritizerType(Enum):
   FRESH = "fresh"
   TOP = "top"
   KEYWORD = "keyword"
+  ACTIVE = "active"
+  BANDED = "banded"
   def __str__(self):
     return self.value
 
@@ -46,6 +57,18 @@ def make_prioritizer(type:PrioritizerType):
       partial(keyword_coef, "color"),
     ])
 
+  if type == PrioritizerType.ACTIVE:
+    return ActivePrioritizer([
+      partial(rd_coef, 350),
+      partial(match_coef, 40, 2),
+    ])
+
+  if type == PrioritizerType.BANDED:
+    return BandedPrioritizer([
+      partial(match_coef, 40, 2),
+      partial(star_coef, 1.5),
+    ])
+
   return Prioritizer([
     partial(match_coef, 40, 2),
     partial(star_coef, 1.5),
@@ -59,3 +82,87 @@ class Prioritizer:
   def calc(self, row:pd.Series) -> pd.Series:
     row.loc['priority'] = statistics.mean([op(row) for op in self.ops]) if self.ops else 0
     return row
+
+  def pick(self, df:pd.DataFrame, n:int) -> pd.DataFrame:
+    return df.sample(n, weights='priority')
+
+  def track(self, df:pd.DataFrame) -> None:
+    """called when the set of profiles changes"""
+    pass
+
+  def on_update(self, name:str, row:pd.Series) -> None:
+    pass
+
+
+class ActivePrioritizer(Prioritizer):
+  """
+  pick the group whose outcome is expected to be the most informative:
+  uncertain ratings (high rd) and close strength, so the relative order is a coin flip
+  """
+  MIN_CANDIDATES = 64
+
+  def pick(self, df:pd.DataFrame, n:int) -> pd.DataFrame:
+    # cheap pre-filter, keeps the pairwise part independent of library size
+    weights = df['priority'].to_numpy(dtype=float) + 1e-9
+    candidates = df.iloc[np.random.choice(len(df), size=min(len(df), max(self.MIN_CANDIDATES, 4*n)),
+                                          replace=False, p=weights/weights.sum())]
+    gain = self._pairwise_gain(candidates)
+    chosen = [int(np.argmax(candidates['priority'].to_numpy()))]
+    total_gain = gain[chosen[0]].copy()
+    for _ in range(n-1):
+      total_gain[chosen] = -np.inf
+      nxt = int(np.argmax(total_gain))
+      chosen.append(nxt)
+      total_gain += gain[nxt]
+    return candidates.iloc[chosen]
+
+  @staticmethod
+  def _pairwise_gain(df:pd.DataFrame) -> np.ndarray:
+    stars = df['stars'].to_numpy(dtype=float)
+    rd_cols = [col for col in df.columns if col.endswith('_rd')]
+    uncertainty = df[rd_cols].to_numpy(dtype=float).mean(axis=1) / 350 if rd_cols else np.ones(len(df))
+    # expected score with 1 star ~ 200 elo points
+    p_win = 1 / (1 + 10**((stars[None,:] - stars[:,None])/2))
+    return p_win*(1-p_win) * (uncertainty[None,:] + uncertainty[:,None])
+
+
+class BandedPrioritizer(Prioritizer):
+  """
+  draw a seed by priority, fill the rest of the match from the seed's rating band
+  """
+  BAND = 0.5  # stars each side of the seed
+  MAX_CANDIDATES_PER_SLOT = 8
+
+  def __init__(self, ops:list[Callable[[pd.Series], float]]):
+    super().__init__(ops)
+    self.stars:dict[str,float] = {}
+    self.sorted_keys:list[tuple[float,str]] = []
+
+  def track(self, df:pd.DataFrame) -> None:
+    self.stars = df['stars'].to_dict()
+    self.sorted_keys = sorted((stars, name) for name, stars in self.stars.items())
+
+  def on_update(self, name:str, row:pd.Series) -> None:
+    if name in self.stars:
+      del self.sorted_keys[bisect.bisect_left(self.sorted_keys, (self.stars[name], name))]
+    self.stars[name] = row['stars']
+    bisect.insort(self.sorted_keys, (row['stars'], name))
+
+  def pick(self, df:pd.DataFrame, n:int) -> pd.DataFrame:
+    if len(self.stars) != len(df):
+      self.track(df)
+    seed = super().pick(df, 1).index[0]
+    seed_stars = self.stars[seed]
+    lo = bisect.bisect_left(self.sorted_keys, (seed_stars-self.BAND,))
+    hi = bisect.bisect_left(self.sorted_keys, (seed_stars+self.BAND,))
+    if hi - lo < n:
+      pos = bisect.bisect_left(self.sorted_keys, (seed_stars, seed))
+      lo = max(0, min(pos - n//2, len(self.sorted_keys) - n))
+      hi = lo + n
+    positions = range(lo, hi)
+    if len(positions) > self.MAX_CANDIDATES_PER_SLOT*n:
+      positions = random.sample(positions, self.MAX_CANDIDATES_PER_SLOT*n)
+    band = [self.sorted_keys[i][1] for i in positions if self.sorted_keys[i][1] != seed]
+    weights = df.loc[band, 'priority'].to_numpy(dtype=float) + 1e-9
+    rest = np.random.choice(len(band), size=n-1, replace=False, p=weights/weights.sum())
+    return df.loc[[seed] + [band[i] for i in rest]]
@@ -0,0 +1,163 @@
+import os
+import sys
+from collections.abc import Sequence
+import numpy as np
+import pandas as pd
+
+from ae_rater_types import ProfileInfo, Rating
+
+
+STRICT = bool(os.environ.get("AE_STRICT"))  # debug: check every updated row too, not only whole loads
+
+def schema(systems:list[str]) -> dict[str,type]:
+  dtypes = {'tags': str, 'stars': np.float64, 'nmatches': np.int64, 'priority': np.float64, 'awards': str}
+  for s in systems:
+    dtypes |= {s+'_pts': np.int64, s+'_rd': np.int64, s+'_time': np.float64}
+  return dtypes
+
+def schema_errors(df:pd.DataFrame, systems:list[str]) -> list[str]:
+  """checks whole columns at once, instead of every value on every conversion"""
+  dtypes = schema(systems)
+  if missing := [col for col in dtypes if col not in df.columns]:
+    return [f"missing columns {missing}"]
+  errors = []
+  for col, t in dtypes.items():
+    if t is str:
+      not_str = df.index[df[col].map(type) != str]
+      if len(not_str):
+        errors.append(f"{col} is not a string in {list(not_str[:5])}")
+    elif df[col].dtype != t:
+      errors.append(f"{col} expected {np.dtype(t)}  got {df[col].dtype}")
+    elif t is np.float64 and df[col].isna().any():
+      errors.append(f"{col} is missing in {list(df.index[df[col].isna()][:5])}")
+  if not errors and (bad := df.index[~(df['stars'] >= 0)]).size:
+    errors.append(f"negative stars in {list(bad[:5])}")
+  return errors
+
+
+class ProfileStore:
+  """
+  Columnar mirror of the db for building profiles: numpy arrays for the numbers
+  (one column per rating system in pts/rd/time), interned tags and awards and
+  a name -> row index. Profiles are built only when asked for,
+  the schema is validated once per load()
+  """
+  def __init__(self, media_dir:str, systems:list[str], strict:bool=STRICT) -> None:
+    self.media_dir = media_dir
+    self.systems = list(systems)
+    self.strict = strict
+    self.generation = 0  # moves on every load(), row numbers of earlier generations mean other files
+    self.columns = list(schema(self.systems))
+    self.load(pd.DataFrame({col: pd.Series(dtype=object if t is str else t) for col, t in schema(self.systems).items()}))
+
+  def load(self, df:pd.DataFrame) -> None:
+    errors = schema_errors(df, self.systems)
+    assert not errors, "bad db:\n" + '\n'.join(errors)
+    self.generation += 1
+    self.names = df.index.to_numpy(dtype=object)
+    self.row_of = {name: i for i, name in enumerate(self.names)}
+    self.tags = np.array([sys.intern(t) for t in df['tags']], dtype=object)
+    self.awards = np.array([sys.intern(a) for a in df['awards']], dtype=object)
+    self.stars = df['stars'].to_numpy(np.float64, copy=True)
+    self.nmatches = df['nmatches'].to_numpy(np.int64, copy=True)
+    self.priority = df['priority'].to_numpy(np.float64, copy=True)
+    def matrix(suffix, dtype):
+      return np.column_stack([df[s+suffix].to_numpy(dtype) for s in self.systems]).reshape(len(df), len(self.systems))
+    self.pts = matrix('_pts', np.int64)
+    self.rd = matrix('_rd', np.int64)
+    self.time = matrix('_time', np.float64)
+
+  def set_row(self, short_name:str, row:pd.Series) -> None:
+    i = self.row_of[short_name]
+    self.tags[i] = sys.intern(row['tags'])
+    self.awards[i] = sys.intern(row['awards'])
+    self.stars[i] = row['stars']
+    self.nmatches[i] = row['nmatches']
+    self.priority[i] = row['priority']
+    for j, s in enumerate(self.systems):
+      self.pts[i,j], self.rd[i,j], self.time[i,j] = row[s+'_pts'], row[s+'_rd'], row[s+'_time']
+    if self.strict:
+      self._check_row(i, row)
+
+  def values(self, short_name:str) -> dict:
+    """the row as a dict of the db's columns, much cheaper than a DataFrame row"""
+    i = self.row_of[short_name]
+    values = [self.tags[i], self.stars[i], self.nmatches[i], self.priority[i], self.awards[i]]
+    for j in range(len(self.systems)):
+      values += [self.pts[i,j], self.rd[i,j], self.time[i,j]]
+    return dict(zip(self.columns, values))
+
+  def _check_row(self, i:int, row:pd.Series) -> None:
+    """what got stored is what was given: no truncated ints or NaNs"""
+    assert isinstance(row['tags'], str) and isinstance(row['awards'], str), row
+    assert self.stars[i] >= 0, row
+    stored = [self.stars[i], self.nmatches[i], self.priority[i]]
+    given = [row['stars'], row['nmatches'], row['priority']]
+    for j, s in enumerate(self.systems):
+      stored += [self.pts[i,j], self.rd[i,j], self.time[i,j]]
+      given += [row[s+'_pts'], row[s+'_rd'], row[s+'_time']]
+    assert stored == given, f"{self.names[i]}: stored {stored}, given {given}"
+
+  def __len__(self) -> int:
+    return len(self.names)
+
+  def profile(self, i:int) -> ProfileInfo:
+    return ProfileInfo(
+      fullname=os.path.join(self.media_dir, self.names[i]),
+      tags=self.tags[i],
+      stars=float(self.stars[i]),
+      ratings={s: Rating(int(self.pts[i,j]), int(self.rd[i,j]), float(self.time[i,j]))
+               for j, s in enumerate(self.systems)},
+      nmatches=int(self.nmatches[i]),
+      awards=self.awards[i],
+    )
+
+  def profiles(self, short_names) -> list[ProfileInfo]:
+    return [self.profile(self.row_of[name]) for name in short_names]
+
+  def get(self, short_name:str) -> ProfileInfo:
+    return self.profile(self.row_of[short_name])
+
+  def ranking(self, by_systems:list[str]) -> 'Profiles':
+    """best first: by stars, then points of `by_systems` in order, then awards"""
+    awards_rank = pd.factorize(self.awards, sort=True)[0]
+    keys = [-awards_rank] + [-self.pts[:, self.systems.index(s)] for s in reversed(by_systems)] + [-self.stars]
+    return Profiles(self, np.lexsort(keys))
+
+
+class Profiles(Sequence):
+  """
+  The store's profiles in a given order, each built on access. A view:
+  it sees later updates of the rows. After the store is reloaded (renames,
+  deletions, fs events, bulk updates) the rows are found again by name,
+  keeping the order; files gone since then drop out of the view
+  """
+  def __init__(self, store:ProfileStore, rows:np.ndarray) -> None:
+    self.store = store
+    self.rows = rows
+    self.names = store.names[rows]
+    self.generation = store.generation
+
+  def _resolve(self) -> np.ndarray:
+    if self.generation != self.store.generation:
+      row_of = self.store.row_of
+      self.names = np.array([name for name in self.names if name in row_of], dtype=object)
+      self.rows = np.array([row_of[name] for name in self.names], dtype=np.int64)
+      self.generation = self.store.generation
+    return self.rows
+
+  def __len__(self) -> int:
+    return len(self._resolve())
+
+  def __getitem__(self, i):
+    rows = self._resolve()
+    if isinstance(i, slice):
+      return [self.store.profile(r) for r in rows[i]]
+    return self.store.profile(rows[i])
+
+  def rank_of(self, fullname:str) -> int:
+    rows = self._resolve()
+    return int(np.flatnonzero(rows == self.store.row_of[os.path.basename(fullname)])[0])
+
+  def total_matches(self) -> int:
+    return int(self.store.nmatches[self._resolve()].sum())
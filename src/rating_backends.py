@@ -1,7 +1,11 @@
 from abc import ABC, abstractmethod
+import itertools
 import math
 import copy
 import time
+from functools import partial
+from typing import Callable
+import numpy as np
 from ae_rater_types import *
 
 import logging
@@ -156,3 +160,146 @@ class Glicko(RatingBackend):
       max(self.MIN_RD, round(new_rd)),
       time.time(),
     )
+
+
+
+class TrueSkill(RatingBackend):
+  def __init__(self):
+    super().__init__()
+    self.BASE_POINTS = 1500
+    self.MIN_RD = 25
+    self.MAX_RD = 350
+    self.BETA = self.MAX_RD/2
+    self.MIN_VARIANCE_FACTOR = 1e-4
+
+  def stars_to_rating(self, stars):
+    return Rating(int(self.BASE_POINTS+self.MAX_RD*stars), self.MAX_RD, time.time())
+
+  def rating_to_stars(self, rat):
+    return max((rat.points-self.BASE_POINTS)/self.MAX_RD, 0.0)
+
+  # Weng, Lin "A Bayesian Approximation Method for Online Ranking", Plackett-Luce model:
+  # the whole ranking (ties included) is consumed at once instead of O(N^2) pairwise games.
+  # The sums over "everyone ranked the same or lower" are running sums over the tiers,
+  # and the outcome string is already sorted best to worst, so a match costs O(N)
+  def _process_match_strategy(self, match):
+    tiers = [[Outcome.let_to_idx(letter) for letter in tier] for tier in match.outcome.tiers.split()]
+    ratings = [p.ratings[self.name()] for p in match.profiles]
+    for rat in ratings:
+      rat.rd = self._update_rd(match.timestamp, rat)
+    c = math.sqrt(sum(rat.rd**2 + self.BETA**2 for rat in ratings))
+    top = max(rat.points for rat in ratings)
+    strength = [math.exp((rat.points-top)/c) for rat in ratings]  # shifted against overflow, only ratios matter
+
+    tier_strength = [sum(strength[i] for i in tier) for tier in tiers]
+    not_better = list(itertools.accumulate(reversed(tier_strength)))[::-1]
+    inv_sums = list(itertools.accumulate(1/s for s in not_better))
+    inv_sq_sums = list(itertools.accumulate(1/s**2 for s in not_better))
+
+    ret = [None] * len(ratings)
+    for k, tier in enumerate(tiers):
+      for i in tier:
+        rat, x = ratings[i], strength[i]
+        omega = 1/len(tier) - x*inv_sums[k]
+        delta = (x*inv_sums[k] - x**2*inv_sq_sums[k]) * rat.rd/c
+        newrat = Rating(
+          round(rat.points + rat.rd**2/c * omega),
+          max(self.MIN_RD, round(rat.rd * math.sqrt(max(1 - rat.rd**2/c**2 * delta, self.MIN_VARIANCE_FACTOR)))),
+          time.time(),
+        )
+        ret[i] = RatChange(newrat, newrat.points-rat.points, self.rating_to_stars(newrat))
+    return ret
+
+  def _update_rd(self, match_timestamp, rating:Rating) -> int:
+    days_since_last_match = max(0, (match_timestamp-rating.timestamp)/86400)
+    return min(round(math.sqrt(rating.rd**2 + days_since_last_match**2)), self.MAX_RD)
+
+
+class BradleyTerry:
+  """
+  offline maximum likelihood fit over the whole history at once:
+  unlike the incremental backends above, the result does not depend on the order of matches
+  """
+  def __init__(self, base_rating=1200, std=200):
+    self.BASE_RATING = base_rating  # same scale as ELO
+    self.STD = std
+    self.SCALE = math.log(10)/(2*self.STD)  # points -> log-strength
+    self.PRIOR_GAMES = 1  # a virtual draw against the stars-based rating keeps unbeaten profiles finite
+    self.TOL = 1e-6
+    self.MAX_ITERS = 100
+
+  def name(self) -> RatSystemName:
+    return type(self).__name__
+
+  def stars_to_rating(self, stars:float) -> Rating:
+    no_data_se = 1/math.sqrt(self.PRIOR_GAMES/4)/self.SCALE
+    return Rating(int(self.BASE_RATING + self.STD*stars), round(no_data_se), time.time())
+
+  def rating_to_stars(self, rat:Rating) -> float:
+    return max((rat.points-self.BASE_RATING)/self.STD, 0.0)
+
+  def fit(self, winners:np.ndarray, losers:np.ndarray, weights:np.ndarray,
+          prior_pts:np.ndarray, init_pts:np.ndarray=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    winners[k] beat losers[k] `weights[k]` times, draws count as half a win both ways.
+    Returns points and their standard errors for every profile.
+    Damped Newton on log-strengths, the Hessian is never built: its products with a vector
+    are a couple of bincounts over the results, and the Newton step is solved by conjugate gradient
+    """
+    n = len(prior_pts)
+    prior = (prior_pts - np.mean(prior_pts)) * self.SCALE  # only differences matter
+    theta = prior.copy() if init_pts is None else (init_pts - np.mean(prior_pts)) * self.SCALE
+
+    def log_likelihood(theta):
+      diff, prior_diff = theta[winners]-theta[losers], theta-prior
+      return (-np.sum(weights*np.logaddexp(0, -diff))
+              - self.PRIOR_GAMES*np.sum(np.logaddexp(0, prior_diff) - prior_diff/2))
+
+    def curvature(theta):
+      p = 1/(1+np.exp(theta[losers]-theta[winners]))
+      q = 1/(1+np.exp(prior-theta))
+      return p, q, weights*p*(1-p), self.PRIOR_GAMES*q*(1-q)
+
+    def information_times(v, games_c, prior_c):
+      flow = games_c*(v[winners]-v[losers])
+      return np.bincount(winners, flow, minlength=n) - np.bincount(losers, flow, minlength=n) + prior_c*v
+
+    for it in range(self.MAX_ITERS):
+      p, q, games_c, prior_c = curvature(theta)
+      surprise = weights*(1-p)
+      grad = (np.bincount(winners, surprise, minlength=n) - np.bincount(losers, surprise, minlength=n)
+              + self.PRIOR_GAMES*(0.5-q))
+      diag = np.bincount(winners, games_c, minlength=n) + np.bincount(losers, games_c, minlength=n) + prior_c
+      step = self._conjugate_gradient(partial(information_times, games_c=games_c, prior_c=prior_c), grad, diag)
+      current = log_likelihood(theta)
+      while log_likelihood(theta+step) < current and np.max(np.abs(step), initial=0) > self.TOL:
+        step /= 2
+      theta += step
+      if np.max(np.abs(step), initial=0) < self.TOL:
+        break
+    logging.info("%s: fit %d results in %d iterations", self.name(), len(weights), it+1)
+
+    # diagonal of the Fisher information, the full inverse would be O(n^3)
+    _, _, games_c, prior_c = curvature(theta)
+    info = np.bincount(winners, games_c, minlength=n) + np.bincount(losers, games_c, minlength=n) + prior_c
+    points = theta/self.SCALE + np.mean(prior_pts)
+    return np.round(points).astype(np.int64), np.round(1/np.sqrt(info)/self.SCALE).astype(np.int64)
+
+  def _conjugate_gradient(self, matmul:Callable, b:np.ndarray, diag:np.ndarray) -> np.ndarray:
+    """solve Ax=b for symmetric positive definite A, Jacobi preconditioned"""
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = r/diag
+    d = z.copy()
+    rz = r@z
+    for _ in range(len(b)):
+      if np.max(np.abs(r), initial=0) < self.TOL:
+        break
+      ad = matmul(d)
+      alpha = rz/(d@ad)
+      x += alpha*d
+      r -= alpha*ad
+      z = r/diag
+      rz, rz_prev = r@z, rz
+      d = z + rz/rz_prev*d
+    return x
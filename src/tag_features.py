@@ -0,0 +1,66 @@
+from typing import Iterable
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from tag_matrix import TagMatrix
+
+
+class TagFeaturizer:
+  """
+  Tags and awards as a sparse files x tokens matrix for the ml backends.
+  Tokens match exactly: `lighting` is not `lighting|colors`.
+  Features of a MetadataManager's db come from its tag matrix and are cached until the db changes
+  """
+  AWARD_PREFIX = 'award:'
+
+  def __init__(self) -> None:
+    self.columns:list[str] = []
+    self.col_of:dict[str,int] = {}
+    self.cache_key = None
+    self.cached = None
+
+  @classmethod
+  def tokens(cls, tags:Iterable[str], awards:Iterable[str]=()) -> list[str]:
+    return list(tags) + [cls.AWARD_PREFIX+a for a in awards]
+
+  @classmethod
+  def _db_tokens(cls, db:pd.DataFrame) -> Iterable[list[str]]:
+    return (cls.tokens(tags.split(), awards.split()) for tags, awards in zip(db['tags'], db['awards']))
+
+  def _tag_columns(self, tag_matrix:TagMatrix) -> sparse.csr_matrix:
+    """tag bits -> the fitted columns, tags unknown at fit() are dropped"""
+    pairs = [(tag_matrix.bit_of[t], j) for j, t in enumerate(self.columns) if t in tag_matrix.bit_of]
+    bits, cols = zip(*pairs) if pairs else ((), ())
+    return sparse.csr_matrix((np.ones(len(pairs), dtype=np.float32), (bits, cols)),
+                             shape=(len(tag_matrix.vocab), len(self.columns)))
+
+  def fit(self, db:pd.DataFrame) -> 'TagFeaturizer':
+    self.columns = sorted({t for tokens in self._db_tokens(db) for t in tokens})
+    self.col_of = {t: i for i, t in enumerate(self.columns)}
+    self.cache_key = self.cached = None
+    return self
+
+  def transform(self, token_lists:Iterable[list[str]]) -> sparse.csr_matrix:
+    """one row per token list, tokens unknown at fit() are dropped"""
+    indices, indptr = [], [0]
+    for tokens in token_lists:
+      indices += sorted({self.col_of[t] for t in tokens if t in self.col_of})
+      indptr.append(len(indices))
+    return sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32),
+                              np.array(indptr, dtype=np.int64)), shape=(len(indptr)-1, len(self.columns)))
+
+  def transform_db(self, db:pd.DataFrame) -> sparse.csr_matrix:
+    return self.transform(self._db_tokens(db))
+
+  def db_features(self, mm) -> sparse.csr_matrix:
+    """features of mm's db rows, recomputed only when mm.version moves"""
+    key = (id(mm), mm.version)
+    if key != self.cache_key:
+      db, tm = mm.get_db(), mm.tag_matrix
+      rows = np.array([tm.row_of[name] for name in db.index], dtype=np.int64)
+      tags = sparse.csr_matrix(tm.bool_matrix()[rows], dtype=np.float32) @ self._tag_columns(tm)
+      awards = self.transform(self.tokens((), a.split()) for a in db['awards'])
+      self.cached = (tags + awards).tocsr()
+      self.cache_key = key
+    return self.cached
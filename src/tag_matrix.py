@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+from tags_vocab import VOCAB
+
+
+def _bit_columns(bits:np.ndarray) -> np.ndarray:
+  """uint64 words -> one bool column per tag"""
+  return np.unpackbits(bits.astype('<u8').view(np.uint8), axis=-1, bitorder='little').astype(bool)
+
+
+class TagMatrix:
+  """
+  Tags of every file as a row of bits, one bit per tag: the vocabulary first,
+  then tags outside of it in the order they are met. Counting and filtering by
+  tags are numpy operations over the whole matrix instead of string splits per row
+  """
+  def __init__(self, tags:pd.Series, vocab:list[str]=VOCAB) -> None:
+    self.vocab:list[str] = []
+    self.bit_of:dict[str,int] = {}
+    self.bits = np.zeros((len(tags), 1), dtype=np.uint64)
+    for tag in vocab:
+      self._bit(tag)
+    self.names = tags.index
+    self.row_of = {name: i for i, name in enumerate(tags.index)}
+    encoded = {}
+    for i, tagstr in enumerate(tags):
+      if tagstr not in encoded:  # few distinct tag sets in a library
+        encoded[tagstr] = self.mask(tagstr.split(), add=True)
+      self._store(i, encoded[tagstr])
+
+  def _bit(self, tag:str) -> int:
+    if tag not in self.bit_of:
+      self.bit_of[tag] = len(self.vocab)
+      self.vocab.append(tag)
+      if len(self.vocab) > 64*self.bits.shape[1]:
+        self.bits = np.pad(self.bits, ((0, 0), (0, 1)))
+    return self.bit_of[tag]
+
+  def mask(self, tags, add:bool=False) -> np.ndarray:
+    """the bits of `tags`; tags not seen before are ignored, unless `add`"""
+    bits = [self._bit(t) for t in tags] if add else [self.bit_of[t] for t in tags if t in self.bit_of]
+    mask = np.zeros(self.bits.shape[1], dtype=np.uint64)
+    for b in bits:
+      mask[b//64] |= np.uint64(1) << np.uint64(b%64)
+    return mask
+
+  def _store(self, i:int, mask:np.ndarray) -> None:
+    self.bits[i, :len(mask)] = mask  # masks made before the matrix widened are shorter
+    self.bits[i, len(mask):] = 0
+
+  def set_row(self, name:str, tagstr:str) -> None:
+    self._store(self.row_of[name], self.mask(tagstr.split(), add=True))
+
+  def rows(self, names) -> np.ndarray:
+    return np.fromiter((self.row_of[n] for n in names), dtype=np.intp, count=len(names))
+
+  def containing(self, word:str) -> list[str]:
+    """tags that have `word` in them"""
+    return [t for t in self.vocab if word in t]
+
+  def has_any(self, tags, rows:np.ndarray=None) -> np.ndarray:
+    """whether each file has any of `tags`, only the files at `rows` if given"""
+    bits = self.bits if rows is None else self.bits[rows]
+    return (bits & self.mask(tags)).any(axis=1)
+
+  def counts(self) -> pd.Series:
+    """number of files with each tag"""
+    return pd.Series(_bit_columns(self.bits).sum(axis=0)[:len(self.vocab)], index=self.vocab)
+
+  def bool_matrix(self) -> np.ndarray:
+    """files x tags, the tag part of the ml features"""
+    return _bit_columns(self.bits)[:, :len(self.vocab)]
+
+  def strings(self, keep:np.ndarray=None) -> pd.Series:
+    """tags as sorted space-joined strings, only the ones in the `keep` mask if given"""
+    bits = self.bits if keep is None else self.bits & keep
+    distinct, inverse = np.unique(bits, axis=0, return_inverse=True)
+    decoded = np.array([' '.join(sorted(self.vocab[b] for b in np.flatnonzero(row))) for row in _bit_columns(distinct)],
+                       dtype=object)
+    return pd.Series(decoded[inverse.reshape(-1)], index=self.names)
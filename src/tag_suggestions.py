@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import threading
+import time
+import pandas as pd
+from tqdm import tqdm
+
+from ai_types import TagsBackend
+from content_index import content_key
+from db_managers import _is_media, _write_atomically
+
+
+def _stat(fullname:str) -> tuple[int,int]:
+  st = os.stat(fullname)
+  return st.st_size, st.st_mtime_ns
+
+def _encode(suggestions:list[tuple[str,float]]) -> str:
+  return ' '.join(f"{tag}:{prob:.4f}" for tag, prob in suggestions)
+
+def _decode(s:str) -> list[tuple[str,float]]:
+  return [(tag, float(prob)) for tag, prob in (pair.rsplit(':', 1) for pair in s.split())]
+
+
+class SuggestionCache:
+  """
+  Tag suggestions of the files in a media dir, kept in a csv there.
+  An entry is valid for the model version that made it and the content of the file:
+  size and mtime first, then the payload key, so rewriting the metadata keeps the suggestions
+  """
+  FNAME = 'tag_suggestions.csv'
+  COLUMNS = ['size', 'mtime', 'payload_size', 'head', 'model', 'suggestions']
+  KEEP = 20
+  COMMIT_INTERVAL = 30.0  # seconds, for suggestions put one by one
+
+  def __init__(self, media_dir:str, model_version:str) -> None:
+    self.media_dir = media_dir
+    self.model_version = model_version
+    self.fname = os.path.join(media_dir, self.FNAME)
+    self.lock = threading.RLock()
+    self.dirty = False
+    self.last_commit = time.monotonic()
+    if os.path.exists(self.fname):
+      self.df = pd.read_csv(self.fname, index_col='name', keep_default_na=False,
+                            dtype={'head': str, 'model': str, 'suggestions': str})
+    else:
+      self.df = pd.DataFrame(columns=self.COLUMNS).rename_axis('name')
+
+  def covers(self, fullname:str) -> bool:
+    return os.path.dirname(os.path.abspath(fullname)) == os.path.abspath(self.media_dir)
+
+  def _is_fresh(self, name:str) -> bool:
+    if name not in self.df.index or self.df.at[name, 'model'] != self.model_version:
+      return False
+    fullname = os.path.join(self.media_dir, name)
+    try:
+      size, mtime = _stat(fullname)
+      if (self.df.at[name, 'size'], self.df.at[name, 'mtime']) == (size, mtime):
+        return True
+      if content_key(fullname) != (self.df.at[name, 'payload_size'], self.df.at[name, 'head']):
+        return False
+    except OSError:
+      return False
+    self.df.loc[name, ['size', 'mtime']] = [size, mtime]  # only the metadata changed
+    return True
+
+  def get(self, fullname:str) -> list[tuple[str,float]]:
+    """None if there are no valid suggestions for the file"""
+    name = os.path.basename(fullname)
+    with self.lock:
+      if not self._is_fresh(name):
+        return None
+      return _decode(self.df.at[name, 'suggestions'])
+
+  def put(self, fullname:str, suggestions:list[tuple[str,float]]) -> None:
+    row = [*_stat(fullname), *content_key(fullname), self.model_version, _encode(suggestions[:self.KEEP])]
+    with self.lock:
+      self.df.loc[os.path.basename(fullname)] = row
+      self.dirty = True
+
+  def stale(self, names:list[str]) -> list[str]:
+    with self.lock:
+      return [name for name in names if not self._is_fresh(name)]
+
+  def commit(self) -> None:
+    with self.lock:
+      _write_atomically(self.df, self.fname)
+      self.dirty = False
+      self.last_commit = time.monotonic()
+
+  def commit_due(self) -> None:
+    """commit if the last one is COMMIT_INTERVAL old: every commit rewrites the whole csv"""
+    if self.dirty and time.monotonic()-self.last_commit >= self.COMMIT_INTERVAL:
+      self.commit()
+
+
+def precompute(cache:SuggestionCache, backend:TagsBackend, names:list[str], chunk:int=256) -> int:
+  """suggest tags for the files with stale entries in batches, returns how many were computed"""
+  todo = cache.stale(names)
+  done = 0
+  for start in tqdm(range(0, len(todo), chunk), desc="suggesting tags", unit="batch"):
+    fullnames = [os.path.join(cache.media_dir, name) for name in todo[start:start+chunk]]
+    try:
+      suggested = backend.suggest_many(fullnames)
+    except Exception as ex:
+      logging.warning("batch failed, suggesting one by one: %s", ex)
+      suggested = []
+      for fullname in fullnames:
+        try:
+          suggested.append(backend.suggest_tags(fullname))
+        except Exception as ex:
+          logging.error("%s: %s", fullname, ex)
+          suggested.append(None)
+    for fullname, suggestions in zip(fullnames, suggested):
+      if suggestions is not None:
+        cache.put(fullname, suggestions)
+        done += 1
+    cache.commit()  # an interrupted run keeps what it did
+  return done
+
+
+if __name__ == "__main__":
+  from ai_backend_tags import ConvnextTiny
+  from db_managers import MetadataManager
+
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="precompute tag suggestions of a media dir for the editor")
+  parser.add_argument('media_dir')
+  parser.add_argument('--all', action='store_true', help="tagged files too, not only untagged and changed ones")
+  parser.add_argument('--chunk', type=int, default=256, help="files per inference batch")
+  args = parser.parse_args()
+
+  backend = ConvnextTiny()
+  cache = SuggestionCache(args.media_dir, backend.version)
+  names = sorted(name for name in os.listdir(args.media_dir)
+                 if _is_media(name) and os.path.isfile(os.path.join(args.media_dir, name)))
+  if not args.all:
+    db = MetadataManager(os.path.abspath(args.media_dir)).get_db()
+    untagged = set(db.index[db['tags'] == ""])
+    names = [name for name in names if name in untagged or name in cache.df.index]
+  print(f"suggested tags for {precompute(cache, backend, names, args.chunk)} files")
@@ -0,0 +1,66 @@
+import logging
+import queue
+import threading
+from typing import Callable
+
+
+class WriteBehind:
+  """
+  Runs disk writes on a worker thread, one at a time in submission order,
+  so no write is overtaken by an older version of the same data.
+  The queue is bounded: when the disk falls behind, submit() blocks the caller
+  instead of piling up snapshots in memory
+  """
+  def __init__(self, maxsize:int=256) -> None:
+    self.jobs = queue.Queue(maxsize)
+    self.failures = queue.SimpleQueue()
+    self.pending:dict[str,int] = {}
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self._work, name="write-behind", daemon=True)
+    self.thread.start()
+
+  def submit(self, what:str, func:Callable, *args, key:str=None) -> None:
+    """what: description for failure reports; key: what is written to, see is_pending()"""
+    assert self.thread.is_alive(), "write-behind worker is closed"
+    if key is not None:
+      with self.lock:
+        self.pending[key] = self.pending.get(key, 0) + 1
+    self.jobs.put((what, key, func, args))
+
+  def is_pending(self, key:str) -> bool:
+    with self.lock:
+      return key in self.pending
+
+  def pop_failures(self) -> list[str]:
+    failures = []
+    while not self.failures.empty():
+      failures.append(self.failures.get())
+    return failures
+
+  def drain(self) -> None:
+    """wait until everything submitted so far is on disk"""
+    self.jobs.join()
+
+  def close(self) -> None:
+    if self.thread.is_alive():
+      self.jobs.put(None)
+      self.thread.join()
+    for failure in self.pop_failures():
+      logging.error("not saved: %s", failure)
+
+  def _work(self) -> None:
+    while (job := self.jobs.get()) is not None:
+      what, key, func, args = job
+      try:
+        func(*args)
+      except Exception as ex:
+        logging.exception("write-behind: %s failed", what)
+        self.failures.put(f"{what}: {ex}")
+      finally:
+        if key is not None:
+          with self.lock:
+            self.pending[key] -= 1
+            if not self.pending[key]:
+              del self.pending[key]
+        self.jobs.task_done()
+    self.jobs.task_done()
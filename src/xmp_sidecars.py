@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from db_managers import _is_media
+from metadata import SidecarPolicy, embed_sidecar, move_to_sidecar, sidecar_name
+
+
+WORKERS = min(32, 4*(os.cpu_count() or 1))
+
+def _run(func, fullnames:list[str], desc:str) -> int:
+  def safe(fullname):
+    try:
+      func(fullname)
+      return True
+    except Exception as ex:
+      logging.error("%s: %s", fullname, ex)
+      return False
+  with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+    return sum(tqdm(pool.map(safe, fullnames), total=len(fullnames), desc=desc))
+
+def migrate(media_dir:str, policy:SidecarPolicy) -> int:
+  """move metadata of the files the policy picks into sidecars, returns how many were moved"""
+  fullnames = [os.path.join(media_dir, name) for name in sorted(os.listdir(media_dir)) if _is_media(name)]
+  todo = [f for f in fullnames if not os.path.exists(sidecar_name(f)) and policy.wants_sidecar(f)]
+  return _run(move_to_sidecar, todo, "to sidecars")
+
+def embed(media_dir:str, policy:SidecarPolicy=None) -> int:
+  """write sidecars back into their files (only those the policy picks, if given) and remove them"""
+  fullnames = [os.path.join(media_dir, name) for name in sorted(os.listdir(media_dir)) if _is_media(name)]
+  todo = [f for f in fullnames if os.path.exists(sidecar_name(f)) and (policy is None or policy.wants_sidecar(f))]
+  return _run(embed_sidecar, todo, "embedding")
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="move metadata between media files and .xmp sidecars")
+  parser.add_argument('command', choices=['migrate', 'embed'])
+  parser.add_argument('media_dir')
+  parser.add_argument('--ext', nargs='*', default=[], help="file extensions to select, e.g. mp4 mov")
+  parser.add_argument('--min_mb', type=float, help="select files of at least this size")
+  args = parser.parse_args()
+
+  policy = SidecarPolicy(tuple(e.lower().lstrip('.') for e in args.ext),
+                         None if args.min_mb is None else int(args.min_mb*2**20))
+  if args.command == 'migrate':
+    if not policy.extensions and policy.min_size is None:
+      parser.error("migrate needs --ext or --min_mb")
+    print(f"moved metadata of {migrate(args.media_dir, policy)} files to sidecars")
+  else:
+    selective = bool(policy.extensions) or policy.min_size is not None
+    print(f"embedded {embed(args.media_dir, policy if selective else None)} sidecars")
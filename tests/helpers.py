@@ -66,8 +66,10 @@ def immitate_external_metadata_change() -> tuple:
 
 def disk_cleanup() -> None:
   for f in os.listdir(MEDIA_FOLDER):
-    if file_extension(f) == 'csv':
+    if file_extension(f) in ('csv', 'wal'):
       os.remove(os.path.join(MEDIA_FOLDER, f))
+    elif f.endswith('_checkpoints'):
+      shutil.rmtree(os.path.join(MEDIA_FOLDER, f))
   if os.path.exists(BACKUP_FOLDER):
     for f in os.listdir(BACKUP_FOLDER):
       shutil.move(os.path.join(BACKUP_FOLDER, f), os.path.join(MEDIA_FOLDER, f))
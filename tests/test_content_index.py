@@ -0,0 +1,94 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from content_index import ContentIndex, content_digest
+from tests.helpers import MEDIA_FOLDER
+
+
+def _add_jpeg_app_segment(fullname:str, payload:bytes) -> None:
+  with open(fullname, 'rb') as f:
+    data = f.read()
+  segment = b'\xff\xe1' + struct.pack('>H', len(payload)+2) + payload
+  with open(fullname, 'wb') as f:
+    f.write(data[:2] + segment + data[2:])
+
+def _add_mp4_box(fullname:str, payload:bytes) -> None:
+  with open(fullname, 'ab') as f:
+    f.write(struct.pack('>I4s', len(payload)+8, b'free') + payload)
+
+
+class TestContentIndex(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.other_dir = tempfile.mkdtemp()
+    for name in ["dog.jpg", "pink_field.jpg", "cat.mp4"]:
+      shutil.copy(os.path.join(MEDIA_FOLDER, name), self.dir)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+    shutil.rmtree(self.other_dir)
+
+  def _path(self, name:str, folder:str=None) -> str:
+    return os.path.join(folder or self.dir, name)
+
+  def test_metadata_doesnt_change_digest(self):
+    for name, add_metadata in [("dog.jpg", _add_jpeg_app_segment), ("cat.mp4", _add_mp4_box)]:
+      copy = shutil.copy(self._path(name), self._path(name, self.other_dir))
+      add_metadata(copy, b"<?xpacket begin='' id='W5M0MpCehiHzreSzNTczkc9d'?>tags<?xpacket end='w'?>")
+      self.assertNotEqual(os.path.getsize(copy), os.path.getsize(self._path(name)))
+      self.assertEqual(content_digest(copy), content_digest(self._path(name)))
+
+  def test_find(self):
+    index = ContentIndex(self.dir)
+    self.assertTrue(os.path.exists(self._path(ContentIndex.FNAME)))
+    incoming = shutil.copy(self._path("dog.jpg"), self._path("downloaded.jpg", self.other_dir))
+    self.assertListEqual(index.find(incoming), ["dog.jpg"])
+    self.assertListEqual(index.find(self._path("dog.jpg")), [])
+    self.assertListEqual(index.find(os.path.join(MEDIA_FOLDER, "giphy.gif")), [])
+
+    moved = shutil.move(incoming, self.dir)
+    index.add(moved)
+    self.assertListEqual(index.find(self._path("pink_field.jpg", MEDIA_FOLDER)), ["pink_field.jpg"])
+    self.assertListEqual(index.find(self._path("dog.jpg", MEDIA_FOLDER)), ["dog.jpg", "downloaded.jpg"])
+
+  def test_find_deleted(self):
+    shutil.copy(self._path("dog.jpg"), self._path("dog_copy.jpg"))
+    index = ContentIndex(self.dir)
+    incoming = shutil.copy(self._path("dog.jpg"), self._path("downloaded.jpg", self.other_dir))
+    os.remove(self._path("dog.jpg"))
+    self.assertListEqual(index.find(incoming), ["dog_copy.jpg"])
+    self.assertNotIn("dog.jpg", index.df.index)
+    os.remove(self._path("dog_copy.jpg"))
+    self.assertListEqual(index.find(incoming), [])
+    self.assertNotIn("dog_copy.jpg", index.df.index)
+
+  def test_incremental_refresh(self):
+    ContentIndex(self.dir).duplicates()
+    shutil.copy(self._path("cat.mp4"), self._path("cat_copy.mp4"))
+    os.remove(self._path("pink_field.jpg"))
+    _add_jpeg_app_segment(self._path("dog.jpg"), b"edited")
+
+    index = ContentIndex(self.dir)
+    self.assertCountEqual(index.df.index, ["dog.jpg", "cat.mp4", "cat_copy.mp4"])
+    self.assertEqual(index.df.at["cat.mp4", "size"], os.path.getsize(self._path("cat.mp4")))
+    self.assertEqual(index.df.at["dog.jpg", "size"], os.path.getsize(self._path("dog.jpg")))
+    self.assertListEqual(index.duplicates(), [["cat.mp4", "cat_copy.mp4"]])
+    self.assertListEqual(ContentIndex(self.dir).duplicates(), [["cat.mp4", "cat_copy.mp4"]])
+
+  def test_duplicates(self):
+    shutil.copy(self._path("dog.jpg"), self._path("dog_2.jpg"))
+    shutil.copy(self._path("dog.jpg"), self._path("dog_3.jpg"))
+    _add_jpeg_app_segment(self._path("dog_3.jpg"), b"rated")
+    with open(self._path("fake.jpg"), 'wb') as f:  # same size and head, different tail
+      with open(self._path("pink_field.jpg"), 'rb') as src:
+        data = bytearray(src.read())
+      data[-3] ^= 0xFF
+      f.write(data)
+    self.assertListEqual(ContentIndex(self.dir).duplicates(), [["dog.jpg", "dog_2.jpg", "dog_3.jpg"]])
+
+
+if __name__ == "__main__":
+  unittest.main()
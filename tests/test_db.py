@@ -1,17 +1,21 @@
 import string
 import unittest
+import unittest.mock
 import os
 import random
+import shutil
+import time
 from math import sqrt
 import pandas as pd
 from pandas import testing as tm
 from ae_rater_model import DBAccess, RatingCompetition
 from ae_rater_types import MatchInfo, Outcome, ProfileInfo
-from prioritizers import PrioritizerType
-from rating_backends import ELO, Glicko
+from prioritizers import PrioritizerType, make_prioritizer
 
-from src.metadata import ManualMetadata, get_metadata
-from src.db_managers import MetadataManager
+from src.metadata import ManualMetadata, get_metadata, write_metadata
+import src.db_managers as db_managers
+from src.db_managers import HistoryManager, MetadataManager, _db_row, _scan_metadata
+from perceptual_index import PerceptualIndex
 import tests.helpers as hlp
 from tests.helpers import BACKUP_INITIAL_FILE, MEDIA_FOLDER, METAFILE, generate_outcome
 
@@ -34,7 +38,7 @@ class TestDBAccess(unittest.TestCase):
       MEDIA_FOLDER,
       refresh=False,
       prioritizer_type=PrioritizerType.DEFAULT,
-      rat_systems=[Glicko(),ELO()],
+      rat_systems=RatingCompetition().get_rat_systems(),
       history_fname='tst_history.csv'
     )
 
@@ -49,6 +53,14 @@ class TestDBAccess(unittest.TestCase):
       participants = self.dba.get_next_match(i)
       self.assertTrue(all_unique(participants))
 
+  def test_match_generation_matchmakers(self):
+    for prioritizer_type in [PrioritizerType.ACTIVE, PrioritizerType.BANDED]:
+      self.dba.meta_mgr.set_prioritizer(prioritizer_type)
+      for n in range(2,10):
+        participants = self.dba.get_next_match(n)
+        self.assertEqual(len(participants), n, prioritizer_type)
+        self.assertEqual(len({p.fullname for p in participants}), n, prioritizer_type)
+
   def test_get_leaderboard(self):
     ldbrd = self.dba.get_leaderboard()
     mediafiles = hlp.get_initial_mediafiles()
@@ -94,6 +106,31 @@ class TestDBAccess(unittest.TestCase):
           self.assertLessEqual(new_rating.rd, old_rating.rd)
           self.assertGreaterEqual(new_rating.timestamp, old_rating.timestamp)
 
+  def test_write_behind(self):
+    hlp.backup_files([os.path.join(MEDIA_FOLDER, f) for f in hlp.get_initial_mediafiles()])
+    dba = DBAccess(MEDIA_FOLDER, refresh=False, prioritizer_type=PrioritizerType.DEFAULT,
+                   rat_systems=RatingCompetition().get_rat_systems(), history_fname='tst_history.csv',
+                   write_behind=True)
+    competition = RatingCompetition()
+    matches = []
+    for _ in range(10):
+      n = random.randint(2, 8)
+      match = MatchInfo(dba.get_next_match(n), generate_outcome(n))
+      opinions, _ = competition.consume_match(match)
+      dba.apply_opinions(match.profiles, opinions)
+      dba.save_match(match)
+      matches.append(match)
+    dba.on_exit()
+    self.assertListEqual(dba.pop_write_failures(), [])
+
+    for prof in dba.get_leaderboard():
+      self.assertEqual(get_metadata(prof.fullname), ManualMetadata.from_str(prof.tags, int(prof.stars), prof.awards))
+    reloaded = DBAccess(MEDIA_FOLDER, refresh=False, prioritizer_type=PrioritizerType.DEFAULT,
+                        rat_systems=RatingCompetition().get_rat_systems(), history_fname='tst_history.csv')
+    self.assertDictEqual({p.fullname: p.nmatches for p in reloaded.get_leaderboard()},
+                         {p.fullname: p.nmatches for p in dba.get_leaderboard()})
+    self.assertListEqual([m.outcome.rawstr for m in reloaded.get_match_history()], [m.outcome.rawstr for m in matches])
+
   def _get_leaderboard_line(self, fullname:str) -> ProfileInfo:
     ldbrd = self.dba.get_leaderboard()
     return next(p for p in ldbrd if p.fullname==fullname)
@@ -152,6 +189,16 @@ class TestDBAccess(unittest.TestCase):
         stars = random.randint(0, 5),
     ))
 
+  def test_new_file(self):
+    extra = os.path.join(hlp.EXTRA_FOLDER, sorted(os.listdir(hlp.EXTRA_FOLDER))[0])
+    shutil.copy(extra, MEDIA_FOLDER)
+    dtypes = self.dba.meta_mgr.get_db().dtypes
+    self.dba.meta_mgr._sync_file(os.path.basename(extra))
+    tm.assert_series_equal(self.dba.meta_mgr.get_db().dtypes, dtypes)
+    self.dba.meta_mgr._reload_mirrors()
+    ldbrd = self.dba.get_leaderboard()
+    self.assertIn(os.path.join(MEDIA_FOLDER, os.path.basename(extra)), [p.fullname for p in ldbrd])
+
   def test_search_results(self):
     all_files = [os.path.join(MEDIA_FOLDER, f) for f in hlp.get_initial_mediafiles()]
     assert len(all_files) > 9, "need more samples for this test"
@@ -193,6 +240,47 @@ class TestDBAccess(unittest.TestCase):
     assert_searches("factors7 | 2#2 -2#2#", [4,7], "complex")
 
 
+class TestPrioritizers(unittest.TestCase):
+  def _make_db(self, n:int) -> pd.DataFrame:
+    return pd.DataFrame({
+      'stars': [random.uniform(0,5) for _ in range(n)],
+      'nmatches': [random.randint(0,60) for _ in range(n)],
+      'Glicko_rd': [random.choice([25,350]) for _ in range(n)],
+      'tags': ["" for _ in range(n)],
+      'awards': ["" for _ in range(n)],
+    }, index=[f"f{i}.jpg" for i in range(n)])
+
+  def test_active_prefers_informative_matches(self):
+    prioritizer = make_prioritizer(PrioritizerType.ACTIVE)
+    default = make_prioritizer(PrioritizerType.DEFAULT)
+    db = self._make_db(500).apply(prioritizer.calc, axis=1)
+    active_spread, active_rd, random_spread, random_rd = [], [], [], []
+    for _ in range(30):
+      match = prioritizer.pick(db, 6)
+      self.assertEqual(len(set(match.index)), 6)
+      active_spread.append(match['stars'].std())
+      active_rd.append(match['Glicko_rd'].mean())
+      match = default.pick(db, 6)
+      random_spread.append(match['stars'].std())
+      random_rd.append(match['Glicko_rd'].mean())
+    self.assertLess(sum(active_spread), sum(random_spread))
+    self.assertGreater(sum(active_rd), sum(random_rd))
+
+  def test_banded_keeps_matches_in_band(self):
+    prioritizer = make_prioritizer(PrioritizerType.BANDED)
+    db = self._make_db(500).apply(prioritizer.calc, axis=1)
+    prioritizer.track(db)
+    for _ in range(30):
+      match = prioritizer.pick(db, 6)
+      self.assertEqual(len(set(match.index)), 6)
+      self.assertLessEqual(match['stars'].max() - match['stars'].min(), 2*prioritizer.BAND)
+
+    for name in random.sample(list(db.index), 50):
+      db.loc[name, 'stars'] = random.uniform(0,5)
+      prioritizer.on_update(name, db.loc[name])
+    self.assertListEqual(prioritizer.sorted_keys, sorted((s, name) for name, s in db['stars'].items()))
+
+
 class TestMetadataManager(unittest.TestCase):
   def setUp(self) -> None:
     assert os.path.exists(MEDIA_FOLDER)
@@ -279,6 +367,113 @@ class TestMetadataManager(unittest.TestCase):
     mm = self._create_mgr()
     self._check_db(mm.get_db(), self.nfiles+CANARIES)
 
+  def test_parallel_scan(self):
+    fnames = [os.path.join(MEDIA_FOLDER, f) for f in self.initial_files]
+    serial = pd.DataFrame(_db_row(fname) for fname in fnames).set_index('name')
+    tm.assert_frame_equal(_scan_metadata(fnames, max_workers=8), serial)
+
+  def test_incremental_refresh(self):
+    mm0 = self._create_mgr()
+    renamed, modified = [os.path.join(MEDIA_FOLDER, f) for f in random.sample(self.initial_files, 2)]
+    hlp.backup_files([renamed, modified])
+    mm0.update(renamed, {}, matches_each=7)
+    mm0.on_exit()
+    self._create_mgr(refresh=True)
+    new_name = os.path.join(MEDIA_FOLDER, "renamed_"+os.path.basename(renamed))
+    os.rename(renamed, new_name)
+    meta = get_metadata(modified)
+    meta.stars = 5 - meta.stars
+    write_metadata(modified, meta)
+
+    read = []
+    db_row = db_managers._db_row
+    db_managers._db_row = lambda fname: read.append(fname) or db_row(fname)
+    try:
+      db1 = self._create_mgr(refresh=True).get_db()
+    finally:
+      db_managers._db_row = db_row
+      os.remove(new_name)
+    self.assertListEqual(read, [modified])
+    self.assertEqual(int(db1.loc[os.path.basename(modified), 'stars']), meta.stars)
+    self.assertTrue(db1.notna().all(axis=None))
+    self.assertNotIn(os.path.basename(renamed), db1.index)
+    self.assertEqual(db1.loc[os.path.basename(new_name), 'nmatches'], 7)
+    self.assertEqual(len(db1), self.nfiles)
+
+  def test_watch(self):
+    mm = self._create_mgr(watch=True)
+    try:
+      extra = os.path.join(hlp.EXTRA_FOLDER, random.choice(os.listdir(hlp.EXTRA_FOLDER)))
+      short_name = os.path.basename(extra)
+      shutil.copy(extra, MEDIA_FOLDER)
+      self._wait_for(lambda: short_name in mm.get_db().index, mm)
+      row, expected = mm.get_file_info(short_name), _db_row(os.path.join(MEDIA_FOLDER, short_name))
+      self.assertListEqual([row['tags'], row['stars'], row['awards']], [expected['tags'], expected['stars'], expected['awards']])
+      self.assertEqual(row['nmatches'], 0)
+
+      os.remove(os.path.join(MEDIA_FOLDER, short_name))
+      self._wait_for(lambda: short_name not in mm.get_db().index, mm)
+      self.assertEqual(len(mm.get_db()), self.nfiles)
+    finally:
+      mm.on_exit()
+
+  def test_watch_own_writes(self):
+    def touching_write(fullname, meta):
+      write_metadata(fullname, meta)
+      with open(fullname, 'r+b') as f:  # as a real xmp write would
+        f.write(f.read(1))
+    mm = self._create_mgr(watch=True)
+    try:
+      short_name = mm.get_db().index[0]
+      hlp.backup_files([os.path.join(MEDIA_FOLDER, short_name)])
+      with unittest.mock.patch.object(db_managers, 'write_metadata', touching_write):
+        mm.update(os.path.join(MEDIA_FOLDER, short_name), {'nmatches': 3})
+      version = mm.version
+      deadline = time.time() + 2
+      while time.time() < deadline:
+        mm.apply_fs_events()
+        time.sleep(0.1)
+      self.assertEqual(mm.version, version, "own writes are not external changes")
+      self.assertListEqual(list(mm.get_file_info(short_name)[db_managers.FINGERPRINT_COLS]),
+                           db_managers._fingerprint(os.path.join(MEDIA_FOLDER, short_name)))
+    finally:
+      mm.on_exit()
+
+  def test_watch_move_over(self):
+    mm = self._create_mgr(watch=True)
+    try:
+      src, dst = mm.get_db().index[:2]
+      hlp.backup_files([os.path.join(MEDIA_FOLDER, src), os.path.join(MEDIA_FOLDER, dst)])
+      mm.update(os.path.join(MEDIA_FOLDER, src), {'nmatches': 7})
+      os.replace(os.path.join(MEDIA_FOLDER, src), os.path.join(MEDIA_FOLDER, dst))
+      self._wait_for(lambda: src not in mm.get_db().index, mm)
+      self.assertEqual(mm.get_file_info(dst)['nmatches'], 7)
+      self.assertEqual(len(mm.get_db()), self.nfiles-1)
+    finally:
+      mm.on_exit()
+
+  def test_near_duplicates(self):
+    copy = shutil.copy(os.path.join(MEDIA_FOLDER, "dog.jpg"), os.path.join(MEDIA_FOLDER, "dog_copy.jpg"))
+    try:
+      mm = self._create_mgr(similarity=PerceptualIndex(MEDIA_FOLDER))
+      self.assertCountEqual(mm.get_search_results("~dog.jpg", 10).index, ["dog.jpg", "dog_copy.jpg"])
+      self.assertNotIn("dog_copy.jpg", mm.get_search_results("jpg -~dog.jpg", 100).index)
+      for _ in range(10):
+        sample = mm.get_rand_files_info(self.nfiles)
+        self.assertEqual(len(set(sample.index)), self.nfiles)
+        self.assertFalse({"dog.jpg", "dog_copy.jpg"}.issubset(sample.index))
+    finally:
+      os.remove(copy)
+
+  def _wait_for(self, condition, mm:MetadataManager, timeout:float=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      mm.apply_fs_events()
+      if condition():
+        return
+      time.sleep(0.1)
+    self.fail("watcher did not deliver the change")
+
   def test_init_no_refresh(self):            self._test_external_change(True, True, False)
   def test_init_updated_files(self):         self._test_external_change(True, False, True)
   def test_init_extra_files(self):           self._test_external_change(False, True, True)
@@ -356,6 +551,68 @@ class TestMetadataManager(unittest.TestCase):
       row_next_run = mm1.get_file_info(short_name)
       tm.assert_series_equal(row_next_run, row_after)
 
+  def test_update_log(self):
+    mm = self._create_mgr()
+    updated = {}
+    for short_name in random.sample(self.initial_files, self.nfiles//3):
+      fullname = os.path.join(MEDIA_FOLDER, short_name)
+      hlp.backup_files([fullname])
+      mm.update(fullname, {'elo': random.randint(0,2000), 'stars': random.randint(0,5)}, random.randint(0,17))
+      updated[short_name] = mm.get_file_info(short_name)
+    self.assertTrue(os.path.exists(mm.update_log.fname))
+    del mm  # no commit, as if the program crashed
+
+    mm1 = self._create_mgr()
+    self.assertFalse(os.path.exists(mm1.update_log.fname))
+    for short_name, row in updated.items():
+      tm.assert_series_equal(mm1.get_file_info(short_name).drop('priority'), row.drop('priority'))
+
+  def test_update_log_synced(self):
+    mm = self._create_mgr()
+    names = random.sample(self.initial_files, 4)
+    hlp.backup_files([os.path.join(MEDIA_FOLDER, name) for name in names])
+    with unittest.mock.patch.object(db_managers.os, 'fsync', wraps=db_managers.os.fsync) as fsync:
+      for name in names[:3]:
+        mm.update(os.path.join(MEDIA_FOLDER, name), {}, 1)
+      self.assertEqual(fsync.call_count, 1, "batched, also without a write-behind worker")
+      mm.update_log.last_sync -= mm.update_log.SYNC_INTERVAL
+      mm.update(os.path.join(MEDIA_FOLDER, names[3]), {}, 1)
+      self.assertEqual(fsync.call_count, 2)
+
+  def test_frequent_tags(self):
+    mm = self._create_mgr()
+    fullname = os.path.join(MEDIA_FOLDER, self.initial_files[0])
+    hlp.backup_files([fullname])
+    mm.update(fullname, {'tags': "rare_tag " + mm.get_file_info(self.initial_files[0])['tags']})
+    tag_lists = mm.get_db()['tags'].str.split()
+    for min_freq in [1, 2, 3]:
+      freq = pd.concat([pd.Series(l, dtype=object) for l in tag_lists]).value_counts()
+      frequent = set(freq[freq >= min_freq].index)
+      self.assertSetEqual(set(mm._get_frequent_tags(min_freq).index), frequent)
+      filtered = mm.get_db(min_tag_freq=min_freq)['tags']
+      for name, tags in tag_lists.items():
+        self.assertListEqual(filtered[name].split(), sorted(t for t in tags if t in frequent))
+    self.assertNotIn("rare_tag", mm.get_db(min_tag_freq=2).loc[self.initial_files[0], 'tags'])
+
+  def test_search_tag_matrix(self):
+    mm = self._create_mgr()
+    db = mm.get_db()
+    def by_rows(query:str) -> list[str]:  # each row searched as strings
+      def has(name, row, word):
+        return pd.concat([row, pd.Series({'name': name})]).astype(str).str.contains(word).any()
+      return [name for name, row in db.iterrows()
+              if any(all(has(name, row, w) for w in sub.split() if not w.startswith('-')) and
+                     not any(has(name, row, w[1:]) for w in sub.split() if w.startswith('-'))
+                     for sub in query.split('|'))]
+    queries = ["lighting", "ghtin -mood", "subject|hair", "eyes|jpeg -light", "g.c", "^mood", "g c", "5 -comp"]
+    with unittest.mock.patch.object(mm.tag_matrix, 'has_any', wraps=mm.tag_matrix.has_any) as has_any:
+      for query in queries:
+        self.assertListEqual(list(mm.get_search_results(query, 999).index), by_rows(query), query)
+    self.assertEqual(has_any.call_count, 12, "plain words are looked up in the tag matrix")
+    order = list(reversed(db.index))
+    self.assertListEqual(list(mm.get_search_results("mood", 2, 2, order=order).index),
+                         [n for n in order if n in by_rows("mood")][2:4])
+
   def test_rename(self):
     mm = self._create_mgr()
     all_files = [os.path.join(MEDIA_FOLDER, f) for f in self.initial_files]
@@ -400,5 +657,39 @@ class TestMetadataManager(unittest.TestCase):
     self.assertRaises(KeyError, mm.delete, "sks_nonexistant")
 
 
+class TestHistoryManager(unittest.TestCase):
+  HIST_FNAME = 'tst_history.csv'
+
+  def tearDown(self) -> None:
+    hlp.disk_cleanup()
+
+  def test_torn_append(self):
+    hm = HistoryManager(MEDIA_FOLDER, self.HIST_FNAME)
+    for i in range(5):
+      hm.save_match(time.time(), str([f"{i}.jpg", "b.jpg"]), "a b")
+    with open(hm.matches_fname, 'a') as f:
+      f.write('1700000000.5,"[\'half.jpg\', \'ha')
+    hm = HistoryManager(MEDIA_FOLDER, self.HIST_FNAME)
+    self.assertEqual(len(hm.get_match_history()), 5)
+    hm.save_match(time.time(), str(["c.jpg", "d.jpg"]), "ab")
+    self.assertEqual(len(HistoryManager(MEDIA_FOLDER, self.HIST_FNAME).get_match_history()), 6)
+
+  def test_no_final_newline(self):
+    hm = HistoryManager(MEDIA_FOLDER, self.HIST_FNAME)
+    for i in range(2):
+      hm.save_match(time.time(), str([f"{i}.jpg", "b.jpg"]), "a b")
+    with open(hm.matches_fname, 'rb+') as f:  # as saved by an editor
+      f.truncate(f.seek(0, os.SEEK_END)-1)
+    hm = HistoryManager(MEDIA_FOLDER, self.HIST_FNAME)
+    self.assertEqual(len(hm.get_match_history()), 2)
+    hm.save_match(time.time(), str(["c.jpg", "d.jpg"]), "ab")
+    self.assertEqual(len(HistoryManager(MEDIA_FOLDER, self.HIST_FNAME).get_match_history()), 3)
+
+    with open(hm.matches_fname, 'w') as f:
+      f.write("timestamp,particip")
+    HistoryManager(MEDIA_FOLDER, self.HIST_FNAME)
+    self.assertTrue(os.path.exists(hm.matches_fname), "a history file is never deleted")
+
+
 if __name__ == '__main__':
   unittest.main()
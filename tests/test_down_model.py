@@ -0,0 +1,147 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import down_model
+from down_model import Converter, Usher, UsherCfg
+from fs_watcher import DirWatcher
+from metadata import ManualMetadata, get_metadata, write_metadata
+from tests.helpers import MEDIA_FOLDER
+
+
+def fake_convert(fullname:str) -> str:
+  """the test files are jpegs already, whatever their extension"""
+  time.sleep(0.2)
+  converted_name = os.path.splitext(fullname)[0] + ".jpg"
+  assert not os.path.exists(converted_name)
+  shutil.copy(fullname, converted_name)
+  return converted_name
+
+
+class TestConverter(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fullname = os.path.join(self.dir, "pic.png")
+    shutil.copy(os.path.join(MEDIA_FOLDER, "dog.jpg"), self.fullname)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_concurrent(self):
+    converter = Converter(max_workers=2)
+    start = threading.Barrier(2)
+    results = queue.SimpleQueue()
+    def convert():
+      start.wait()
+      results.put(converter.convert(self.fullname))
+    with patch.object(converter, '_convert_impl', side_effect=fake_convert) as impl:
+      threads = [threading.Thread(target=convert) for _ in range(2)]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+    self.assertEqual(impl.call_count, 1, "one conversion for both callers")
+    expected = os.path.join(self.dir, "pic.jpg")
+    self.assertListEqual([results.get_nowait(), results.get_nowait()], [expected]*2)
+    self.assertFalse(converter.is_converting(self.fullname))
+    self.assertListEqual(converter.outputs(os.path.join(self.dir, "a.webp")),
+                         [os.path.join(self.dir, "a.jpg"), os.path.join(self.dir, "a.mp4")])
+
+
+class FakeGui:
+  def __init__(self, assistant=None) -> None:
+    self.shown = []
+
+  def show_editor(self, fullname, suggested_tags=None, existing_meta=None):
+    self.shown.append(os.path.basename(fullname))
+    meta = ManualMetadata({"lighting"}, 3)
+    write_metadata(fullname, meta)
+    return meta
+
+
+class TestUsher(unittest.TestCase):
+  NAMES = ["doggy.jpg", "pink_field.jpg", "a cat.jpg", "kitty.png"]
+
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    dirs = [os.path.join(self.dir, d) for d in ("buffer", "uncateg", "dest")]
+    for d in dirs:
+      os.mkdir(d)
+    self.cfg = UsherCfg(*dirs)
+    sources = ["dog.jpg", "pink_field.jpg", "9a8219a087f481414ef986e2b76fc358.jpg", "006f129e1d4baaa9cd5e766d06256f58.jpg"]
+    for src, name in zip(sources, self.NAMES):
+      shutil.copy(os.path.join(MEDIA_FOLDER, src), self.buffer(name))
+    for target, value in [('DownGui', FakeGui), ('Assistant', unittest.mock.DEFAULT), ('send2trash', os.remove)]:
+      patcher = patch.object(down_model, target, value)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    self.usher = Usher(self.cfg, catch_up_n=0)
+    self.usher.assistant.suggest_tags.return_value = []
+    self.usher.SETTLE = 0.3
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def buffer(self, name:str) -> str:
+    return os.path.join(self.cfg.buffer_dir, name)
+
+  def test_pipeline(self):
+    for name in os.listdir(self.cfg.buffer_dir):
+      self.assertTrue(self.usher._enqueue(name))
+      self.assertFalse(self.usher._enqueue(name), "queued once")
+    with patch.object(self.usher.converter, '_convert_impl', side_effect=fake_convert):
+      self.usher._convert_backlog()
+      self.usher.converter.convert_async(self.buffer("kitty.png")).result()  # done before its turn comes
+      self.usher.process_recent_files(len(self.NAMES))
+    self.assertListEqual(sorted(f for f in os.listdir(self.cfg.buffer_dir) if not f.startswith('.')), [])
+    moved = sorted(f for f in os.listdir(self.cfg.dest_dir) if f != self.usher.content_index.FNAME)
+    self.assertListEqual(moved, ["a_cat.jpg", "doggy.jpg", "kitty.jpg", "pink_field.jpg"])
+    self.assertTrue(all(get_metadata(os.path.join(self.cfg.dest_dir, f)).tags for f in moved))
+    self.assertTrue(set(self.usher.gui.shown) <= set(moved))
+    self.assertSetEqual(self.usher.owned, set(), "released once gone from the buffer")
+
+  def _wait_in_background(self) -> tuple[threading.Thread,queue.SimpleQueue]:
+    done = queue.SimpleQueue()
+    thread = threading.Thread(target=lambda: done.put((self.usher._wait_for_files(), time.monotonic())), daemon=True)
+    thread.start()
+    return thread, done
+
+  def test_wait_for_files(self):
+    for name in os.listdir(self.cfg.buffer_dir):
+      self.usher._enqueue(name)
+    watcher = DirWatcher(self.cfg.buffer_dir, self.usher.fs_events.put, debounce=0.05).start()
+    try:
+      thread, done = self._wait_in_background()
+      names = [self.buffer("a cat.jpg")]
+      self.usher._robust_rename(names[0], names)
+      write_metadata(self.buffer("doggy.jpg"), ManualMetadata({"lighting"}, 3))
+      os.remove(self.buffer("pink_field.jpg"))
+      thread.join(1.5)
+      self.assertTrue(thread.is_alive(), "Usher's own changes are no new downloads")
+      self.assertEqual(len(self.usher.pending), len(self.NAMES))
+
+      with open(os.path.join(MEDIA_FOLDER, "7b3034aa37fe6af5b8d1ec770d8d2bf5.jpg"), 'rb') as src:
+        data = src.read()
+      with open(self.buffer("new.jpg"), 'wb') as f:  # still downloading
+        for start in range(0, len(data), len(data)//4):
+          f.write(data[start:start+len(data)//4])
+          f.flush()
+          time.sleep(0.2)
+      last_write = time.monotonic()
+      thread.join(10)
+      queued, finished = done.get_nowait()
+      self.assertEqual(queued, 1)
+      self.assertGreaterEqual(finished-last_write, self.usher.SETTLE-0.2, "not before the download settles")
+      self.assertEqual([f for _, f in self.usher.pending].count(self.buffer("new.jpg")), 1)
+      self.assertFalse(self.usher._enqueue("new.jpg"))
+    finally:
+      watcher.stop()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,100 @@
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+
+from fs_watcher import DirWatcher, FsEvent, FsEventKind, coalesce
+
+CREATED, MODIFIED, MOVED, DELETED = FsEventKind.CREATED, FsEventKind.MODIFIED, FsEventKind.MOVED, FsEventKind.DELETED
+
+
+class TestCoalesce(unittest.TestCase):
+  def test_single_events_pass(self):
+    events = [FsEvent(CREATED, "a"), FsEvent(MODIFIED, "b"), FsEvent(MOVED, "d", "c"), FsEvent(DELETED, "e")]
+    self.assertListEqual(coalesce(events), events)
+
+  def test_created_then_written(self):
+    self.assertListEqual(coalesce([FsEvent(CREATED, "a"), FsEvent(MODIFIED, "a"), FsEvent(MODIFIED, "a")]),
+                         [FsEvent(CREATED, "a")])
+
+  def test_temporary_file(self):
+    self.assertListEqual(coalesce([FsEvent(CREATED, "a.part"), FsEvent(MODIFIED, "a.part"), FsEvent(DELETED, "a.part")]), [])
+
+  def test_download_renamed_when_done(self):
+    self.assertListEqual(coalesce([FsEvent(CREATED, "a.part"), FsEvent(MOVED, "a.jpg", "a.part")]),
+                         [FsEvent(CREATED, "a.jpg")])
+
+  def test_chained_moves(self):
+    self.assertListEqual(coalesce([FsEvent(MOVED, "b", "a"), FsEvent(MOVED, "c", "b")]),
+                         [FsEvent(MOVED, "c", "a")])
+    self.assertListEqual(coalesce([FsEvent(MOVED, "b", "a"), FsEvent(DELETED, "b")]),
+                         [FsEvent(DELETED, "a")])
+
+  def test_replaced(self):
+    self.assertListEqual(coalesce([FsEvent(DELETED, "a"), FsEvent(CREATED, "a")]),
+                         [FsEvent(MODIFIED, "a")])
+
+
+class TestDirWatcher(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.batches = queue.SimpleQueue()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def _next_batch(self) -> list[FsEvent]:
+    return self.batches.get(timeout=10)
+
+  def _check_backend(self, force_polling:bool):
+    path = lambda name: os.path.join(self.dir, name)
+    with open(path("old.jpg"), 'w') as f:
+      f.write("old")
+    watcher = DirWatcher(self.dir, self.batches.put, debounce=0.1, poll_interval=0.05,
+                         force_polling=force_polling).start()
+    try:
+      with open(path("new.jpg"), 'w') as f:
+        f.write("new")
+      self.assertListEqual(self._next_batch(), [FsEvent(CREATED, "new.jpg")])
+
+      os.rename(path("new.jpg"), path("renamed.jpg"))
+      self.assertListEqual(self._next_batch(), [FsEvent(MOVED, "renamed.jpg", "new.jpg")])
+
+      with open(path("old.jpg"), 'a') as f:
+        f.write("more")
+      self.assertListEqual(self._next_batch(), [FsEvent(MODIFIED, "old.jpg")])
+
+      os.remove(path("renamed.jpg"))
+      self.assertListEqual(self._next_batch(), [FsEvent(DELETED, "renamed.jpg")])
+    finally:
+      watcher.stop()
+
+  def test_inotify(self):
+    self._check_backend(force_polling=False)
+
+  def test_polling(self):
+    self._check_backend(force_polling=True)
+
+  def test_polling_same_dir_mtime(self):
+    path = lambda name: os.path.join(self.dir, name)
+    with open(path("old.jpg"), 'w') as f:
+      f.write("old")
+    watcher = DirWatcher(self.dir, self.batches.put, debounce=0.1, poll_interval=0.05, force_polling=True).start()
+    try:
+      st = os.stat(self.dir)
+      with open(path("new.jpg"), 'w') as f:
+        f.write("new")
+      with open(path("old.jpg"), 'a') as f:
+        f.write("more")
+      os.utime(self.dir, ns=(st.st_atime_ns, st.st_mtime_ns))
+      batch = self._next_batch()
+      while len(batch) < 2:
+        batch += self._next_batch()
+      self.assertCountEqual(batch, [FsEvent(CREATED, "new.jpg"), FsEvent(MODIFIED, "old.jpg")])
+    finally:
+      watcher.stop()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 import os
 import shutil
+import tempfile
 
 from metadata import *
 from tests.helpers import MEDIA_FOLDER
@@ -24,6 +25,45 @@ class TestReadingMetadata(unittest.TestCase):
     self._test_metadata_read("no_metadata.JPG", ManualMetadata())
 
 
+class TestLeafTags(unittest.TestCase):
+  VOCAB = ["lighting", "lighting|contrast", "composition", "composition|contrast", "composition|frames",
+           "genre", "genre|street", "genre|street|night"]
+
+  def _resolve(self, leaves:list[str]) -> list[str]:
+    return resolve_leaf_tags(leaves, build_leaf_index(self.VOCAB))
+
+  def test_unique_leaves(self):
+    self.assertListEqual(self._resolve(["composition", "frames", "genre", "street", "night"]),
+                         ["composition", "composition|frames", "genre", "genre|street", "genre|street|night"])
+
+  def test_ambiguous_leaves(self):
+    self.assertListEqual(self._resolve(["composition", "contrast"]), ["composition", "composition|contrast"])
+    self.assertListEqual(self._resolve(["contrast", "lighting"]), ["lighting|contrast", "lighting"])
+    self.assertListEqual(self._resolve(["contrast"]), ["lighting|contrast"])
+
+  def test_unknown_and_full_tags(self):
+    self.assertListEqual(self._resolve(["trast", "rain", "genre|street"]), ["trast", "rain", "genre|street"])
+
+
+class TestXmpPacket(unittest.TestCase):
+  def test_find_packet(self):
+    packet = find_xmp_packet(os.path.join(MEDIA_FOLDER, "fixed/fixed_metadata_test.jpeg"))
+    self.assertTrue(packet.startswith(b"<?xpacket begin"))
+    self.assertTrue(packet.endswith(b"?>"))
+    self.assertIn(b"hierarchicalSubject", packet)
+    self.assertIsNone(find_xmp_packet(os.path.join(MEDIA_FOLDER, "fixed/no_metadata.JPG")))
+
+  def test_packet_position(self):
+    packet = find_xmp_packet(os.path.join(MEDIA_FOLDER, "fixed/fixed_metadata_test.jpeg"))
+    padding = b"\0" * 2*XMP_SCAN_BYTES
+    for content, expected in [(padding+packet, packet), (packet[:100]+padding+packet[100:], None),
+                              (padding+packet+padding, None)]:
+      with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+        f.write(content)
+        f.flush()
+        self.assertEqual(find_xmp_packet(f.name), expected)
+
+
 class TestWritingMetadata(unittest.TestCase):
   def setUp(self):
     original = os.path.join(MEDIA_FOLDER, "fixed/no_metadata.JPG")
@@ -57,5 +97,51 @@ class TestWritingMetadata(unittest.TestCase):
     self.assertEqual(get_metadata(self.fname), meta2)
 
 
+class TestSidecars(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.fname = os.path.join(self.dir, "pic.jpg")
+    shutil.copyfile(os.path.join(MEDIA_FOLDER, "fixed/fixed_metadata_test.jpeg"), self.fname)
+    self.embedded = get_metadata(self.fname)
+
+  def tearDown(self):
+    set_sidecar_policy(SidecarPolicy())
+    shutil.rmtree(self.dir)
+
+  def test_policy(self):
+    self.assertFalse(SidecarPolicy().wants_sidecar(self.fname))
+    self.assertTrue(SidecarPolicy(extensions=('mp4', 'jpg')).wants_sidecar(self.fname))
+    self.assertFalse(SidecarPolicy(extensions=('mp4',)).wants_sidecar(self.fname))
+    size = os.path.getsize(self.fname)
+    self.assertTrue(SidecarPolicy(min_size=size).wants_sidecar(self.fname))
+    self.assertFalse(SidecarPolicy(min_size=size+1).wants_sidecar(self.fname))
+
+  def test_write_to_sidecar(self):
+    set_sidecar_policy(SidecarPolicy(extensions=('jpg',)))
+    meta = ManualMetadata({"mood", "mood|epic"}, 3, {"wallpaper"})
+    write_metadata(self.fname, meta)
+    self.assertTrue(os.path.exists(sidecar_name(self.fname)))
+    self.assertEqual(get_metadata(self.fname), meta)
+    self.assertListEqual(sorted(os.listdir(self.dir)), ["pic.jpg", "pic.jpg.xmp"])
+
+    set_sidecar_policy(SidecarPolicy())
+    meta.stars = 4
+    write_metadata(self.fname, meta)  # an existing sidecar sticks
+    self.assertEqual(get_metadata(self.fname), meta)
+    os.remove(sidecar_name(self.fname))
+    self.assertEqual(get_metadata(self.fname), self.embedded)
+
+  def test_migrate_and_embed(self):
+    move_to_sidecar(self.fname)
+    self.assertTrue(os.path.exists(sidecar_name(self.fname)))
+    self.assertEqual(get_metadata(self.fname), self.embedded)
+
+    meta = ManualMetadata({"color"}, 5, set())
+    write_metadata(self.fname, meta)
+    embed_sidecar(self.fname)
+    self.assertFalse(os.path.exists(sidecar_name(self.fname)))
+    self.assertEqual(get_metadata(self.fname), meta)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -4,7 +4,7 @@ import os
 import pandas as pd
 import random
 import string
-from ae_rater import Controller, FromHistoryController
+from ae_rater import BatchFitController, Controller, FromHistoryController
 
 from ae_rater_types import DiagnosticInfo, MatchInfo, Outcome, ProfileInfo
 from ae_rater_model import RatingCompetition
@@ -132,6 +132,69 @@ class TestLongTerm(unittest.TestCase):
     )
 
 
+  def test_history_checkpoints(self):
+    HIST_FNAME = 'test_history_checkpoints.csv'
+    CHECKPOINT_EVERY = 16
+    start_time = time.time() + 100
+    shnames = [os.path.basename(f) for f in self.all_files]
+    hist_data = []
+    for i in range(60):
+      n = random.randint(2,6)
+      hist_data.append([start_time + 0.1*i, str(random.sample(shnames, n)), hlp.generate_outcome(n).tiers])
+    history = pd.DataFrame(hist_data, columns=["timestamp","names","outcome"])
+
+    def run_history_replay(from_scratch:bool) -> tuple[list[ProfileInfo], int]:
+      history.to_csv(os.path.join(MEDIA_FOLDER, HIST_FNAME), index=False)
+      ctrl = FromHistoryController(MEDIA_FOLDER, HIST_FNAME)
+      ctrl.CHECKPOINT_EVERY = CHECKPOINT_EVERY
+      replayed = []
+      process_match = ctrl.process_match
+      ctrl.process_match = lambda match: replayed.append(match) or process_match(match)
+      ctrl.run(with_diagnostics=False, from_scratch=from_scratch)
+      return list(ctrl.db.get_leaderboard()), len(replayed)
+
+    _, n_replayed = run_history_replay(from_scratch=False)
+    self.assertEqual(n_replayed, len(history))
+
+    fixed_idx = 40
+    n = len(eval(history.loc[fixed_idx, 'names']))
+    fixed_outcome = ' '.join(string.ascii_lowercase[:n][::-1])
+    if history.loc[fixed_idx, 'outcome'] == fixed_outcome:
+      fixed_outcome = string.ascii_lowercase[:n]
+    history.loc[fixed_idx, 'outcome'] = fixed_outcome
+    ldbrd_incremental, n_replayed = run_history_replay(from_scratch=False)
+    self.assertEqual(n_replayed, len(history) - fixed_idx//CHECKPOINT_EVERY*CHECKPOINT_EVERY)
+
+    ldbrd_full, n_replayed = run_history_replay(from_scratch=True)
+    self.assertEqual(n_replayed, len(history))
+    self.assertListEqual(ldbrd_incremental, ldbrd_full)
+
+  def test_batch_fit(self):
+    HIST_FNAME = 'test_history_batch.csv'
+    shnames = [os.path.basename(f) for f in random.sample(self.all_files, 5)]
+    start_time = time.time() + 100
+    hist_data = []
+    for i in range(40):
+      n = random.randint(2,5)
+      players = sorted(random.sample(range(len(shnames)), n))
+      hist_data.append([start_time + 0.1*i, str([shnames[p] for p in players]), ' '.join(string.ascii_lowercase[:n])])
+    history = pd.DataFrame(hist_data, columns=["timestamp","names","outcome"])
+
+    def fit(history:pd.DataFrame) -> list[int]:
+      history.to_csv(os.path.join(MEDIA_FOLDER, HIST_FNAME), index=False)
+      ctrl = BatchFitController(MEDIA_FOLDER, HIST_FNAME)
+      ctrl.run()
+      sysname = ctrl.competition.get_batch_systems()[0].name()
+      return [ctrl.db.get_profile(os.path.join(MEDIA_FOLDER, shname)).ratings[sysname] for shname in shnames]
+
+    ratings = fit(history)
+    for stronger, weaker in zip(ratings, ratings[1:]):
+      self.assertGreater(stronger.points, weaker.points)
+    shuffled_ratings = fit(history.sample(frac=1))
+    for rat, shuffled_rat in zip(ratings, shuffled_ratings):
+      self.assertAlmostEqual(rat.points, shuffled_rat.points, delta=1)
+      self.assertAlmostEqual(rat.rd, shuffled_rat.rd, delta=1)
+
   @unittest.skipIf(*SKIPLONG)
   def test_history_repeats(self):
     HIST_FNAME = 'test_history_long.csv'
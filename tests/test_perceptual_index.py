@@ -0,0 +1,79 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from PIL import Image, ImageOps
+
+from perceptual_index import BKTree, PerceptualIndex, hamming
+from tests.helpers import MEDIA_FOLDER
+
+
+class TestBKTree(unittest.TestCase):
+  def test_find_matches_brute_force(self):
+    hashes = [random.getrandbits(64) for _ in range(500)]
+    hashes += [h ^ (1 << random.randrange(64)) for h in hashes[:100]]  # close relatives
+    tree = BKTree()
+    for i, h in enumerate(hashes):
+      tree.add(h, i)
+    for radius in [0, 3, 20]:
+      for h in random.sample(hashes, 50):
+        expected = sorted((hamming(h, other), i) for i, other in enumerate(hashes) if hamming(h, other) <= radius)
+        self.assertListEqual(sorted(tree.find(h, radius)), expected)
+
+
+class TestPerceptualIndex(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    for name in ["dog.jpg", "pink_field.jpg", "giphy.gif", "Screenshot_from_2023_02_23_19_26_20.jpg"]:
+      shutil.copy(os.path.join(MEDIA_FOLDER, name), self.dir)
+    with Image.open(os.path.join(self.dir, "dog.jpg")) as img:
+      img.resize((img.width//3, img.height//3)).save(os.path.join(self.dir, "dog_small.jpg"), quality=60)
+      ImageOps.mirror(img).save(os.path.join(self.dir, "dog_mirrored.jpg"))
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_similar(self):
+    index = PerceptualIndex(self.dir)
+    self.assertTrue(os.path.exists(os.path.join(self.dir, PerceptualIndex.FNAME)))
+    self.assertListEqual(index.similar("dog.jpg"), ["dog_small.jpg"])
+    self.assertListEqual(index.similar("dog_small.jpg"), ["dog.jpg"])
+    self.assertListEqual(index.similar("pink_field.jpg"), [])
+    self.assertTrue(index.are_similar("dog.jpg", "dog_small.jpg"))
+    self.assertFalse(index.are_similar("dog.jpg", "dog_mirrored.jpg"))
+    self.assertListEqual(index.groups(), [["dog.jpg", "dog_small.jpg"]])
+
+  def test_incremental(self):
+    PerceptualIndex(self.dir)
+    os.remove(os.path.join(self.dir, "dog_small.jpg"))
+    shutil.copy(os.path.join(self.dir, "pink_field.jpg"), os.path.join(self.dir, "pink_copy.jpg"))
+    with open(os.path.join(self.dir, "dog.jpg"), 'ab') as f:
+      f.write(b"trailing garbage")  # changes the content key, not the picture
+
+    index = PerceptualIndex(self.dir, refresh=False)
+    self.assertNotIn("pink_copy.jpg", index.hashes)
+    index = PerceptualIndex(self.dir)
+    self.assertNotIn("dog_small.jpg", index.hashes)
+    self.assertListEqual(index.groups(), [["pink_copy.jpg", "pink_field.jpg"]])
+
+  def test_update(self):
+    index = PerceptualIndex(self.dir)
+    os.remove(os.path.join(self.dir, "dog_small.jpg"))
+    shutil.copy(os.path.join(self.dir, "pink_field.jpg"), os.path.join(self.dir, "pink_copy.jpg"))
+    index.update(["dog_small.jpg", "pink_copy.jpg", "dog.jpg"])
+    self.assertListEqual(index.groups(), [["pink_copy.jpg", "pink_field.jpg"]])
+    self.assertListEqual(PerceptualIndex(self.dir, refresh=False).groups(), [["pink_copy.jpg", "pink_field.jpg"]])
+
+  def test_background(self):
+    index = PerceptualIndex(self.dir, background=True)
+    deadline = time.time() + 10
+    while not index.hashes and time.time() < deadline:
+      time.sleep(0.05)
+    with index.lock:  # the refresh is done
+      self.assertListEqual(index.similar("dog.jpg"), ["dog_small.jpg"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,105 @@
+import random
+import unittest
+import numpy as np
+import pandas as pd
+
+from ae_rater_types import ProfileInfo, Rating
+from profile_store import Profiles, ProfileStore, schema_errors
+
+
+SYSTEMS = ['ELO', 'Glicko']
+
+def make_db(n:int) -> pd.DataFrame:
+  df = pd.DataFrame({
+    'tags': [random.choice(["", "a", "a b", "a b|c"]) for _ in range(n)],
+    'stars': [random.randint(0, 50)/10 for _ in range(n)],
+    'nmatches': np.random.randint(0, 100, n),
+    'priority': np.random.rand(n),
+    'awards': [random.choice(["", "e_a", "wallpaper"]) for _ in range(n)],
+  }, index=pd.Index([f"f{i}.jpg" for i in range(n)], name='name'))
+  for s in SYSTEMS:
+    df[s+'_pts'] = np.random.randint(1000, 2000, n)
+    df[s+'_rd'] = np.random.randint(0, 300, n)
+    df[s+'_time'] = np.random.rand(n)*1e9
+  return df
+
+def expected_profile(df:pd.DataFrame, name:str) -> ProfileInfo:
+  row = df.loc[name]
+  return ProfileInfo(f"/media/{name}", row['tags'], row['stars'],
+                     {s: Rating(row[s+'_pts'], row[s+'_rd'], row[s+'_time']) for s in SYSTEMS},
+                     row['nmatches'], row['awards'])
+
+
+class TestProfileStore(unittest.TestCase):
+  def setUp(self):
+    self.df = make_db(300)
+    self.store = ProfileStore("/media", SYSTEMS)
+    self.store.load(self.df)
+
+  def test_profiles(self):
+    for name in random.sample(list(self.df.index), 30):
+      self.assertEqual(self.store.get(name), expected_profile(self.df, name))
+    self.assertRaises(KeyError, self.store.get, "nonexistent.jpg")
+    self.assertFalse(hasattr(self.store.get("f0.jpg"), '__dict__'))
+
+  def test_set_row(self):
+    row = self.df.loc["f7.jpg"].copy()
+    row[['stars', 'nmatches', 'tags', 'Glicko_pts']] = [4.5, 3, "new tags", 1234]
+    self.store.set_row("f7.jpg", row)
+    self.df.loc["f7.jpg"] = row
+    self.assertEqual(self.store.get("f7.jpg"), expected_profile(self.df, "f7.jpg"))
+
+  def test_ranking(self):
+    ranking = self.store.ranking(SYSTEMS)
+    self.assertIsInstance(ranking, Profiles)
+    expected = self.df.sort_values(['stars', 'ELO_pts', 'Glicko_pts', 'awards'], ascending=False)
+    self.assertListEqual([p.fullname for p in ranking], [f"/media/{name}" for name in expected.index])
+    self.assertEqual(ranking.total_matches(), self.df['nmatches'].sum())
+    for i in random.sample(range(len(ranking)), 10):
+      self.assertEqual(ranking.rank_of(ranking[i].fullname), i)
+    self.assertListEqual(ranking[5:8], [ranking[5], ranking[6], ranking[7]])
+
+
+  def test_stale_view(self):
+    ranking = self.store.ranking(SYSTEMS)
+    row = self.df.iloc[0].copy()
+    row['nmatches'] += 1
+    self.store.set_row(self.df.index[0], row)
+    self.assertEqual(ranking.total_matches(), self.df['nmatches'].sum()+1, "sees updates of rows")
+    order = [p.fullname for p in ranking]
+    gone = self.df.index[0]
+    self.store.load(self.df.drop(index=gone).sample(frac=1))  # other row numbers
+    self.assertEqual(len(ranking), len(self.df)-1)
+    self.assertListEqual([p.fullname for p in ranking], [f for f in order if f != f"/media/{gone}"],
+                         "found again by name, in the same order")
+    self.assertEqual(ranking.rank_of(ranking[3].fullname), 3)
+    self.assertRaises(KeyError, ranking.rank_of, f"/media/{gone}")
+    self.assertEqual(ranking.total_matches(), self.df['nmatches'].drop(index=gone).sum())
+
+  def test_values(self):
+    self.assertDictEqual(self.store.values("f5.jpg"), self.df.loc["f5.jpg"].to_dict())
+
+  def test_schema(self):
+    self.assertListEqual(schema_errors(self.df, SYSTEMS), [])
+    self.assertListEqual(schema_errors(self.df.drop(columns='ELO_rd'), SYSTEMS), ["missing columns ['ELO_rd']"])
+    bad = self.df.astype({'Glicko_pts': float})
+    bad.loc["f3.jpg", 'stars'] = -1
+    bad.loc["f4.jpg", 'tags'] = np.nan
+    errors = schema_errors(bad, SYSTEMS)
+    self.assertEqual(len(errors), 2, errors)
+    self.assertRaises(AssertionError, self.store.load, bad)
+    negative = self.df.copy()
+    negative.loc["f3.jpg", 'stars'] = -.5
+    self.assertListEqual(schema_errors(negative, SYSTEMS), ["negative stars in ['f3.jpg']"])
+
+  def test_strict(self):
+    row = self.df.loc["f1.jpg"].copy()
+    row['ELO_pts'] = 1500.5
+    self.store.set_row("f1.jpg", row)  # truncated silently
+    strict = ProfileStore("/media", SYSTEMS, strict=True)
+    strict.load(self.df)
+    self.assertRaises(AssertionError, strict.set_row, "f1.jpg", row)
+
+
+if __name__ == "__main__":
+  unittest.main()
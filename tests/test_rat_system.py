@@ -1,10 +1,11 @@
 from typing import Callable
+import string
 import unittest
 import random
 import copy
 import numpy as np
 
-from rating_backends import RatingBackend, ELO, Glicko
+from rating_backends import RatingBackend, ELO, Glicko, TrueSkill, BradleyTerry
 from ae_rater_types import MatchInfo, ProfileInfo, Outcome, RatChange, Rating
 
 def make_testcase(system:RatingBackend):
@@ -199,6 +200,70 @@ class TestELO(make_testcase(ELO())):
 class TestGlicko(make_testcase(Glicko())):
   pass
 
+class TestTrueSkill(make_testcase(TrueSkill())):
+  def test_big_match_ranking(self):
+    system = TrueSkill()
+    n = 26
+    participants = [ProfileInfo(f"p{i}", "", 2, {system.name():system.stars_to_rating(2)}) for i in range(n)]
+    changes = system.process_match(MatchInfo(participants, Outcome(' '.join(string.ascii_lowercase[:n]))))
+    deltas = [ch.delta_rating for ch in changes]
+    self.assertGreater(deltas[0], 0)
+    self.assertLess(deltas[-1], 0)
+    self.assertTrue(all(better >= worse for better, worse in zip(deltas, deltas[1:])))
+    old_rds = [p.ratings[system.name()].rd for p in participants]
+    new_rds = [ch.new_rating.rd for ch in changes]
+    self.assertTrue(all(new <= old for new, old in zip(new_rds, old_rds)))
+    self.assertLess(sum(new_rds), sum(old_rds))
+
+  def test_tier_draws(self):
+    system = TrueSkill()
+    participants = [ProfileInfo(f"p{i}", "", 2, {system.name():system.stars_to_rating(2)}) for i in range(6)]
+    changes = system.process_match(MatchInfo(participants, Outcome("abc def")))
+    for i in range(3):
+      self.assertGreater(changes[i].delta_rating, 0)
+      self.assertLess(changes[3+i].delta_rating, 0)
+
+
+class TestBradleyTerry(unittest.TestCase):
+  def setUp(self):
+    self.system = BradleyTerry()
+    self.prior = np.full(4, self.system.stars_to_rating(2).points)
+
+  def _fit(self, games:list[tuple[int,int]], times:int=1, init_pts=None):
+    winners, losers = np.array(games).T
+    return self.system.fit(winners, losers, np.full(len(games), float(times)), self.prior, init_pts)
+
+  def test_order_recovered(self):
+    points, errors = self._fit([(0,1), (1,2), (2,3), (0,2), (1,3), (0,3)])
+    self.assertTrue(all(points[i] > points[i+1] for i in range(3)))
+    self.assertTrue(all(errors < self.system.stars_to_rating(2).rd))
+
+  def test_no_games(self):
+    points, errors = self._fit([(0,1)], times=0)
+    self.assertListEqual(list(points), list(self.prior))
+    self.assertTrue(all(errors == self.system.stars_to_rating(2).rd))
+
+  def test_unbeaten_stays_finite(self):
+    points, errors = self._fit([(0,1)], times=1000)
+    self.assertTrue(np.all(np.isfinite(points)))
+    self.assertGreater(points[0], points[1])
+    self.assertEqual(points[2], self.prior[2])
+
+  def test_more_games_less_error(self):
+    _, few = self._fit([(0,1), (1,0), (0,1)])
+    _, many = self._fit([(0,1), (1,0), (0,1)], times=10)
+    self.assertTrue(all(many[:2] < few[:2]))
+
+  def test_draws_are_even(self):
+    points, _ = self._fit([(0,1), (1,0)], times=0.5)
+    self.assertEqual(points[0], points[1])
+
+  def test_warm_start(self):
+    games = [(0,1), (1,2), (2,3), (3,0), (0,2)]
+    cold = self._fit(games)
+    warm = self._fit(games, init_pts=cold[0])
+    self.assertTrue(np.allclose(cold[0], warm[0], atol=1))
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,69 @@
+import os
+import unittest
+import numpy as np
+import pandas as pd
+
+from ai_backend_stars import RandomForest
+from db_managers import MetadataManager
+from tag_features import TagFeaturizer
+import tests.helpers as hlp
+from tests.helpers import MEDIA_FOLDER
+
+
+def defgettr(stars) -> dict:
+  return {"elo": 1200+int(stars)}
+
+
+class TestTagFeaturizer(unittest.TestCase):
+  def setUp(self):
+    self.db = pd.DataFrame({
+      'tags': ["lighting|colors lighting", "lighting", "", "mood mood|epic"],
+      'awards': ["", "e_lighting", "wallpaper", ""],
+    }, index=["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+    self.featurizer = TagFeaturizer().fit(self.db)
+
+  def test_exact_tokens(self):
+    x = self.featurizer.transform_db(self.db)
+    self.assertEqual(x.shape, (4, 6))
+    lighting = self.featurizer.col_of["lighting"]
+    np.testing.assert_array_equal(x[:, lighting].toarray().ravel(), [1, 1, 0, 0])
+    colors = self.featurizer.col_of["lighting|colors"]
+    np.testing.assert_array_equal(x[:, colors].toarray().ravel(), [1, 0, 0, 0])
+    wallpaper = self.featurizer.col_of["award:wallpaper"]
+    np.testing.assert_array_equal(x[:, wallpaper].toarray().ravel(), [0, 0, 1, 0])
+    np.testing.assert_array_equal(x.sum(axis=1).A1, [2, 2, 1, 2])
+
+  def test_unknown_tokens(self):
+    x = self.featurizer.transform([["Lighting", "unseen", "lighting"], []])
+    self.assertEqual(x.nnz, 1)
+    self.assertEqual(x[0, self.featurizer.col_of["lighting"]], 1)
+
+
+class TestRandomForest(unittest.TestCase):
+  def tearDown(self):
+    hlp.disk_cleanup()
+
+  def test_predict(self):
+    mm = MetadataManager(MEDIA_FOLDER, defaults_getter=defgettr)
+    rf = RandomForest(mm)
+    db = mm.get_db()
+    features = rf.featurizer.db_features(mm)
+    self.assertIs(rf.featurizer.db_features(mm), features, "cached while the db doesn't change")
+
+    by_db = rf.predict_db()
+    self.assertListEqual(list(by_db.index), list(db.index))
+    np.testing.assert_array_equal(features.toarray(), rf.featurizer.transform_db(db).toarray(),
+                                  "the tag matrix gives the same features as the strings")
+    items = [(tags.split(), awards.split()) for tags, awards in zip(db['tags'], db['awards'])]
+    np.testing.assert_allclose(rf.predict_many(items), by_db.to_numpy(), err_msg="served like trained")
+    self.assertAlmostEqual(rf.predict_from_tags(*items[0]), by_db.iloc[0])
+
+    name = db.index[0]
+    fullname = os.path.join(MEDIA_FOLDER, name)
+    hlp.backup_files([fullname])
+    mm.update(fullname, {'tags': "lighting"})
+    self.assertIsNot(rf.featurizer.db_features(mm), features, "recomputed after an update")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,62 @@
+import random
+import unittest
+import numpy as np
+import pandas as pd
+
+from tag_matrix import TagMatrix
+
+
+VOCAB = ["a", "a|b", "a|c", "d", "e"]
+
+def random_tags(n:int, extra:int=0) -> pd.Series:
+  pool = VOCAB + [f"x{i}" for i in range(extra)]
+  return pd.Series([' '.join(random.sample(pool, random.randint(0, 4))) for _ in range(n)],
+                   index=[f"f{i}.jpg" for i in range(n)])
+
+
+class TestTagMatrix(unittest.TestCase):
+  def _check(self, tags:pd.Series, tm:TagMatrix):
+    split = tags.str.split()
+    expected = pd.concat([pd.Series(l, dtype=object) for l in split]).value_counts()
+    counts = tm.counts()
+    self.assertDictEqual(counts[counts > 0].to_dict(), expected.to_dict())
+    pd.testing.assert_series_equal(tm.strings(), split.map(lambda l: ' '.join(sorted(l))))
+    np.testing.assert_array_equal(tm.bool_matrix().sum(axis=1), split.map(len).to_numpy())
+
+  def test_against_strings(self):
+    tags = random_tags(500)
+    self._check(tags, TagMatrix(tags, VOCAB))
+
+  def test_wide(self):
+    tags = random_tags(500, extra=150)  # past the first 64-bit words
+    tm = TagMatrix(tags, VOCAB)
+    self.assertEqual(tm.bits.shape[1], 3)
+    self.assertListEqual(tm.vocab[:len(VOCAB)], VOCAB)
+    self._check(tags, tm)
+
+  def test_set_row(self):
+    tags = random_tags(100)
+    tm = TagMatrix(tags, VOCAB)
+    for name in random.sample(list(tags.index), 20):
+      tags[name] = random.choice(["", "d e", "a a|c", "new1 new2"]) + f" more{random.randint(0, 70)}"
+      tm.set_row(name, tags[name])
+    self._check(tags, tm)
+
+  def test_filter(self):
+    tags = pd.Series(["a a|b d", "a|b e", "d"], index=["1", "2", "3"])
+    tm = TagMatrix(tags, VOCAB)
+    self.assertListEqual(list(tm.strings(keep=tm.mask(["a|b", "d"]))), ["a|b d", "a|b", "d"])
+
+  def test_has_any(self):
+    tags = random_tags(200)
+    tm = TagMatrix(tags, VOCAB)
+    split = tags.str.split()
+    self.assertListEqual(tm.containing("|"), ["a|b", "a|c"])
+    for query in [["a"], ["a|b", "d"], ["nonexistent"], tm.containing("a")]:
+      np.testing.assert_array_equal(tm.has_any(query), split.map(lambda l: any(q in l for q in query)).to_numpy(), query)
+    names = random.sample(list(tags.index), 50)
+    np.testing.assert_array_equal(tm.has_any(["e"], tm.rows(names)), split[names].map(lambda l: "e" in l).to_numpy())
+
+
+if __name__ == "__main__":
+  unittest.main()
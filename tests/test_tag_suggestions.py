@@ -0,0 +1,152 @@
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from unittest.mock import patch
+
+import ai_assistant
+from ai_types import TagsBackend
+from metadata import ManualMetadata, write_metadata
+from tag_suggestions import SuggestionCache, precompute
+import tests.helpers as hlp
+from tests import SOURCE_PATH
+from tests.helpers import MEDIA_FOLDER
+
+
+class FakeBackend(TagsBackend):
+  version = "fake@1"
+
+  def __init__(self, broken:set[str]=()) -> None:
+    self.broken = broken
+    self.batches = []
+    self.singles = []
+
+  def suggest_tags(self, fullname):
+    if os.path.basename(fullname) in self.broken:
+      raise ValueError("cannot decode")
+    self.singles.append(fullname)
+    return [("lighting", .9), (os.path.basename(fullname), .5)]
+
+  def suggest_many(self, fullnames):
+    self.batches.append(len(fullnames))
+    return [self.suggest_tags(f) for f in fullnames]
+
+
+class TestSuggestionCache(unittest.TestCase):
+  def setUp(self):
+    self.cache = SuggestionCache(MEDIA_FOLDER, FakeBackend.version)
+    self.fullname = os.path.join(MEDIA_FOLDER, "dog.jpg")
+
+  def tearDown(self):
+    hlp.disk_cleanup()
+
+  def test_roundtrip(self):
+    self.assertIsNone(self.cache.get(self.fullname))
+    self.cache.put(self.fullname, [("lighting", .91234), ("composition|frames", .1)])
+    self.cache.commit()
+    expected = [("lighting", .9123), ("composition|frames", .1)]
+    self.assertListEqual(self.cache.get(self.fullname), expected)
+    self.assertListEqual(SuggestionCache(MEDIA_FOLDER, FakeBackend.version).get(self.fullname), expected)
+    self.assertIsNone(SuggestionCache(MEDIA_FOLDER, "fake@2").get(self.fullname), "new model")
+    self.assertFalse(self.cache.covers(os.path.join(hlp.EXTRA_FOLDER, "dog.jpg")))
+
+  def test_invalidation(self):
+    hlp.backup_files([self.fullname])
+    self.cache.put(self.fullname, [("lighting", .9)])
+    write_metadata(self.fullname, ManualMetadata(tags=["lighting"], stars=3))
+    self.assertIsNotNone(self.cache.get(self.fullname), "only the metadata changed")
+    with open(self.fullname, 'ab') as f:
+      f.write(b"\0"*1024)
+    with open(self.fullname, 'r+b') as f:
+      f.seek(-1024-2, os.SEEK_END)
+      f.write(b"\1")  # inside the image data
+    self.assertIsNone(self.cache.get(self.fullname), "the content changed")
+    os.remove(self.fullname)
+    self.assertIsNone(self.cache.get(self.fullname))
+
+  def test_commit_due(self):
+    self.cache.put(self.fullname, [("lighting", .9)])
+    self.cache.commit_due()
+    self.assertFalse(os.path.exists(self.cache.fname), "not committed per suggestion")
+    self.cache.last_commit -= SuggestionCache.COMMIT_INTERVAL
+    self.cache.commit_due()
+    self.assertIsNotNone(SuggestionCache(MEDIA_FOLDER, FakeBackend.version).get(self.fullname))
+    self.assertFalse(self.cache.dirty)
+
+  def test_precompute(self):
+    names = sorted(f for f in hlp.get_initial_mediafiles() if hlp.file_extension(f) in ('jpg', 'jpeg'))
+    backend = FakeBackend()
+    self.cache.put(os.path.join(MEDIA_FOLDER, names[0]), [("lighting", .9)])
+    self.assertEqual(precompute(self.cache, backend, names, chunk=4), len(names)-1)
+    self.assertEqual(sum(backend.batches), len(names)-1)
+    self.assertEqual(max(backend.batches), 4)
+    self.assertListEqual(SuggestionCache(MEDIA_FOLDER, FakeBackend.version).stale(names), [])
+    self.assertEqual(precompute(self.cache, backend, names), 0, "everything is fresh")
+
+  def test_precompute_broken(self):
+    names = sorted(f for f in hlp.get_initial_mediafiles() if hlp.file_extension(f) in ('jpg', 'jpeg'))[:5]
+    backend = FakeBackend(broken={names[2]})
+    self.assertEqual(precompute(self.cache, backend, names), 4)
+    self.assertListEqual(self.cache.stale(names), [names[2]])
+
+
+class SlowBackend(FakeBackend):
+  loading = threading.Event()
+
+  def __init__(self) -> None:
+    super().__init__()
+    assert self.loading.wait(10)
+
+
+class TestAssistant(unittest.TestCase):
+  def setUp(self):
+    SlowBackend.loading.clear()
+    self.fullname = os.path.join(MEDIA_FOLDER, "dog.jpg")
+
+  def tearDown(self):
+    hlp.disk_cleanup()
+
+  def test_lazy_loading(self):
+    with patch.object(ai_assistant, 'ConvnextTiny', SlowBackend):
+      assistant = ai_assistant.Assistant()
+      self.assertIsNone(assistant.tags_backend, "the model isn't loaded on construction")
+      self.assertIsNone(assistant.suggest_tags_nowait(self.fullname))
+      self.assertEqual(assistant.predict_rating(self.fullname), assistant.stars_backend.AVERAGE,
+                       "ratings don't wait for the model")
+      self.assertEqual(assistant.status(), "loading model...")
+      SlowBackend.loading.set()
+      expected = [("lighting", .9), ("dog.jpg", .5)]
+      self.assertListEqual(assistant.suggest_tags(self.fullname), expected)
+      self.assertFalse(assistant.is_loading())
+      self.assertEqual(assistant.predict_rating(self.fullname), assistant.stars_backend.AVERAGE)
+      while (suggested := assistant.suggest_tags_nowait(self.fullname)) is None:
+        pass
+      self.assertListEqual(suggested, expected)
+      self.assertEqual(len(assistant.tags_backend.singles), 2)
+
+  def test_commit_on_close(self):
+    with patch.object(ai_assistant, 'ConvnextTiny', FakeBackend):
+      assistant = ai_assistant.Assistant()
+      assistant.cache = SuggestionCache(MEDIA_FOLDER, FakeBackend.version)
+      self.assertListEqual(assistant.suggest_tags(self.fullname), [("lighting", .9), ("dog.jpg", .5)])
+      self.assertFalse(os.path.exists(assistant.cache.fname))
+      assistant.close()
+      self.assertIsNotNone(SuggestionCache(MEDIA_FOLDER, FakeBackend.version).get(self.fullname))
+
+  def test_no_model(self):
+    with patch.object(ai_assistant, 'ConvnextTiny', side_effect=FileNotFoundError("no model")):
+      assistant = ai_assistant.Assistant()
+      self.assertListEqual(assistant.suggest_tags(self.fullname), [])
+      self.assertListEqual(assistant.suggest_tags_nowait(self.fullname) or [], [])
+
+  def test_light_imports(self):
+    check = ("import sys; sys.path.append(sys.argv[1]); import ae_rater, down_model;"
+             "print(' '.join(m for m in ('torch', 'fastai', 'sklearn', 'matplotlib') if m in sys.modules))")
+    res = subprocess.run([sys.executable, '-c', check, SOURCE_PATH], capture_output=True, text=True)
+    self.assertEqual(res.returncode, 0, res.stderr)
+    self.assertEqual(res.stdout.strip(), "", "heavy ml deps are imported only when the backends load")
+
+
+if __name__ == "__main__":
+  unittest.main()
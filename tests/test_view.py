@@ -31,6 +31,7 @@ class MockListener(UserListener):
   def consume_result(self, *args, **kwargs): pass
   def update_meta(self, *args, **kwargs): pass
   def suggest_tags(self, *args, **kwargs): pass
+  def suggestions_status(self): return ""
   def search_for(self, *args, **kwargs): return []
 
 
@@ -0,0 +1,59 @@
+import threading
+import time
+import unittest
+
+from write_behind import WriteBehind
+
+
+class TestWriteBehind(unittest.TestCase):
+  def test_order(self):
+    writer = WriteBehind(maxsize=4)
+    done = []
+    for i in range(100):
+      writer.submit(f"job {i}", done.append, i)
+    writer.drain()
+    self.assertListEqual(done, list(range(100)))
+    writer.close()
+
+  def test_failures(self):
+    writer = WriteBehind()
+    done = []
+    writer.submit("bad", lambda: 1/0)
+    writer.submit("good", done.append, 1)
+    writer.drain()
+    self.assertListEqual(done, [1])
+    failures = writer.pop_failures()
+    self.assertEqual(len(failures), 1)
+    self.assertTrue(failures[0].startswith("bad: "))
+    self.assertListEqual(writer.pop_failures(), [])
+    writer.close()
+
+  def test_pending(self):
+    writer = WriteBehind()
+    gate = threading.Event()
+    writer.submit("blocked", gate.wait, key="a")
+    writer.submit("after", time.sleep, 0, key="a")
+    self.assertTrue(writer.is_pending("a"))
+    self.assertFalse(writer.is_pending("b"))
+    gate.set()
+    writer.drain()
+    self.assertFalse(writer.is_pending("a"))
+    writer.close()
+
+  def test_bounded(self):
+    writer = WriteBehind(maxsize=2)
+    gate = threading.Event()
+    writer.submit("blocked", gate.wait)
+    writer.submit("1", time.sleep, 0)
+    writer.submit("2", time.sleep, 0)
+    submitted = threading.Event()
+    threading.Thread(target=lambda: (writer.submit("3", time.sleep, 0), submitted.set())).start()
+    self.assertFalse(submitted.wait(.2))
+    gate.set()
+    self.assertTrue(submitted.wait(5))
+    writer.close()
+    self.assertFalse(writer.thread.is_alive())
+
+
+if __name__ == "__main__":
+  unittest.main()